@@ -0,0 +1,188 @@
+import argparse
+import itertools
+import json
+import os
+import time
+import numpy as np
+
+import app.crud as crud
+from app.database import session_for
+from app.datekeys import epoch_day, from_epoch_day, from_month_key, month_bounds
+from app.versions import VersionedCache, get_version
+
+# Unusual spending, over a user's whole expense history:
+# - month: a category's spend in a month far above its average of the months before
+# - day: a category's spend on a day far above its average of the days before
+# - transaction: a single expense far larger than is usual for its category
+# Expenses are loaded as a few integer columns, and each rule is a handful of NumPy operations
+# over a (category x period) matrix: rolling sums come from cumulative sums, per-category
+# statistics from bincount. Results are cached until the user's data changes.
+# Run as a module to scan every user:
+#
+#   python -m app.anomalies [--output anomalies.jsonl]
+
+# Rolling window, periods with spending the baseline needs in it (a category spent on now and
+# then has no usual daily or monthly amount), z-score and multiple of the baseline to flag
+MONTH_RULE = {'window': 12, 'min_active': 9, 'z': 3.5, 'ratio': 2.0}
+DAY_RULE = {'window': 90, 'min_active': 30, 'z': 4.0, 'ratio': 3.0}
+# Transactions against the log amounts of their category
+TRANSACTION_RULE = {'min_count': 10, 'z': 3.5, 'ratio': 3.0}
+
+anomaly_cache = VersionedCache(maxsize=int(os.environ.get("FINA_ANOMALY_CACHE_SIZE", 64)))
+
+_LOAD = """
+    SELECT id, category_id, date_key, month_key, amount FROM transactions
+    WHERE user_id = ? AND transaction_type_id = 1
+      AND category_id IS NOT NULL AND date_key IS NOT NULL AND amount > 0
+"""
+
+def load(db, user_id: int):
+    # (n, 5) int64 array: id, category_id, date_key, month_key, amount. Read with the DBAPI cursor,
+    # as plain tuples: building result rows costs over ten times the query itself
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.execute(_LOAD, (int(user_id),))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    return np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=len(rows) * 5).reshape(-1, 5)
+
+def _month_index(month_keys):
+    return (month_keys // 100) * 12 + month_keys % 100 - 1
+
+def _from_month_index(index: int) -> int:
+    return (index // 12) * 100 + index % 12 + 1
+
+def _spikes(group, period, amounts, window: int, min_active: int, z: float, ratio: float):
+    # Totals per (group, period) compared with the mean and deviation of the group's previous
+    # `window` periods, counted from its first period with spending
+    groups, periods = group.max() + 1, period.max() + 1
+    totals = np.bincount(group * periods + period, weights=amounts, minlength=groups * periods).reshape(groups, periods)
+    # sums[:, k] is the total of periods [0, k)
+    sums = np.zeros((groups, periods + 1))
+    squares = np.zeros((groups, periods + 1))
+    active = np.zeros((groups, periods + 1), dtype=np.int64)
+    np.cumsum(totals, axis=1, out=sums[:, 1:])
+    np.cumsum(totals ** 2, axis=1, out=squares[:, 1:])
+    np.cumsum(totals > 0, axis=1, out=active[:, 1:])
+
+    first = np.argmax(totals > 0, axis=1)
+    index = np.arange(periods)
+    start = np.maximum(index - window, 0)[None, :].repeat(groups, axis=0)
+    start = np.maximum(start, first[:, None])
+    count = index[None, :] - start
+    rows = np.arange(groups)[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (sums[rows, index] - sums[rows, start]) / count
+        variance = (squares[rows, index] - squares[rows, start]) / count - mean ** 2
+        deviation = np.sqrt(np.maximum(variance, 0))
+        # A steady series has no deviation; measure it against a tenth of its mean instead
+        deviation = np.maximum(deviation, mean * 0.1)
+        score = (totals - mean) / deviation
+    flagged = (active[rows, index] - active[rows, start] >= min_active) & (totals >= ratio * mean) & (score >= z)
+    group_index, period_index = np.nonzero(flagged)
+    return group_index, period_index, totals[flagged], mean[flagged], score[flagged]
+
+def detect(history):
+    # Anomalies in a load() array, newest first
+    if len(history) == 0:
+        return []
+    ids, category_ids, days, months, amounts = history.T
+    codes, group = np.unique(category_ids, return_inverse=True)
+    amounts = amounts.astype(np.float64)
+    flags = []
+
+    month_index = _month_index(months)
+    first_month = month_index.min()
+    for g, period, amount, baseline, score in zip(*_spikes(group, month_index - first_month, amounts, **MONTH_RULE)):
+        key = int(_from_month_index(first_month + period))
+        flags.append({'kind': 'month', 'category_id': int(codes[g]), 'month_key': key, 'date_key': epoch_day(from_month_key(key)),
+                      'amount': int(amount), 'baseline': int(round(baseline)), 'score': round(float(score), 1)})
+
+    first_day = days.min()
+    for g, period, amount, baseline, score in zip(*_spikes(group, days - first_day, amounts, **DAY_RULE)):
+        flags.append({'kind': 'day', 'category_id': int(codes[g]), 'date_key': int(first_day + period),
+                      'amount': int(amount), 'baseline': int(round(baseline)), 'score': round(float(score), 1)})
+
+    # Single transactions, against the mean and deviation of their category's log amounts
+    logs = np.log(amounts)
+    count = np.bincount(group)
+    mean = np.bincount(group, weights=logs) / count
+    deviation = np.sqrt(np.maximum(np.bincount(group, weights=logs ** 2) / count - mean ** 2, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = (logs - mean[group]) / deviation[group]
+    typical = np.exp(mean[group])
+    flagged = (count[group] >= TRANSACTION_RULE['min_count']) & (deviation[group] > 0) \
+        & (score >= TRANSACTION_RULE['z']) & (amounts >= TRANSACTION_RULE['ratio'] * typical)
+    for row in np.nonzero(flagged)[0]:
+        flags.append({'kind': 'transaction', 'category_id': int(category_ids[row]), 'transaction_id': int(ids[row]),
+                      'date_key': int(days[row]), 'amount': int(amounts[row]), 'baseline': int(round(typical[row])),
+                      'score': round(float(score[row]), 1)})
+
+    return sorted(flags, key=lambda flag: (-flag['date_key'], -flag['score']))
+
+def get_anomalies(db, user_id):
+    user_id = int(user_id)
+    cached = anomaly_cache.get(user_id, 'anomalies')
+    if cached is not None:
+        return cached
+    # Read before loading, so a write that races the scan leaves the entry already stale
+    version = get_version(user_id)
+    flags = detect(load(db, user_id))
+    anomaly_cache.set(user_id, 'anomalies', flags, version)
+    return flags
+
+def in_window(flags, from_key: int, to_key: int, names: dict, limit: int = 10):
+    # Flags for days in [from_key, to_key] and months overlapping it, the strongest first
+    shown = []
+    for flag in flags:
+        if flag['kind'] == 'month':
+            first, last = (epoch_day(day) for day in month_bounds(flag['month_key']))
+        else:
+            first = last = flag['date_key']
+        if first <= to_key and last >= from_key:
+            shown.append({**flag, 'category_name': names.get(flag['category_id'], ''), 'date': from_epoch_day(flag['date_key'])})
+    return sorted(shown, key=lambda flag: -flag['score'])[:limit]
+
+### Batch job
+def scan_all(output: str = None):
+    db = session_for()
+    try:
+        user_ids = [user.id for user in crud.get_users(db) if user.is_active and user.deleted_date is None]
+    finally:
+        db.close()
+
+    totals = {'users': 0, 'transactions': 0, 'anomalies': 0, 'load_seconds': 0.0, 'detect_seconds': 0.0}
+    out = open(output, 'w') if output else None
+    try:
+        for user_id in user_ids:
+            db = session_for(user_id)
+            try:
+                started = time.perf_counter()
+                history = load(db, user_id)
+                loaded = time.perf_counter()
+                flags = detect(history)
+                totals['load_seconds'] += loaded - started
+                totals['detect_seconds'] += time.perf_counter() - loaded
+            finally:
+                db.close()
+            totals['users'] += 1
+            totals['transactions'] += len(history)
+            totals['anomalies'] += len(flags)
+            if out:
+                for flag in flags:
+                    out.write(json.dumps({'user_id': user_id, **flag}) + '\n')
+    finally:
+        if out:
+            out.close()
+    return totals
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Flag unusual spending for every user")
+    parser.add_argument('--output', help='write the anomalies as JSON lines to this file')
+    args = parser.parse_args()
+    totals = scan_all(args.output)
+    seconds = totals['load_seconds'] + totals['detect_seconds']
+    print(f"{totals['users']} users, {totals['transactions']} expenses, {totals['anomalies']} anomalies in {seconds:.2f}s "
+          f"(load {totals['load_seconds']:.2f}s, detect {totals['detect_seconds']:.2f}s, "
+          f"{totals['transactions'] / seconds if seconds else 0:,.0f} expenses/s)")
@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import os
+import time
+from datetime import date, datetime
+from sqlalchemy import text
+
+import app.models as models
+import app.search as search
+from app.database import session_for
+from app.datekeys import add_months, epoch_day, month_bounds, month_key
+from app.versions import mark_changed
+
+# Hot/cold storage of transactions. Months before the archive horizon (FINA_ARCHIVE_MONTHS before
+# the current one, default 24) are moved out of transactions into archived_transactions, and their
+# totals per wallet, category, type and month are kept in transaction_summaries. Balances, the
+# cashflow chart and compare_periods add the summaries to the hot rows, so they stay correct while
+# full-history reads only touch recent months; archived rows themselves are read only on request
+# (/transactions?archived=1 and the CSV export). Run as a module:
+#
+#   python -m app.archive [--months 24] [--user 3]
+#
+# FINA_ARCHIVE=1 runs the same job from the app after each month ends. Archived rows stay counted
+# in category_spend and are not recorded in the change log: they moved, they did not change.
+ARCHIVE_MONTHS = int(os.environ.get("FINA_ARCHIVE_MONTHS", 24))
+
+_COLUMNS = ', '.join(column.name for column in models.Transaction.__table__.columns)
+
+_SUMMARIZE = """
+    INSERT INTO transaction_summaries (user_id, wallet_id, category_id, transaction_type_id, month_key, amount, count)
+    SELECT user_id, wallet_id, category_id, transaction_type_id, month_key, sum(amount), count(*)
+    FROM archived_transactions
+    WHERE {where}
+    GROUP BY month_key, wallet_id, category_id, transaction_type_id
+"""
+
+def horizon(months: int = ARCHIVE_MONTHS, today: date = None) -> int:
+    # First month kept hot
+    return add_months(month_key(today or date.today()), -months)
+
+def summarize_where(db, where: str, params: dict):
+    db.execute(text(f"DELETE FROM transaction_summaries WHERE {where}"), params)
+    db.execute(text(_SUMMARIZE.format(where=where)), params)
+
+def rebuild_summaries(db, user_id: int):
+    # After the amounts of archived rows change (rescale_money)
+    summarize_where(db, "user_id = :user_id", {'user_id': user_id})
+
+def reserve_archived_ids(connection):
+    # transactions is AUTOINCREMENT, so new rows never take the id of an archived one; a table
+    # filled by copying rows (migration, shard split) starts its sequence above both tables
+    connection.execute(text("DELETE FROM sqlite_sequence WHERE name = 'transactions'"))
+    connection.execute(text("""
+        INSERT INTO sqlite_sequence (name, seq)
+        SELECT 'transactions', max(coalesce((SELECT max(id) FROM transactions), 0), coalesce((SELECT max(id) FROM archived_transactions), 0))
+    """))
+
+def archive_month(db, user_id: int, key: int):
+    where = "transactions.user_id = :user_id AND transactions.month_key = :month_key"
+    params = {'user_id': user_id, 'month_key': key}
+    search.unindex_where(db, where, params)
+    moved = db.execute(text(f"INSERT INTO archived_transactions ({_COLUMNS}, archived_date) SELECT {_COLUMNS}, :now FROM transactions WHERE {where}"),
+                       {**params, 'now': datetime.now()}).rowcount
+    db.execute(text(f"DELETE FROM transactions WHERE {where}"), params)
+    summarize_where(db, "user_id = :user_id AND month_key = :month_key", params)
+    return moved
+
+def archive_user(db, user_id: int, before: int):
+    user_id = int(user_id)
+    months = [row[0] for row in db.execute(text("SELECT DISTINCT month_key FROM transactions WHERE user_id = :user_id AND month_key < :before ORDER BY month_key"),
+                                           {'user_id': user_id, 'before': before})]
+    moved = 0
+    for key in months:
+        moved += archive_month(db, user_id, key)
+        mark_changed(db, user_id)
+        # One commit per month, so other writers are not blocked for the whole account
+        db.commit()
+    return moved
+
+### Reads
+def get_summaries(db, user_id: int, wallet_id: int = None):
+    # Archived months as rows shaped like transactions, dated on the last day of their month, for
+    # computations that only add amounts up
+    query = db.query(models.TransactionSummary).filter(models.TransactionSummary.user_id == user_id)
+    if wallet_id is not None:
+        query = query.filter(models.TransactionSummary.wallet_id == wallet_id)
+    return [{'wallet_id': summary.wallet_id, 'category_id': summary.category_id, 'transaction_type_id': summary.transaction_type_id,
+             'amount': summary.amount, 'month_key': summary.month_key, 'date_key': epoch_day(month_bounds(summary.month_key)[1])}
+            for summary in query]
+
+### Batch job
+def archive_all(months: int = ARCHIVE_MONTHS, user_ids: list = None, today: date = None):
+    before = horizon(months, today)
+    if user_ids is None:
+        db = session_for()
+        try:
+            user_ids = [row[0] for row in db.execute(text("SELECT id FROM users WHERE deleted_date IS NULL"))]
+        finally:
+            db.close()
+
+    totals = {'users': 0, 'transactions': 0, 'failed': 0, 'seconds': 0.0}
+    started = time.perf_counter()
+    for user_id in user_ids:
+        db = session_for(user_id)
+        try:
+            moved = archive_user(db, user_id, before)
+        except Exception as error:
+            # One failing account must not hold up the others; its remaining months are retried on the next run
+            db.rollback()
+            print(f"Archiving user {user_id} failed: {error!r}")
+            totals['failed'] += 1
+            continue
+        finally:
+            db.close()
+        totals['users'] += moved > 0
+        totals['transactions'] += moved
+    totals['seconds'] = time.perf_counter() - started
+    return totals
+
+async def schedule(interval: float = 3600):
+    # Archives once per process and again after each month ends
+    done = None
+    while True:
+        key = month_key(date.today())
+        if key != done:
+            try:
+                await asyncio.to_thread(archive_all)
+                done = key
+            except Exception as error:
+                # Tried again after the next interval instead of ending the task
+                print(f"Archiving failed: {error!r}")
+        await asyncio.sleep(interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Move old transactions to the archive")
+    parser.add_argument('--months', type=int, default=ARCHIVE_MONTHS, help='months before the current one kept hot')
+    parser.add_argument('--user', type=int, action='append', help='only this user (repeatable)')
+    args = parser.parse_args()
+    totals = archive_all(args.months, args.user)
+    print(f"{totals['transactions']} transactions of {totals['users']} users archived before {horizon(args.months)} "
+          f"in {totals['seconds']:.2f}s" + (f", {totals['failed']} users failed" if totals['failed'] else ""))
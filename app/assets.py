@@ -0,0 +1,149 @@
+import gzip
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import shutil
+import sys
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Static asset bundles. `python -m app.assets` concatenates the files of each bundle, names the
+# result after a hash of its content and writes gzip (and brotli, when installed) copies next to
+# it, all under static/dist with a manifest. Templates resolve bundle names through asset_urls(),
+# so a changed file gets a new URL and everything under dist/ can be cached forever.
+# Without a build the templates fall back to the source files.
+STATIC_DIRECTORY = "static"
+DIST_DIRECTORY = "dist"
+MANIFEST = "manifest.json"
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# Files served from installed packages rather than static/, so they always match the package
+# version: plotly.js for the dashboard charts, which are rendered without their own copy of it.
+# Found without importing plotly, which only report workers load.
+PACKAGE_FILES = {
+    'js/plotly.min.js': os.path.join(os.path.dirname(importlib.util.find_spec('plotly').origin), 'package_data', 'plotly.min.js'),
+}
+
+# Bundle -> source files under static/ (or in PACKAGE_FILES), in load order. Only what the
+# templates use: the plugins all ship minified builds, so those are bundled as they are.
+BUNDLES = {
+    'css/app.css': ['css/bootstrap.min.css', 'css/plugins.min.css', 'css/kaiadmin.min.css'],
+    'css/fonts.css': ['css/fonts.min.css'],
+    'js/webfont.js': ['js/plugin/webfont/webfont.min.js'],
+    'js/core.js': ['js/core/jquery-3.7.1.min.js', 'js/core/popper.min.js', 'js/core/bootstrap.min.js'],
+    'js/plugins.js': ['js/plugin/jquery-scrollbar/jquery.scrollbar.min.js',
+                      'js/plugin/jquery.sparkline/jquery.sparkline.min.js',
+                      'js/plugin/sweetalert/sweetalert.min.js'],
+    'js/kaiadmin.js': ['js/kaiadmin.min.js'],
+    'js/plotly.js': ['js/plotly.min.js'],
+}
+
+SOURCE_MAP = re.compile(r"^\s*(//# sourceMappingURL=.*|/\*# sourceMappingURL=.*\*/)\s*$", re.M)
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+def _absolute_urls(css: str, source: str) -> str:
+    # Bundles live in another directory than their sources, so relative url()s are made absolute
+    base = os.path.dirname(source)
+    def replace(match):
+        quote, url = match.groups()
+        if url.startswith(('data:', 'http:', 'https:', '/', '#')):
+            return match.group(0)
+        return f"url({quote}/{STATIC_DIRECTORY}/{os.path.normpath(os.path.join(base, url)).replace(os.sep, '/')}{quote})"
+    return CSS_URL.sub(replace, css)
+
+def bundle(name: str, sources: list, directory: str = STATIC_DIRECTORY) -> bytes:
+    parts = []
+    for source in sources:
+        with open(PACKAGE_FILES.get(source) or os.path.join(directory, source), encoding='utf-8') as file:
+            content = SOURCE_MAP.sub('', file.read()).strip()
+        if name.endswith('.css'):
+            content = _absolute_urls(content, source)
+        else:
+            # Guard against files that do not end their last statement
+            content += ';'
+        parts.append(content)
+    return ('\n'.join(parts) + '\n').encode('utf-8')
+
+def build(directory: str = STATIC_DIRECTORY):
+    dist = os.path.join(directory, DIST_DIRECTORY)
+    shutil.rmtree(dist, ignore_errors=True)
+    manifest = {}
+    for name, sources in BUNDLES.items():
+        content = bundle(name, sources, directory)
+        stem, extension = os.path.splitext(name)
+        path = f"{DIST_DIRECTORY}/{stem}.{hashlib.sha256(content).hexdigest()[:12]}{extension}"
+        target = os.path.join(directory, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as file:
+            file.write(content)
+        # mtime=0 keeps the compressed copies byte-identical between builds
+        with open(target + '.gz', 'wb') as file:
+            file.write(gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(target + '.br', 'wb') as file:
+                file.write(brotli.compress(content, quality=11))
+        manifest[name] = path
+        print(f"{path} {len(content)} bytes from {len(sources)} files")
+    with open(os.path.join(dist, MANIFEST), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+def load_manifest(directory: str = STATIC_DIRECTORY):
+    try:
+        with open(os.path.join(directory, DIST_DIRECTORY, MANIFEST)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+manifest = load_manifest()
+
+def asset_urls(name: str) -> list:
+    # The built bundle, or its source files when the assets have not been built
+    if name in manifest:
+        return [f"/{STATIC_DIRECTORY}/{manifest[name]}"]
+    return [f"/{STATIC_DIRECTORY}/{source}" for source in BUNDLES.get(name, [name])]
+
+def asset_url(name: str) -> str:
+    urls = asset_urls(name)
+    if len(urls) != 1:
+        raise ValueError(f"{name} is not built into a single file")
+    return urls[0]
+
+class AssetFiles(StaticFiles):
+    # StaticFiles serving the fingerprinted bundles with immutable caching, and their precompressed
+    # copies to clients that accept them
+    async def get_response(self, path: str, scope):
+        if path in PACKAGE_FILES:
+            # Unbuilt assets only: built bundles already hold these files
+            return FileResponse(PACKAGE_FILES[path], media_type=self.media_type(path))
+        if not path.startswith(DIST_DIRECTORY + '/'):
+            return await super().get_response(path, scope)
+        accepted = Headers(scope=scope).get('accept-encoding', '')
+        response = None
+        for encoding, suffix in [('br', '.br'), ('gzip', '.gz')]:
+            if encoding in accepted and os.path.isfile(os.path.join(self.directory, path + suffix)):
+                response = await super().get_response(path + suffix, scope)
+                if response.status_code == 200:
+                    response.headers['content-encoding'] = encoding
+                    response.headers['content-type'] = self.media_type(path)
+                break
+        if response is None:
+            response = await super().get_response(path, scope)
+        response.headers['cache-control'] = IMMUTABLE
+        response.headers['vary'] = 'Accept-Encoding'
+        return response
+
+    @staticmethod
+    def media_type(path: str) -> str:
+        return 'text/css; charset=utf-8' if path.endswith('.css') else 'text/javascript; charset=utf-8'
+
+if __name__ == '__main__':
+    build(sys.argv[1] if len(sys.argv) > 1 else STATIC_DIRECTORY)
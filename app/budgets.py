@@ -0,0 +1,53 @@
+from sqlalchemy import text
+
+# Running spend per category and month in category_spend, kept current by the crud write paths so
+# budget status never scans transactions. Like the search index, counters are adjusted with
+# set-based statements over a WHERE clause on transactions: uncount rows before they change or
+# go away, count them again afterwards. Archived transactions (app/archive.py) stay counted; when
+# counters are rebuilt, or a wallet goes, their summaries stand in for them.
+
+_ADJUST = """
+    INSERT INTO category_spend (category_id, month_key, amount, count)
+    SELECT transactions.category_id, transactions.month_key, {sign} * sum(transactions.amount), {sign} * count(*)
+    FROM transactions
+    WHERE transactions.category_id IS NOT NULL AND transactions.month_key IS NOT NULL AND ({where})
+    GROUP BY transactions.category_id, transactions.month_key
+    ON CONFLICT (category_id, month_key) DO UPDATE SET amount = amount + excluded.amount, count = count + excluded.count
+"""
+
+_ADJUST_ARCHIVED = """
+    INSERT INTO category_spend (category_id, month_key, amount, count)
+    SELECT transaction_summaries.category_id, transaction_summaries.month_key, {sign} * sum(transaction_summaries.amount), {sign} * sum(transaction_summaries.count)
+    FROM transaction_summaries
+    WHERE transaction_summaries.category_id IS NOT NULL AND ({where})
+    GROUP BY transaction_summaries.category_id, transaction_summaries.month_key
+    ON CONFLICT (category_id, month_key) DO UPDATE SET amount = amount + excluded.amount, count = count + excluded.count
+"""
+
+def count_where(db, where: str, params: dict):
+    db.execute(text(_ADJUST.format(sign=1, where=where)), params)
+
+def uncount_where(db, where: str, params: dict):
+    db.execute(text(_ADJUST.format(sign=-1, where=where)), params)
+
+def count_archived_where(db, where: str, params: dict):
+    db.execute(text(_ADJUST_ARCHIVED.format(sign=1, where=where)), params)
+
+def uncount_archived_where(db, where: str, params: dict):
+    db.execute(text(_ADJUST_ARCHIVED.format(sign=-1, where=where)), params)
+
+def count_transaction(db, transaction_id: int):
+    count_where(db, "transactions.id = :id", {'id': transaction_id})
+
+def uncount_transaction(db, transaction_id: int):
+    uncount_where(db, "transactions.id = :id", {'id': transaction_id})
+
+def recount_user(db, user_id: int):
+    db.execute(text("DELETE FROM category_spend WHERE category_id IN (SELECT id FROM categories WHERE user_id = :user_id)"), {'user_id': user_id})
+    count_where(db, "transactions.user_id = :user_id", {'user_id': user_id})
+    count_archived_where(db, "transaction_summaries.user_id = :user_id", {'user_id': user_id})
+
+def rebuild_counters(connection):
+    connection.execute(text("DELETE FROM category_spend"))
+    connection.execute(text(_ADJUST.format(sign=1, where="1")))
+    connection.execute(text(_ADJUST_ARCHIVED.format(sign=1, where="1")))
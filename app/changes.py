@@ -0,0 +1,67 @@
+from datetime import datetime
+from sqlalchemy import text
+
+import app.models as models
+
+# Append-only log of the inserts, updates and deletes of users' rows, for clients that keep a copy
+# of a user's data. The crud write paths record the rows they touch in change_log, in the same
+# transaction as the write; seq only grows (AUTOINCREMENT), so a client asks for everything after
+# the last seq it has seen. Like the search index and spend counters, rows are recorded with
+# set-based statements over a WHERE clause, and deletes are recorded before the rows go away.
+SYNCED_TABLES = ["wallets", "categories", "budgets", "transactions"]
+
+_RECORD = """
+    INSERT INTO change_log (user_id, table_name, row_id, operation)
+    SELECT {source}.user_id, '{table}', {source}.id, :operation FROM {source} WHERE {where} ORDER BY {source}.id
+"""
+
+def record_where(db, table: str, operation: str, where: str, params: dict, source: str = None):
+    # source: the table the rows are read from when it is not the one they are recorded under,
+    # as archived_transactions for transactions
+    db.execute(text(_RECORD.format(table=table, source=source or table, where=where)), {**params, 'operation': operation})
+
+def record(db, table: str, operation: str, row_id: int):
+    record_where(db, table, operation, f"{table}.id = :row_id", {'row_id': row_id})
+
+def record_all(connection):
+    # Every existing row as an insert, so a client starting from seq 0 gets the full data
+    for table in SYNCED_TABLES:
+        record_where(connection, table, 'insert', "1", {})
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def get_changes(db, user_id: int, since: int = 0, limit: int = 500):
+    entries = db.execute(text("""
+        SELECT seq, table_name, row_id, operation FROM change_log
+        WHERE user_id = :user_id AND seq > :since ORDER BY seq LIMIT :limit
+    """), {'user_id': user_id, 'since': since, 'limit': limit}).all()
+
+    # One entry per row, at its latest seq. A row inserted within the page stays an insert.
+    latest = {}
+    for seq, table, row_id, operation in entries:
+        previous = latest.pop((table, row_id), None)
+        if previous is not None and previous['operation'] == 'insert' and operation == 'update':
+            operation = 'insert'
+        latest[(table, row_id)] = {'seq': seq, 'table': table, 'id': row_id, 'operation': operation}
+
+    # Current values of the rows still there, one query per table
+    changes = []
+    rows = {}
+    for table in SYNCED_TABLES:
+        ids = [change['id'] for change in latest.values() if change['table'] == table and change['operation'] != 'delete']
+        if ids:
+            model_table = models.Base.metadata.tables[table]
+            for row in db.execute(model_table.select().where(model_table.c.id.in_(ids))):
+                rows[(table, row.id)] = {key: _value(value) for key, value in row._mapping.items()}
+    for key, change in latest.items():
+        if change['operation'] != 'delete':
+            if key not in rows:
+                # Deleted since; the delete comes in a later page
+                continue
+            change['row'] = rows[key]
+        changes.append(change)
+
+    return {'changes': changes,
+            'next': entries[-1].seq if entries else since,
+            'more': len(entries) == limit}
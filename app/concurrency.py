@@ -0,0 +1,85 @@
+import asyncio
+import os
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from app.database import session_for
+from app.versions import VersionedCache, get_version
+
+class SingleFlight:
+    # Concurrent calls with the same key share one running computation
+    def __init__(self):
+        self.calls = {}
+
+    async def run(self, key, compute):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(compute())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self.calls.pop(key) if self.calls.get(key) is done else None)
+        # A caller that disconnects must not cancel the computation the others wait for
+        return await asyncio.shield(task)
+
+class AdmissionLimiter:
+    # At most per_user_limit computations per user and global_limit overall. Callers over the
+    # per-user limit are shed at once, the others queue for a global slot up to queue_timeout seconds.
+    def __init__(self, global_limit: int, per_user_limit: int, queue_timeout: float, retry_after: int):
+        self.slots = asyncio.Semaphore(global_limit)
+        self.per_user_limit = per_user_limit
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.running = defaultdict(int)
+
+    def overloaded(self):
+        return HTTPException(status_code=503, detail="Server busy, try again shortly", headers={'Retry-After': str(self.retry_after)})
+
+    @asynccontextmanager
+    async def admit(self, user_id):
+        if self.running[user_id] >= self.per_user_limit:
+            raise self.overloaded()
+        self.running[user_id] += 1
+        try:
+            try:
+                await asyncio.wait_for(self.slots.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise self.overloaded()
+            try:
+                yield
+            finally:
+                self.slots.release()
+        finally:
+            self.running[user_id] -= 1
+            if self.running[user_id] == 0:
+                del self.running[user_id]
+
+report_flights = SingleFlight()
+report_cache = VersionedCache(maxsize=int(os.environ.get("FINA_REPORT_CACHE_SIZE", 8)))
+report_limiter = AdmissionLimiter(global_limit=int(os.environ.get("FINA_REPORT_CONCURRENCY", 4)),
+                                  per_user_limit=int(os.environ.get("FINA_REPORT_CONCURRENCY_PER_USER", 2)),
+                                  queue_timeout=float(os.environ.get("FINA_REPORT_QUEUE_TIMEOUT", 10)),
+                                  retry_after=int(os.environ.get("FINA_REPORT_RETRY_AFTER", 5)))
+
+def _with_session(user_id, function, *args):
+    # The computation can outlive the request that started it, so it gets its own session
+    db = session_for(user_id)
+    try:
+        return function(db, *args)
+    finally:
+        db.close()
+
+async def run_report(key, user_id, function, *args):
+    # Results are cached until the user's data changes. Identical requests (same user, key and
+    # data version) share one computation; only that computation counts against the limits and runs
+    # in the threadpool, off the event loop
+    cached = report_cache.get(user_id, key)
+    if cached is not None:
+        return cached
+    version = get_version(user_id)
+    async def compute():
+        async with report_limiter.admit(user_id):
+            result = await run_in_threadpool(_with_session, user_id, function, *args)
+        report_cache.set(user_id, key, result, version)
+        return result
+    return await report_flights.run((user_id, key, version), compute)
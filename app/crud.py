@@ -1,10 +1,14 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_, desc
+import re
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import and_, or_, desc, func, cast, select, insert, delete, table, column, text, literal, union_all, Integer
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 from fastapi import HTTPException
 
-import app.models as models, app.schemas as schemas
+import app.models as models, app.schemas as schemas, app.search as search, app.budgets as budgets, app.changes as changes, app.duplicates as duplicates, app.archive as archive, app.rules as rules
+from app.versions import mark_changed
+from app.formatting import minor_unit_scale
+from app.datekeys import add_months, epoch_day, month_bounds, month_key
 
 ### User functions
 def get_user(db: Session, user_id: int):
@@ -43,14 +47,53 @@ def update_user(db: Session,
     if fullname is not None:
         db_user.fullname = fullname
     if currency is not None:
+        if currency != db_user.currency:
+            rescale_money(db, user_id=db_user.id, old_currency=db_user.currency, new_currency=currency)
         db_user.currency = currency
     if is_active is not None:
         db_user.is_active = is_active
     
+    mark_changed(db, db_user.id)
     db.commit()
     db.refresh(db_user)
     return db_user
 
+def rescale_money(db: Session, user_id: int, old_currency: str, new_currency: str):
+    # Keep the displayed amounts when the currency precision changes (e.g. VND -> USD)
+    old_scale, new_scale = minor_unit_scale(old_currency), minor_unit_scale(new_currency)
+    if old_scale == new_scale:
+        return
+    if new_scale > old_scale:
+        factor = new_scale // old_scale
+        for model in [models.Transaction, models.ArchivedTransaction]:
+            db.query(model).filter(model.user_id == user_id)\
+                .update({model.amount: model.amount * factor}, synchronize_session=False)
+        db.query(models.Wallet).filter(models.Wallet.user_id == user_id)\
+            .update({models.Wallet.initial_balance: models.Wallet.initial_balance * factor}, synchronize_session=False)
+        db.query(models.Budget).filter(models.Budget.user_id == user_id)\
+            .update({models.Budget.amount: models.Budget.amount * factor}, synchronize_session=False)
+        db.query(models.CategoryRule).filter(models.CategoryRule.user_id == user_id)\
+            .update({models.CategoryRule.min_amount: models.CategoryRule.min_amount * factor,
+                     models.CategoryRule.max_amount: models.CategoryRule.max_amount * factor}, synchronize_session=False)
+    else:
+        factor = old_scale // new_scale
+        for model in [models.Transaction, models.ArchivedTransaction]:
+            db.query(model).filter(model.user_id == user_id)\
+                .update({model.amount: cast(func.round(model.amount * 1.0 / factor), Integer)}, synchronize_session=False)
+        db.query(models.Wallet).filter(models.Wallet.user_id == user_id)\
+            .update({models.Wallet.initial_balance: cast(func.round(models.Wallet.initial_balance * 1.0 / factor), Integer)}, synchronize_session=False)
+        db.query(models.Budget).filter(models.Budget.user_id == user_id)\
+            .update({models.Budget.amount: cast(func.round(models.Budget.amount * 1.0 / factor), Integer)}, synchronize_session=False)
+        db.query(models.CategoryRule).filter(models.CategoryRule.user_id == user_id)\
+            .update({models.CategoryRule.min_amount: cast(func.round(models.CategoryRule.min_amount * 1.0 / factor), Integer),
+                     models.CategoryRule.max_amount: cast(func.round(models.CategoryRule.max_amount * 1.0 / factor), Integer)}, synchronize_session=False)
+    # Rounded amounts no longer add up to the old totals
+    archive.rebuild_summaries(db, user_id)
+    budgets.recount_user(db, user_id)
+    duplicates.refingerprint_where(db, "user_id = :user_id", {'user_id': user_id})
+    for table_name in ["wallets", "budgets", "transactions"]:
+        changes.record_where(db, table_name, 'update', f"{table_name}.user_id = :user_id", {'user_id': user_id})
+
 def inactive_user(db: Session, user_id: int):
     db_user = db.query(models.User).filter(models.User.id == user_id).first()
     if db_user is None:
@@ -65,10 +108,50 @@ def delete_user(db: Session, user_id: int):
     if db_user is None:
         return ValueError("User not found")
     
+    search.unindex_where(db, "transactions.user_id = :user_id", {'user_id': db_user.id})
     db.delete(db_user)
+    mark_changed(db, db_user.id)
     db.commit()
     return db_user
 
+# Accounts above this size are purged in the background, PURGE_BATCH_SIZE rows per commit
+PURGE_BACKGROUND_THRESHOLD = 20000
+PURGE_BATCH_SIZE = 5000
+
+def count_transactions(db: Session, user_id: int):
+    return sum(db.query(func.count(model.id)).filter(model.user_id == user_id).scalar()
+               for model in [models.Transaction, models.ArchivedTransaction])
+
+def request_user_deletion(db: Session, user_id: int):
+    # Lock the account out immediately; the data is removed by delete_user or purge_user
+    db_user = db.query(models.User).filter(models.User.id == user_id).first()
+    if db_user is None:
+        return None
+    db_user.is_active = 0
+    db_user.deleted_date = datetime.now()
+    db.commit()
+    return db_user
+
+def get_users_pending_deletion(db: Session):
+    return db.query(models.User).filter(models.User.deleted_date.isnot(None)).all()
+
+def purge_user(db: Session, user_id: int, batch_size: int = PURGE_BATCH_SIZE):
+    # Delete transactions in bounded batches, committing between them so other writers are not
+    # blocked for the whole purge; the remaining rows then go with the user through ON DELETE CASCADE
+    params = {'user_id': user_id, 'limit': batch_size}
+    for table_name in ["transactions", "archived_transactions"]:
+        batch = f"SELECT id FROM {table_name} WHERE user_id = :user_id ORDER BY id LIMIT :limit"
+        while True:
+            if table_name == "transactions":
+                db.execute(text(f"DELETE FROM {search.FTS_TABLE} WHERE rowid IN ({batch})"), params)
+            deleted = db.execute(text(f"DELETE FROM {table_name} WHERE id IN ({batch})"), params).rowcount
+            mark_changed(db, user_id)
+            db.commit()
+            if deleted < batch_size:
+                break
+
+    return delete_user(db, user_id=user_id)
+
 def create_user(db: Session, user: schemas.UserCreate):
     hashed_password = generate_password_hash(user.password)
     db_user = models.User(username=user.username,
@@ -111,7 +194,7 @@ def get_wallet_by_name(db: Session, user_id: int, wallet_name: str):
 def get_wallet_by_id(db: Session, wallet_id: int):
     return db.query(models.Wallet).filter(models.Wallet.id == wallet_id).first()
 
-def create_wallet(db: Session, user_id: int, wallet_name: str, liability: int = 0, description: str = None, initial_balance: float = 0):
+def create_wallet(db: Session, user_id: int, wallet_name: str, liability: int = 0, description: str = None, initial_balance: int = 0):
     existing_wallet = db.query(models.Wallet).filter(and_(models.Wallet.user_id == user_id, models.Wallet.wallet_name == wallet_name)).first()
     if existing_wallet:
         return ValueError("Wallet exists")
@@ -122,20 +205,27 @@ def create_wallet(db: Session, user_id: int, wallet_name: str, liability: int =
                             liability=liability,
                             initial_balance=initial_balance)
     db.add(db_wallet)
+    db.flush()
+    changes.record(db, 'wallets', 'insert', db_wallet.id)
+    mark_changed(db, user_id)
     db.commit()
     db.refresh(db_wallet)
     return db_wallet
 
-def update_wallet(db: Session, wallet_id: int, wallet_name: str = None, description: str = None, initial_balance: float = None):
+def update_wallet(db: Session, wallet_id: int, wallet_name: str = None, description: str = None, initial_balance: int = None):
     db_wallet = db.query(models.Wallet).filter(models.Wallet.id==wallet_id).first()
     if db_wallet is None:
         return ValueError("Wallet not found")
     if wallet_name is not None:
         db_wallet.wallet_name = wallet_name
+        db.flush()
+        search.reindex_wallet(db, wallet_id)
     if description is not None:
         db_wallet.description = description
     if initial_balance is not None:
         db_wallet.initial_balance = initial_balance
+    changes.record(db, 'wallets', 'update', wallet_id)
+    mark_changed(db, db_wallet.user_id)
     db.commit()
     db.refresh(db_wallet)
     return db_wallet
@@ -144,7 +234,16 @@ def delete_wallet(db: Session, wallet_id: int):
     db_wallet = db.query(models.Wallet).filter(models.Wallet.id==wallet_id).first()
     if db_wallet is None:
         return ValueError("Wallet not found")
+    search.unindex_where(db, "transactions.wallet_id = :wallet_id", {'wallet_id': wallet_id})
+    budgets.uncount_where(db, "transactions.wallet_id = :wallet_id", {'wallet_id': wallet_id})
+    budgets.uncount_archived_where(db, "transaction_summaries.wallet_id = :wallet_id", {'wallet_id': wallet_id})
+    # Its transactions, archived ones included, go with it through ON DELETE CASCADE
+    changes.record_where(db, 'transactions', 'delete', "transactions.wallet_id = :wallet_id", {'wallet_id': wallet_id})
+    changes.record_where(db, 'transactions', 'delete', "archived_transactions.wallet_id = :wallet_id", {'wallet_id': wallet_id},
+                         source='archived_transactions')
+    changes.record(db, 'wallets', 'delete', wallet_id)
     db.delete(db_wallet)
+    mark_changed(db, db_wallet.user_id)
     db.commit()
     return db_wallet
 
@@ -167,6 +266,9 @@ def create_category(db: Session,
                               category_name=category_name,
                               description=description)
     db.add(db_category)
+    db.flush()
+    changes.record(db, 'categories', 'insert', db_category.id)
+    mark_changed(db, user_id)
     db.commit()
     db.refresh(db_category)
     return db_category
@@ -188,11 +290,18 @@ def update_category(db: Session,
         db_category.user_id = user_id
     if transaction_type_id is not None:
         db_category.transaction_type_id = transaction_type_id
+        # Compiled into the user's rule matcher: touch its rules so the matcher is rebuilt
+        db.query(models.CategoryRule).filter(models.CategoryRule.category_id == category_id)\
+            .update({models.CategoryRule.updated_date: datetime.now()}, synchronize_session=False)
     if category_name is not None:
         db_category.category_name = category_name
+        db.flush()
+        search.reindex_category(db, category_id)
     if description is not None:
         db_category.description = description
 
+    changes.record(db, 'categories', 'update', category_id)
+    mark_changed(db, db_category.user_id)
     db.commit()
     db.refresh(db_category)
 
@@ -202,49 +311,387 @@ def delete_category(db: Session, category_id: int):
     db_category = db.query(models.Category).filter(models.Category.id == category_id).first()
     if db_category is None:
         return ValueError("Category not found")
+    search.unindex_where(db, "transactions.category_id = :category_id", {'category_id': category_id})
+    # Its transactions, archived ones included, and budgets go with it through ON DELETE CASCADE
+    for table_name in ["transactions", "budgets"]:
+        changes.record_where(db, table_name, 'delete', f"{table_name}.category_id = :category_id", {'category_id': category_id})
+    changes.record_where(db, 'transactions', 'delete', "archived_transactions.category_id = :category_id", {'category_id': category_id},
+                         source='archived_transactions')
+    changes.record(db, 'categories', 'delete', category_id)
     db.delete(db_category)
+    mark_changed(db, db_category.user_id)
     db.commit()
     return db_category
 
+### Budget functions
+# Share of a budget spent from which it is flagged as nearly used up
+BUDGET_WARNING_RATIO = 0.9
+
+def get_budgets(db: Session, user_id: int, month_key: int = None):
+    # Budgets in force for a month: the month's own amount, else the category's default
+    query = db.query(models.Budget).options(joinedload(models.Budget.category)).filter(models.Budget.user_id == user_id)
+    if month_key is None:
+        return query.filter(models.Budget.month_key.is_(None)).all()
+    budgets_by_category = {}
+    for db_budget in query.filter(or_(models.Budget.month_key.is_(None), models.Budget.month_key == month_key))\
+                          .order_by(models.Budget.month_key.isnot(None)):
+        budgets_by_category[db_budget.category_id] = db_budget
+    return list(budgets_by_category.values())
+
+def set_budget(db: Session, user_id: int, category_id: int, amount: int, month_key: int = None):
+    db_category = db.query(models.Category).filter(models.Category.id == category_id, models.Category.user_id == user_id).first()
+    if db_category is None:
+        raise HTTPException(detail="Invalid category", status_code=400)
+    if amount is not None and amount < 0:
+        raise HTTPException(detail="Budget must not be negative", status_code=400)
+
+    db_budget = db.query(models.Budget).filter(models.Budget.category_id == category_id,
+                                               models.Budget.month_key.is_(None) if month_key is None else models.Budget.month_key == month_key).first()
+    if amount is None:
+        # No amount removes the budget
+        if db_budget is not None:
+            changes.record(db, 'budgets', 'delete', db_budget.id)
+            db.delete(db_budget)
+    elif db_budget is None:
+        db_budget = models.Budget(user_id=user_id, category_id=category_id, month_key=month_key, amount=amount)
+        db.add(db_budget)
+        db.flush()
+        changes.record(db, 'budgets', 'insert', db_budget.id)
+    else:
+        db_budget.amount = amount
+        changes.record(db, 'budgets', 'update', db_budget.id)
+    mark_changed(db, user_id)
+    db.commit()
+    return db_budget
+
+def get_budget_status(db: Session, user_id: int, month: datetime = None):
+    # Spend comes from the running counters in category_spend, so this reads one row per
+    # budgeted category however many transactions the month has
+    key = month_key(month or datetime.now())
+    db_budgets = get_budgets(db, user_id, key)
+    if not db_budgets:
+        return []
+    spent = dict(db.query(models.CategorySpend.category_id, models.CategorySpend.amount)
+                 .filter(models.CategorySpend.category_id.in_([db_budget.category_id for db_budget in db_budgets]),
+                         models.CategorySpend.month_key == key).all())
+
+    status = []
+    for db_budget in db_budgets:
+        amount = spent.get(db_budget.category_id) or 0
+        ratio = amount / db_budget.amount if db_budget.amount else (1.0 if amount else 0.0)
+        status.append({'category_id': db_budget.category_id,
+                       'category_name': db_budget.category.category_name,
+                       'transaction_type_id': db_budget.category.transaction_type_id,
+                       'month_key': key,
+                       'budget': db_budget.amount,
+                       'spent': amount,
+                       'remaining': db_budget.amount - amount,
+                       'ratio': ratio,
+                       'over': amount > db_budget.amount,
+                       'warning': ratio >= BUDGET_WARNING_RATIO})
+    return sorted(status, key=lambda row: -row['ratio'])
+
+### Rule functions
+def get_rules(db: Session, user_id: int):
+    return db.query(models.CategoryRule).options(joinedload(models.CategoryRule.category), joinedload(models.CategoryRule.wallet))\
+        .filter(models.CategoryRule.user_id == user_id)\
+        .order_by(models.CategoryRule.priority, models.CategoryRule.id).all()
+
+def validate_rule(db: Session, user_id: int, category_id: int, keywords: str, pattern: str,
+                  min_amount: int, max_amount: int, wallet_id: int):
+    if db.query(models.Category).filter(models.Category.id == category_id, models.Category.user_id == user_id).first() is None:
+        raise HTTPException(detail="Invalid category", status_code=400)
+    if wallet_id is not None and db.query(models.Wallet).filter(models.Wallet.id == wallet_id, models.Wallet.user_id == user_id).first() is None:
+        raise HTTPException(detail="Invalid wallet", status_code=400)
+    if not (keywords or '').strip(' ,') and not pattern and min_amount is None and max_amount is None and wallet_id is None:
+        raise HTTPException(detail="A rule needs keywords, a pattern, an amount range or a wallet", status_code=400)
+    if min_amount is not None and max_amount is not None and min_amount > max_amount:
+        raise HTTPException(detail="Minimum amount is above the maximum", status_code=400)
+    if pattern:
+        try:
+            rules.compile_pattern(pattern)
+        except re.error as e:
+            raise HTTPException(detail=f"Invalid pattern: {e}", status_code=400)
+
+def create_rule(db: Session,
+                user_id: int,
+                category_id: int,
+                keywords: str = None,
+                pattern: str = None,
+                min_amount: int = None,
+                max_amount: int = None,
+                wallet_id: int = None,
+                priority: int = 0):
+    validate_rule(db, user_id, category_id, keywords, pattern, min_amount, max_amount, wallet_id)
+    db_rule = models.CategoryRule(user_id=user_id, category_id=category_id, keywords=keywords or None, pattern=pattern or None,
+                                  min_amount=min_amount, max_amount=max_amount, wallet_id=wallet_id, priority=priority)
+    db.add(db_rule)
+    db.commit()
+    db.refresh(db_rule)
+    return db_rule
+
+def update_rule(db: Session,
+                rule_id: int,
+                user_id: int,
+                category_id: int,
+                keywords: str = None,
+                pattern: str = None,
+                min_amount: int = None,
+                max_amount: int = None,
+                wallet_id: int = None,
+                priority: int = 0):
+    # Replaces every condition of the rule
+    db_rule = db.query(models.CategoryRule).filter(models.CategoryRule.id == rule_id, models.CategoryRule.user_id == user_id).first()
+    if db_rule is None:
+        raise HTTPException(detail="Rule not found", status_code=404)
+    validate_rule(db, user_id, category_id, keywords, pattern, min_amount, max_amount, wallet_id)
+    db_rule.category_id = category_id
+    db_rule.keywords = keywords or None
+    db_rule.pattern = pattern or None
+    db_rule.min_amount = min_amount
+    db_rule.max_amount = max_amount
+    db_rule.wallet_id = wallet_id
+    db_rule.priority = priority
+    db.commit()
+    db.refresh(db_rule)
+    return db_rule
+
+def delete_rule(db: Session, rule_id: int, user_id: int):
+    db_rule = db.query(models.CategoryRule).filter(models.CategoryRule.id == rule_id, models.CategoryRule.user_id == user_id).first()
+    if db_rule is None:
+        raise HTTPException(detail="Rule not found", status_code=404)
+    db.delete(db_rule)
+    db.commit()
+    return db_rule
+
+### Statement functions
+def get_statements(db: Session, user_id: int):
+    return db.query(models.Statement).filter(models.Statement.user_id == user_id).order_by(desc(models.Statement.month_key)).all()
+
+def get_statement(db: Session, user_id: int, month_key: int):
+    return db.query(models.Statement).filter(models.Statement.user_id == user_id, models.Statement.month_key == month_key).first()
+
+def save_statement(db: Session, user_id: int, month_key: int, pdf_path: str, png_path: str):
+    db_statement = get_statement(db, user_id=user_id, month_key=month_key)
+    if db_statement is None:
+        db_statement = models.Statement(user_id=user_id, month_key=month_key)
+        db.add(db_statement)
+    db_statement.pdf_path = pdf_path
+    db_statement.png_path = png_path
+    db_statement.created_date = datetime.now()
+    db.commit()
+    return db_statement
+
 # Transcation functions
-def get_transactions(db: Session,
-                     user_id: int,
-                     wallet_id: list = None,
-                     category_id: int = None,
-                     transaction_type_id: int = None,
-                     transaction_date: datetime = None,
-                     transaction_date_from: datetime = None,
-                     transaction_date_to: datetime = None):
-    query = db.query(models.Transaction).filter(models.Transaction.user_id == user_id)
+def filter_transactions(db: Session,
+                        user_id: int,
+                        wallet_id: int = None,
+                        category_id: int = None,
+                        transaction_type_id: int = None,
+                        transaction_date: datetime = None,
+                        transaction_date_from: datetime = None,
+                        transaction_date_to: datetime = None,
+                        archived: bool = False):
+    # archived: the rows moved out by app/archive.py instead of the current ones
+    model = models.ArchivedTransaction if archived else models.Transaction
+    query = db.query(model).filter(model.user_id == user_id)
     
     if wallet_id is not None:
-        query = query.filter(models.Transaction.wallet_id == wallet_id)
+        query = query.filter(model.wallet_id == wallet_id)
     if category_id is not None:
-        query = query.filter(models.Transaction.category_id == category_id)
+        query = query.filter(model.category_id == category_id)
     if transaction_type_id is not None:
-        query = query.filter(models.Transaction.transaction_type_id == transaction_type_id)
+        query = query.filter(model.transaction_type_id == transaction_type_id)
     if transaction_date is not None:
-        query = query.filter(models.Transaction.transaction_date == transaction_date)
+        query = query.filter(model.date_key == epoch_day(transaction_date))
     if transaction_date_from is not None:
-        query = query.filter(models.Transaction.transaction_date >= transaction_date_from)
+        query = query.filter(model.date_key >= epoch_day(transaction_date_from))
     if transaction_date_to is not None:
-        query = query.filter(models.Transaction.transaction_date <= transaction_date_to)
-    
-    query = query.order_by(desc(models.Transaction.transaction_date))
+        query = query.filter(model.date_key <= epoch_day(transaction_date_to))
+
+    return query
+
+def search_transactions(query, user_id: int, search_text: str = None, archived: bool = False, ranked: bool = False):
+    if archived:
+        # Archived rows are not in the search index: every word must appear in the description
+        terms = re.findall(r"\w+", search_text or "")
+        return query.filter(*[models.ArchivedTransaction.description.like(f"%{term}%") for term in terms])
+    matches = search.search_subquery(search_text, user_id)
+    if matches is None:
+        return query
+    query = query.join(matches, matches.c.id == models.Transaction.id)
+    # Full-text search ranks the best matches first
+    return query.order_by(matches.c.rank) if ranked else query
+
+def get_transactions(db: Session,
+                     user_id: int,
+                     wallet_id: list = None,
+                     category_id: int = None,
+                     transaction_type_id: int = None,
+                     transaction_date: datetime = None,
+                     transaction_date_from: datetime = None,
+                     transaction_date_to: datetime = None,
+                     search_text: str = None,
+                     limit: int = None,
+                     offset: int = None,
+                     archived: bool = False):
+    model = models.ArchivedTransaction if archived else models.Transaction
+    query = filter_transactions(db, user_id=user_id,
+                                wallet_id=wallet_id,
+                                category_id=category_id,
+                                transaction_type_id=transaction_type_id,
+                                transaction_date=transaction_date,
+                                transaction_date_from=transaction_date_from,
+                                transaction_date_to=transaction_date_to,
+                                archived=archived)
+
+    query = search_transactions(query, user_id, search_text, archived=archived, ranked=True)
+    query = query.order_by(desc(model.date_key), desc(model.id))
+    if limit is not None:
+        # A page of rows is shown with its names, loaded in the same query
+        query = query.options(joinedload(model.category),
+                              joinedload(model.wallet),
+                              joinedload(model.transaction_type))\
+                     .limit(limit).offset(offset)
     
     return query.all()
 
+def export_transactions(db: Session, user_id: int, search_text: str = None, archived: bool = False, **filters):
+    # (id, date, type, category, wallet, amount, description) rows, the latest first, fetched in
+    # batches so a large export is never held in memory at once
+    model = models.ArchivedTransaction if archived else models.Transaction
+    query = search_transactions(filter_transactions(db, user_id=user_id, archived=archived, **filters), user_id, search_text, archived=archived)
+    return query.outerjoin(models.TransactionType, models.TransactionType.id == model.transaction_type_id)\
+                .outerjoin(models.Category, models.Category.id == model.category_id)\
+                .outerjoin(models.Wallet, models.Wallet.id == model.wallet_id)\
+                .with_entities(model.id, model.transaction_date, models.TransactionType.transaction_type_name,
+                               models.Category.category_name, models.Wallet.wallet_name, model.amount, model.description)\
+                .order_by(desc(model.date_key), desc(model.id))\
+                .yield_per(1000)
+
+def get_transaction_facets(db: Session, user_id: int, search_text: str = None, archived: bool = False, **filters):
+    # Row counts per category, wallet, type and month under the active filters, from one
+    # GROUP BY per facet over the same filtered rows. Returns {facet: {value: count}}.
+    model = models.ArchivedTransaction if archived else models.Transaction
+    query = filter_transactions(db, user_id=user_id, archived=archived, **filters)
+    query = search_transactions(query, user_id, search_text, archived=archived)
+    filtered = query.with_entities(model.category_id,
+                                   model.wallet_id,
+                                   model.transaction_type_id,
+                                   model.month_key).cte('filtered')
+
+    facets = {'categories': filtered.c.category_id,
+              'wallets': filtered.c.wallet_id,
+              'transaction_types': filtered.c.transaction_type_id,
+              'months': filtered.c.month_key}
+    statement = union_all(*[select(literal(facet), value, func.count()).group_by(value) for facet, value in facets.items()])
+
+    counts = {facet: {} for facet in facets}
+    for facet, value, count in db.execute(statement):
+        counts[facet][value] = count
+    return counts
+
+# Columns a comparison can be grouped by
+COMPARISON_GROUPS = ('category_id', 'wallet_id', 'transaction_type_id')
+
+def compare_periods(db: Session,
+                    user_id: int,
+                    periods: list,
+                    group_by: tuple = ('category_id',),
+                    transaction_type_ids: tuple = (1, 2),
+                    wallet_id: int = None):
+    # Totals per period and group for any number of (label, first day, last day) periods, from
+    # one grouped query: the periods are a VALUES table joined on the date key range, so each
+    # one is an index range scan on (user_id, date_key). Periods may overlap. Archived
+    # transactions are added from their monthly summaries for the months a period covers whole,
+    # and from the archived rows for the days of the months it covers in part.
+    if not periods:
+        return []
+    if any(column not in COMPARISON_GROUPS for column in group_by):
+        raise HTTPException(detail="Invalid comparison grouping", status_code=400)
+
+    params = {'user_id': user_id}
+    rows, months, days = [], [], []
+    for number, (label, first, last) in enumerate(periods):
+        from_key, to_key = epoch_day(first), epoch_day(last)
+        rows.append(f"(:label_{number}, :from_{number}, :to_{number})")
+        params.update({f'label_{number}': label, f'from_{number}': from_key, f'to_{number}': to_key})
+
+        first_month = month_key(first) if epoch_day(month_bounds(month_key(first))[0]) == from_key else add_months(month_key(first), 1)
+        last_month = month_key(last) if epoch_day(month_bounds(month_key(last))[1]) == to_key else add_months(month_key(last), -1)
+        if first_month <= last_month:
+            months.append(f"(:label_{number}, {first_month}, {last_month})")
+            edges = [(from_key, epoch_day(month_bounds(first_month)[0]) - 1), (epoch_day(month_bounds(last_month)[1]) + 1, to_key)]
+        else:
+            edges = [(from_key, to_key)]
+        days += [f"(:label_{number}, {start}, {end})" for start, end in edges if start <= end]
+
+    types = ', '.join(str(int(type_id)) for type_id in transaction_type_ids)
+    groups = ''.join(f', {column}' for column in group_by)
+    wallet = " AND {table}.wallet_id = :wallet_id" if wallet_id is not None else ""
+    if wallet_id is not None:
+        params['wallet_id'] = wallet_id
+
+    def totals(ranges: str, source: str, join: str, count: str):
+        columns = [f'{source}.{column}' for column in group_by]
+        return f"""
+            SELECT {ranges}.label AS label{''.join(f', {name} AS {column}' for name, column in zip(columns, group_by))},
+                   sum({source}.amount) AS amount, {count} AS count
+            FROM {ranges}
+            JOIN {source} ON {source}.user_id = :user_id AND {join}
+            WHERE {source}.transaction_type_id IN ({types}){wallet.format(table=source)}
+            GROUP BY {ranges}.label{''.join(f', {name}' for name in columns)}
+        """
+
+    ranges = [f"periods (label, from_key, to_key) AS (VALUES {', '.join(rows)})"]
+    branches = [totals('periods', 'transactions', "transactions.date_key BETWEEN periods.from_key AND periods.to_key", 'count(*)')]
+    if months:
+        ranges.append(f"archived_months (label, from_month, to_month) AS (VALUES {', '.join(months)})")
+        branches.append(totals('archived_months', 'transaction_summaries',
+                               "transaction_summaries.month_key BETWEEN archived_months.from_month AND archived_months.to_month",
+                               'sum(transaction_summaries.count)'))
+    if days:
+        ranges.append(f"archived_days (label, from_key, to_key) AS (VALUES {', '.join(days)})")
+        branches.append(totals('archived_days', 'archived_transactions',
+                               "archived_transactions.date_key BETWEEN archived_days.from_key AND archived_days.to_key", 'count(*)'))
+
+    statement = f"""
+        WITH {', '.join(ranges)}
+        SELECT label{groups}, sum(amount) AS amount, sum(count) AS count
+        FROM ({' UNION ALL '.join(branches)})
+        GROUP BY label{groups}
+    """
+    return [dict(row._mapping) for row in db.execute(text(statement), params)]
+
 def create_transaction(db: Session,
                        user_id: int,
                        wallet_id: int,
                        category_id: int,
                        transaction_type_id: int,
-                       amount: float,
+                       amount: int,
                        transaction_date: datetime,
-                       description: str = None):
+                       description: str = None,
+                       allow_duplicate: bool = False):
+    db_transaction = add_transaction(db, user_id, wallet_id, category_id, transaction_type_id, amount, transaction_date, description, allow_duplicate)
+    db.commit()
+    db.refresh(db_transaction)
+    return db_transaction
+
+def add_transaction(db: Session,
+                    user_id: int,
+                    wallet_id: int,
+                    category_id: int,
+                    transaction_type_id: int,
+                    amount: int,
+                    transaction_date: datetime,
+                    description: str = None,
+                    allow_duplicate: bool = False):
+    # Validates and writes the row without committing, so a caller can commit several at once
     transaction_type_categories = get_categories(db=db, user_id=user_id, transaction_type_id=transaction_type_id)
     if transaction_type_id in [1,2] and category_id not in [category.id for category in transaction_type_categories]:
         raise HTTPException(detail="Invalid category or transaction type", status_code=400)
+    if not allow_duplicate:
+        check_duplicate(db, user_id, wallet_id, transaction_type_id, amount, transaction_date, description)
     
     db_transaction = models.Transaction(user_id=user_id,
                                    wallet_id=wallet_id,
@@ -254,17 +701,28 @@ def create_transaction(db: Session,
                                    transaction_date=transaction_date,
                                    description=description)
     db.add(db_transaction)
-    db.commit()
-    db.refresh(db_transaction)
+    db.flush()
+    search.index_transaction(db, db_transaction.id)
+    budgets.count_transaction(db, db_transaction.id)
+    changes.record(db, 'transactions', 'insert', db_transaction.id)
+    mark_changed(db, user_id)
     return db_transaction
 
+def check_duplicate(db: Session, user_id: int, wallet_id: int, transaction_type_id: int, amount: int, transaction_date: datetime, description: str = None):
+    # Same user, wallet, type, day, amount and description as a stored transaction: most likely
+    # posted twice. Callers pass allow_duplicate for the ones that are meant.
+    duplicate_id = duplicates.find_duplicate(db, user_id=user_id, wallet_id=int(wallet_id), transaction_type_id=int(transaction_type_id),
+                                             date_key=epoch_day(transaction_date), amount=amount, description=description)
+    if duplicate_id is not None:
+        raise HTTPException(detail=f"Same transaction already recorded (#{duplicate_id})", status_code=409)
+
 def update_transaction(db: Session,
                        transaction_id: int,
                        user_id: int = None,
                        wallet_id: int = None,
                        category_id: int = None,
                        transaction_type_id = None,
-                       amount: float = None,
+                       amount: int = None,
                        transaction_date: datetime = None,
                        description: str = None):
 
@@ -278,6 +736,9 @@ def update_transaction(db: Session,
         if db_category is None:
             raise ValueError("Invalid category or transaction type")
 
+    # Take the old values out of the spend counters before they change
+    budgets.uncount_transaction(db, transaction_id)
+
     # Update the fields if new values are provided
     if user_id is not None:
         db_transaction.user_id = user_id
@@ -294,6 +755,11 @@ def update_transaction(db: Session,
     if description is not None:
         db_transaction.description = description
 
+    db.flush()
+    search.index_transaction(db, transaction_id)
+    budgets.count_transaction(db, transaction_id)
+    changes.record(db, 'transactions', 'update', transaction_id)
+    mark_changed(db, db_transaction.user_id)
     db.commit()
     db.refresh(db_transaction)
 
@@ -303,10 +769,136 @@ def delete_transaction(db: Session, transaction_id: int):
     db_transaction = db.query(models.Transaction).filter(models.Transaction.id == transaction_id).first()
     if db_transaction is None:
         return ValueError("Transaction not found")
+    search.unindex_transaction(db, transaction_id)
+    budgets.uncount_transaction(db, transaction_id)
+    changes.record(db, 'transactions', 'delete', transaction_id)
     db.delete(db_transaction)
+    mark_changed(db, db_transaction.user_id)
     db.commit()
     return db_transaction
 
+def post_transfer(db: Session,
+                  user_id: int,
+                  transaction_type_id: int,
+                  wallet_id: int,
+                  amount: int,
+                  transaction_date: datetime,
+                  description: str = None,
+                  to_wallet_id: int = None,
+                  to_wallet_name: str = None,
+                  allow_duplicate: bool = False):
+    # Double-entry posting for transfers (type 3, to_wallet_id) and debts (type 4, to_wallet_name):
+    # wallet_id gets amount and the counterparty wallet -amount. Both legs, the transfer record and
+    # a new debt wallet if needed are written with one flush and one commit.
+    db_wallet = db.query(models.Wallet).filter(models.Wallet.id == wallet_id, models.Wallet.user_id == user_id).first()
+    if db_wallet is None:
+        raise HTTPException(detail="Invalid wallet", status_code=400)
+    if not allow_duplicate:
+        check_duplicate(db, user_id, wallet_id, transaction_type_id, amount, transaction_date, description)
+
+    if transaction_type_id == 3:
+        to_wallet = db.query(models.Wallet).filter(models.Wallet.id == to_wallet_id, models.Wallet.user_id == user_id).first()
+    elif transaction_type_id == 4:
+        to_wallet = get_wallet_by_name(db, user_id=user_id, wallet_name=to_wallet_name)
+        if to_wallet is None and to_wallet_name:
+            to_wallet = models.Wallet(user_id=user_id, wallet_name=to_wallet_name, liability=1, initial_balance=0)
+            db.add(to_wallet)
+            db.flush()
+            changes.record(db, 'wallets', 'insert', to_wallet.id)
+    else:
+        raise HTTPException(detail="Invalid transaction type", status_code=400)
+    if to_wallet is None:
+        raise HTTPException(detail="Invalid counterparty wallet", status_code=400)
+
+    db_transfer = models.Transfer(user_id=user_id)
+    for wallet, leg_amount in [(db_wallet, amount), (to_wallet, -amount)]:
+        db.add(models.Transaction(user_id=user_id,
+                                  wallet=wallet,
+                                  category_id=None,
+                                  transaction_type_id=transaction_type_id,
+                                  amount=leg_amount,
+                                  transaction_date=transaction_date,
+                                  description=description,
+                                  transfer=db_transfer))
+    db.flush()
+    search.reindex_where(db, "transactions.transfer_id = :transfer_id", {'transfer_id': db_transfer.id})
+    changes.record_where(db, 'transactions', 'insert', "transactions.transfer_id = :transfer_id", {'transfer_id': db_transfer.id})
+    mark_changed(db, user_id)
+    db.commit()
+    return db_transfer
+
+# Scratch table holding the rows selected by a bulk update or delete
+bulk_ids = table("bulk_transaction_ids", column("id"), schema="temp")
+BULK_SELECTION = "transactions.id IN (SELECT id FROM temp.bulk_transaction_ids)"
+
+def _select_bulk(db: Session, user_id: int, transaction_ids: list = None, search_text: str = None, criteria: list = (), **filters):
+    # Materialize the selected ids once, so every statement that follows (search index,
+    # update or delete) works on the same rows. Ownership is always part of the WHERE clause.
+    query = filter_transactions(db, user_id=user_id, **filters).filter(*criteria)
+    if transaction_ids is not None:
+        query = query.filter(models.Transaction.id.in_(transaction_ids))
+    matches = search.search_subquery(search_text, user_id)
+    if matches is not None:
+        query = query.filter(models.Transaction.id.in_(select(matches.c.id)))
+
+    db.execute(text("CREATE TEMP TABLE IF NOT EXISTS bulk_transaction_ids (id INTEGER PRIMARY KEY)"))
+    db.execute(delete(bulk_ids))
+    db.execute(insert(bulk_ids).from_select(["id"], query.with_entities(models.Transaction.id).statement))
+    return db.query(models.Transaction).filter(models.Transaction.id.in_(select(bulk_ids.c.id)))
+
+def update_transactions(db: Session,
+                        user_id: int,
+                        transaction_ids: list = None,
+                        new_wallet_id: int = None,
+                        new_category_id: int = None,
+                        search_text: str = None,
+                        **filters):
+    values = {}
+    criteria = []
+
+    if new_wallet_id is not None:
+        db_wallet = db.query(models.Wallet).filter(models.Wallet.id == new_wallet_id, models.Wallet.user_id == user_id).first()
+        if db_wallet is None:
+            raise HTTPException(detail="Invalid wallet", status_code=400)
+        values[models.Transaction.wallet_id] = new_wallet_id
+    if new_category_id is not None:
+        db_category = db.query(models.Category).filter(models.Category.id == new_category_id, models.Category.user_id == user_id).first()
+        if db_category is None:
+            raise HTTPException(detail="Invalid category", status_code=400)
+        # Only transactions of the category's type can move to it
+        criteria.append(models.Transaction.transaction_type_id == db_category.transaction_type_id)
+        values[models.Transaction.category_id] = new_category_id
+    if not values:
+        return 0
+
+    query = _select_bulk(db, user_id, transaction_ids=transaction_ids, search_text=search_text, criteria=criteria, **filters)
+    values[models.Transaction.updated_date] = datetime.now()
+    budgets.uncount_where(db, BULK_SELECTION, {})
+    updated = query.update(values, synchronize_session=False)
+
+    search.reindex_where(db, BULK_SELECTION, {})
+    budgets.count_where(db, BULK_SELECTION, {})
+    if new_wallet_id is not None:
+        duplicates.refingerprint_where(db, BULK_SELECTION, {})
+    changes.record_where(db, 'transactions', 'update', BULK_SELECTION, {})
+    mark_changed(db, user_id)
+    db.commit()
+    return updated
+
+def delete_transactions(db: Session,
+                        user_id: int,
+                        transaction_ids: list = None,
+                        search_text: str = None,
+                        **filters):
+    query = _select_bulk(db, user_id, transaction_ids=transaction_ids, search_text=search_text, **filters)
+    search.unindex_where(db, BULK_SELECTION, {})
+    budgets.uncount_where(db, BULK_SELECTION, {})
+    changes.record_where(db, 'transactions', 'delete', BULK_SELECTION, {})
+    deleted = query.delete(synchronize_session=False)
+    mark_changed(db, user_id)
+    db.commit()
+    return deleted
+
 def new_user_setup(db: Session,
                    wallet_list: list,
                    category_list: list,
@@ -324,6 +916,10 @@ def new_user_setup(db: Session,
                                       description=category[2])
         db.add(db_category)
 
+    db.flush()
+    for table_name in ["wallets", "categories"]:
+        changes.record_where(db, table_name, 'insert', f"{table_name}.user_id = :user_id", {'user_id': user_id})
+    mark_changed(db, user_id)
     db.commit()
     db.refresh(db_wallet)
     db.refresh(db_category)
@@ -1,12 +1,69 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///finance_app.db"
+# Override to point a worker (or the load test) at another SQLite file
+SQLALCHEMY_DATABASE_URL = os.environ.get("FINA_DATABASE_URL", "sqlite:///finance_app.db")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False} # connect_args is needed only for SQLite
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Optional sharded storage: with FINA_SHARDS=N the database above is only the directory of users,
+# and each user's data lives in shard_<user_id % N>.db under FINA_SHARD_DIRECTORY, so writes of
+# users in different shards do not wait on one SQLite writer lock
+SHARDS = int(os.environ.get("FINA_SHARDS", 0))
+SHARD_DIRECTORY = os.environ.get("FINA_SHARD_DIRECTORY", "shards")
+# Tables that stay in the directory; shards keep a copy of their users' rows for foreign keys
+DIRECTORY_TABLES = {"users"}
 
-Base = declarative_base()
\ No newline at end of file
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # SQLite only enforces foreign keys (and ON DELETE CASCADE) when asked to, per connection
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    # WAL lets readers in other worker processes run while one of them writes
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
+def sqlite_engine(url: str):
+    bind = create_engine(
+        url, connect_args={"check_same_thread": False} # connect_args is needed only for SQLite
+    )
+    event.listen(bind, "connect", set_sqlite_pragma)
+    return bind
+
+engine = sqlite_engine(SQLALCHEMY_DATABASE_URL)
+
+def shard_path(number: int, directory: str = SHARD_DIRECTORY) -> str:
+    return os.path.join(directory, f"shard_{number}.db")
+
+shard_engines = [sqlite_engine(f"sqlite:///{shard_path(number)}") for number in range(SHARDS)]
+
+def engine_for(user_id):
+    # The database holding a user's wallets, categories and transactions
+    if not SHARDS:
+        return engine
+    return shard_engines[int(user_id) % SHARDS]
+
+class RoutingSession(Session):
+    # Sessions opened for a user (info['user_id']) run everything but the directory tables on the
+    # user's shard. Without sharding, or without a user, everything goes to the main database.
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not SHARDS:
+            return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+        if mapper is not None and mapper.persist_selectable.name in DIRECTORY_TABLES:
+            return engine
+        user_id = self.info.get('user_id')
+        return engine_for(user_id) if user_id is not None else engine
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=RoutingSession)
+
+def session_for(user_id=None):
+    # A session routed to the user's shard; user_id is the authenticated user (the cookie)
+    db = SessionLocal()
+    if user_id and str(user_id).isdigit():
+        bind_user(db, user_id)
+    return db
+
+def bind_user(db, user_id):
+    # For sessions that learn their user late, e.g. right after signup
+    db.info['user_id'] = int(user_id)
+
+Base = declarative_base()
@@ -0,0 +1,57 @@
+import calendar
+from datetime import date, datetime, timedelta
+
+# Integer calendar keys stored next to transaction_date so range scans and
+# month grouping compare integers instead of DATETIME text
+EPOCH = date(1970, 1, 1)
+
+def epoch_day(value) -> int:
+    if isinstance(value, datetime):
+        value = value.date()
+    return (value - EPOCH).days
+
+def month_key(value) -> int:
+    return value.year * 100 + value.month
+
+def from_epoch_day(day: int) -> date:
+    return EPOCH + timedelta(days=int(day))
+
+def from_month_key(key: int) -> date:
+    return date(key // 100, key % 100, 1)
+
+def month_bounds(key: int):
+    # First and last day of a yyyymm month
+    first = from_month_key(key)
+    return first, first.replace(day=calendar.monthrange(first.year, first.month)[1])
+
+def add_months(key: int, months: int) -> int:
+    index = (key // 100) * 12 + key % 100 - 1 + months
+    return (index // 12) * 100 + index % 12 + 1
+
+def month_periods(from_day, to_day):
+    # (yyyymm, first day, last day) for every calendar month touching [from_day, to_day],
+    # the first and last clipped to the range
+    from_day = from_day.date() if isinstance(from_day, datetime) else from_day
+    to_day = to_day.date() if isinstance(to_day, datetime) else to_day
+    periods = []
+    key = month_key(from_day)
+    while key <= month_key(to_day):
+        first, last = month_bounds(key)
+        periods.append((key, max(first, from_day), min(last, to_day)))
+        key = add_months(key, 1)
+    return periods
+
+# Named comparison periods, as month offsets from the anchor month
+PERIOD_PRESETS = {'this_month': 0, 'last_month': -1, 'same_month_last_year': -12}
+
+def resolve_period(spec: str, anchor: date):
+    # A preset name, "month-N" (N months before the anchor month) or an ISO "from:to" range
+    if spec in PERIOD_PRESETS or spec.startswith('month-'):
+        offset = PERIOD_PRESETS[spec] if spec in PERIOD_PRESETS else -int(spec[len('month-'):])
+        first, last = month_bounds(add_months(month_key(anchor), offset))
+        return spec, first, last
+    from_text, _, to_text = spec.partition(':')
+    first, last = date.fromisoformat(from_text), date.fromisoformat(to_text)
+    if first > last:
+        raise ValueError(f"Period {spec} ends before it starts")
+    return spec, first, last
@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+import time
+from hashlib import blake2b
+from sqlalchemy import text
+
+from app.database import session_for
+from app.rules import normalize
+from app.versions import VersionedCache, get_version
+
+# Duplicate transactions, found through transactions.fingerprint: a 64-bit hash of the user,
+# wallet, type, day, amount and description (case, accents and spacing ignored), set by the model
+# on every insert and update and indexed with user_id. Checking a new row is one index lookup, and
+# an account's duplicate clusters come from one GROUP BY over that index, with no pairwise
+# comparison. Run as a module to scan every user:
+#
+#   python -m app.duplicates [--output duplicates.jsonl]
+
+duplicate_cache = VersionedCache(maxsize=int(os.environ.get("FINA_DUPLICATE_CACHE_SIZE", 64)))
+
+# Rows fingerprinted per statement by refingerprint_where and looked up per query by find_existing
+BATCH_SIZE = 500
+
+def _key(wallet_id, transaction_type_id, date_key, amount, description):
+    return (wallet_id, transaction_type_id, date_key, amount, normalize(description))
+
+def fingerprint(user_id, wallet_id, transaction_type_id, date_key, amount, description):
+    if date_key is None:
+        return None
+    key = f"{user_id}|{'|'.join(map(str, _key(wallet_id, transaction_type_id, date_key, amount, description)))}"
+    return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), 'big', signed=True)
+
+_FIELDS = "user_id, wallet_id, transaction_type_id, date_key, amount, description"
+
+def refingerprint_where(db, where: str, params: dict):
+    # After bulk updates of the wallet or amount, which bypass the model events
+    rows = db.execute(text(f"SELECT id, {_FIELDS} FROM transactions WHERE {where}"), params).all()
+    for start in range(0, len(rows), BATCH_SIZE):
+        db.execute(text("UPDATE transactions SET fingerprint = :fingerprint WHERE id = :id"),
+                   [{'id': row[0], 'fingerprint': fingerprint(*row[1:])} for row in rows[start:start + BATCH_SIZE]])
+
+def backfill(connection):
+    # Every row without a fingerprint, for the migration
+    refingerprint_where(connection, "fingerprint IS NULL AND date_key IS NOT NULL", {})
+
+### Checks
+def find_existing(db, user_id, rows):
+    # rows: dicts of wallet_id, transaction_type_id, date_key, amount and description. For each, the
+    # id of a stored transaction it duplicates, or None; one indexed lookup per BATCH_SIZE rows
+    user_id = int(user_id)
+    keys = [fingerprint(user_id, row['wallet_id'], row['transaction_type_id'], row['date_key'], row['amount'], row.get('description'))
+            for row in rows]
+    wanted = sorted({key for key in keys if key is not None})
+    stored = {}
+    for start in range(0, len(wanted), BATCH_SIZE):
+        chunk = wanted[start:start + BATCH_SIZE]
+        placeholders = ', '.join(f":f{number}" for number in range(len(chunk)))
+        found = db.execute(text(f"SELECT fingerprint, id, {_FIELDS} FROM transactions "
+                                f"WHERE user_id = :user_id AND fingerprint IN ({placeholders}) ORDER BY id"),
+                           {'user_id': user_id, **{f"f{number}": key for number, key in enumerate(chunk)}})
+        for row in found:
+            stored.setdefault(row[0], []).append((row[1], _key(*row[3:])))
+
+    matches = []
+    for row, key in zip(rows, keys):
+        fields = _key(row['wallet_id'], row['transaction_type_id'], row['date_key'], row['amount'], row.get('description'))
+        # Compared field by field as well: 64-bit hashes can collide
+        matches.append(next((transaction_id for transaction_id, stored_fields in stored.get(key, ()) if stored_fields == fields), None))
+    return matches
+
+def find_duplicate(db, user_id, wallet_id, transaction_type_id, date_key, amount, description):
+    return find_existing(db, user_id, [{'wallet_id': wallet_id, 'transaction_type_id': transaction_type_id,
+                                        'date_key': date_key, 'amount': amount, 'description': description}])[0]
+
+### Clusters
+_CLUSTERS = text("""
+    SELECT transactions.fingerprint, transactions.id, transactions.wallet_id, transactions.category_id,
+           transactions.transaction_type_id, transactions.date_key, transactions.amount, transactions.description,
+           transactions.created_date
+    FROM transactions
+    JOIN (SELECT fingerprint FROM transactions
+          WHERE user_id = :user_id AND fingerprint IS NOT NULL
+          GROUP BY fingerprint HAVING count(*) > 1) AS repeated
+      ON repeated.fingerprint = transactions.fingerprint
+    WHERE transactions.user_id = :user_id
+    ORDER BY transactions.date_key DESC, transactions.fingerprint, transactions.id
+""")
+
+def clusters(db, user_id):
+    # Groups of two or more transactions with the same fingerprint, the latest day first
+    user_id = int(user_id)
+    groups = {}
+    for row in db.execute(_CLUSTERS, {'user_id': user_id}):
+        groups.setdefault(row[0], []).append({'id': row[1], 'wallet_id': row[2], 'category_id': row[3], 'transaction_type_id': row[4],
+                                              'date_key': row[5], 'amount': row[6], 'description': row[7],
+                                              'created_date': str(row[8]) if row[8] is not None else None})
+    found = []
+    for rows in groups.values():
+        # Same fingerprint, but only rows with the same fields are duplicates of each other
+        by_fields = {}
+        for row in rows:
+            by_fields.setdefault(_key(row['wallet_id'], row['transaction_type_id'], row['date_key'], row['amount'], row['description']), []).append(row)
+        found += [transactions for transactions in by_fields.values() if len(transactions) > 1]
+    return found
+
+def get_clusters(db, user_id):
+    user_id = int(user_id)
+    cached = duplicate_cache.get(user_id, 'clusters')
+    if cached is not None:
+        return cached
+    version = get_version(user_id)
+    found = clusters(db, user_id)
+    duplicate_cache.set(user_id, 'clusters', found, version)
+    return found
+
+### Batch job
+def scan_all(output: str = None):
+    db = session_for()
+    try:
+        user_ids = [row[0] for row in db.execute(text("SELECT id FROM users WHERE is_active = 1 AND deleted_date IS NULL"))]
+    finally:
+        db.close()
+
+    totals = {'users': 0, 'clusters': 0, 'duplicates': 0, 'seconds': 0.0}
+    out = open(output, 'w') if output else None
+    try:
+        for user_id in user_ids:
+            db = session_for(user_id)
+            try:
+                started = time.perf_counter()
+                found = clusters(db, user_id)
+                totals['seconds'] += time.perf_counter() - started
+            finally:
+                db.close()
+            totals['users'] += 1
+            totals['clusters'] += len(found)
+            # Rows beyond the first of each cluster
+            totals['duplicates'] += sum(len(transactions) - 1 for transactions in found)
+            if out:
+                for transactions in found:
+                    out.write(json.dumps({'user_id': user_id, 'transactions': transactions}) + '\n')
+    finally:
+        if out:
+            out.close()
+    return totals
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find duplicate transactions for every user")
+    parser.add_argument('--output', help='write the clusters as JSON lines to this file')
+    args = parser.parse_args()
+    totals = scan_all(args.output)
+    print(f"{totals['users']} users, {totals['clusters']} clusters, {totals['duplicates']} duplicate transactions "
+          f"in {totals['seconds']:.2f}s")
@@ -1,16 +1,25 @@
 from datetime import date, datetime
 
 currencies = {
-    "VND": {'symbol': "₫", 'format': "{:,.0f}", 'symbol_on_left': False},
-    "USD": {'symbol': "$", 'format': "{:,.2f}", 'symbol_on_left': True},
-    "EUR": {'symbol': "€", 'format': "{:,.2f}", 'symbol_on_left': True},
-    "JPY": {'symbol': "¥", 'format': "{:,.0f}", 'symbol_on_left': False},
-    "GBP": {'symbol': "£", 'format': "{:,.2f}", 'symbol_on_left': True},
-    "AUD": {'symbol': "$", 'format': "{:,.2f}", 'symbol_on_left': True},
-    "KRW": {'symbol': "₩", 'format': "{:,.0f}", 'symbol_on_left': False},
-    "THB": {'symbol': "฿", 'format': "{:,.2f}", 'symbol_on_left': True},
+    "VND": {'symbol': "₫", 'format': "{:,.0f}", 'symbol_on_left': False, 'decimals': 0},
+    "USD": {'symbol': "$", 'format': "{:,.2f}", 'symbol_on_left': True, 'decimals': 2},
+    "EUR": {'symbol': "€", 'format': "{:,.2f}", 'symbol_on_left': True, 'decimals': 2},
+    "JPY": {'symbol': "¥", 'format': "{:,.0f}", 'symbol_on_left': False, 'decimals': 0},
+    "GBP": {'symbol': "£", 'format': "{:,.2f}", 'symbol_on_left': True, 'decimals': 2},
+    "AUD": {'symbol': "$", 'format': "{:,.2f}", 'symbol_on_left': True, 'decimals': 2},
+    "KRW": {'symbol': "₩", 'format': "{:,.0f}", 'symbol_on_left': False, 'decimals': 0},
+    "THB": {'symbol': "฿", 'format': "{:,.2f}", 'symbol_on_left': True, 'decimals': 2},
 }
 
+# Money is stored as integer minor units (cents for USD, whole dong for VND)
+def minor_unit_scale(currency: str) -> int:
+    return 10 ** currencies.get(currency, currencies['VND'])['decimals']
+def to_minor_units(value: float, currency: str) -> int:
+    return int(round(value * minor_unit_scale(currency)))
+def from_minor_units(value, currency: str):
+    # Also accepts pandas Series and NumPy arrays
+    return value / minor_unit_scale(currency)
+
 # Custom filter
 def format_number(value: int) -> str:
     return "{:,}".format(value)
@@ -18,8 +27,9 @@ def format_percentage(value: float) -> str:
     return "{:.2%}".format(value)
 def format_date(value: datetime) -> str:
     return value.strftime("%d/%m/%Y")
-def format_money(value: float, currency: str) -> str:
+def format_money(value: int, currency: str) -> str:
     c_info = currencies[currency]
+    value = from_minor_units(value, currency)
     if c_info['symbol_on_left']:
         if value < 0:
             return '-' + c_info['symbol'] + c_info['format'].format(abs(value))
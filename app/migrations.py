@@ -0,0 +1,138 @@
+from sqlalchemy import text
+from sqlalchemy.schema import CreateTable
+
+import app.models as models
+from app.search import FTS_TABLE, rebuild_index
+from app.budgets import rebuild_counters
+from app.changes import record_all
+from app.duplicates import backfill as backfill_fingerprints
+from app.archive import reserve_archived_ids
+from app.formatting import currencies
+
+# Schema migrations for existing databases. models.Base.metadata.create_all() creates
+# missing tables, then every step below not yet recorded in PRAGMA user_version is applied
+# in order. Steps must be safe to run on a freshly created database as well.
+
+def create_search_index(connection):
+    connection.execute(text(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE}
+        USING fts5(description, category_name, wallet_name, owner, tokenize = 'unicode61 remove_diacritics 2')
+    """))
+    # Rank description matches above category and wallet name matches; the owner token does not count
+    connection.execute(text(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rank) VALUES ('rank', 'bm25(10.0, 2.0, 1.0, 0.0)')"))
+    rebuild_index(connection)
+
+def _rebuild_table(connection, table: str, expressions: dict = None):
+    # SQLite cannot change column types: copy the rows into a table built from the current model
+    model_table = models.Base.metadata.tables[table]
+    existing = [row[1] for row in connection.execute(text(f"PRAGMA table_info({table})"))]
+    columns = [column.name for column in model_table.columns if column.name in existing]
+    selected = [(expressions or {}).get(column, column) for column in columns]
+
+    create_sql = str(CreateTable(model_table).compile(connection)).replace(f"CREATE TABLE {table} (", f"CREATE TABLE {table}__new (", 1)
+    connection.execute(text(create_sql))
+    connection.execute(text(f"INSERT INTO {table}__new ({', '.join(columns)}) SELECT {', '.join(selected)} FROM {table}"))
+    connection.execute(text(f"DROP TABLE {table}"))
+    connection.execute(text(f"ALTER TABLE {table}__new RENAME TO {table}"))
+    for index in model_table.indexes:
+        index.create(connection)
+
+def _currency_scale(table: str):
+    return f"CASE (SELECT currency FROM users WHERE users.id = {table}.user_id) " \
+        + " ".join(f"WHEN '{code}' THEN {10 ** info['decimals']}" for code, info in currencies.items()) \
+        + " ELSE 1 END"
+
+def integer_money(connection):
+    # Float amounts become integer minor units of each user's currency
+    _rebuild_table(connection, "transactions", {'amount': f"CAST(ROUND(amount * {_currency_scale('transactions')}) AS INTEGER)"})
+    _rebuild_table(connection, "wallets", {'initial_balance': f"CAST(ROUND(coalesce(initial_balance, 0) * {_currency_scale('wallets')}) AS INTEGER)"})
+
+def _add_column(connection, table: str, column: str, type_: str):
+    existing = [row[1] for row in connection.execute(text(f"PRAGMA table_info({table})"))]
+    if column not in existing:
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {type_}"))
+
+def _create_indexes(connection, table: str):
+    # Indexes on columns a later step adds are left to that step
+    existing = {row[1] for row in connection.execute(text(f"PRAGMA table_info({table})"))}
+    for index in models.Base.metadata.tables[table].indexes:
+        if all(column.name in existing for column in index.columns):
+            index.create(connection, checkfirst=True)
+
+def date_keys(connection):
+    # Backfill epoch day and yyyymm keys from the DATETIME text
+    _add_column(connection, "transactions", "date_key", "INTEGER")
+    _add_column(connection, "transactions", "month_key", "INTEGER")
+    connection.execute(text("""
+        UPDATE transactions
+        SET date_key = CAST(julianday(date(transaction_date)) - 2440587.5 AS INTEGER),
+            month_key = CAST(strftime('%Y%m', transaction_date) AS INTEGER)
+        WHERE transaction_date IS NOT NULL
+    """))
+    _create_indexes(connection, "transactions")
+
+def cascading_deletes(connection):
+    # Rebuild the child tables so their foreign keys carry ON DELETE CASCADE
+    _add_column(connection, "users", "deleted_date", "DATETIME")
+    for table in ["wallets", "categories", "transactions"]:
+        _rebuild_table(connection, table)
+
+def transfer_links(connection):
+    # Link the two legs of existing transfers and debts. Legs were written separately, so pair
+    # them by user, type, day and opposite amount, in id order
+    _add_column(connection, "transactions", "transfer_id", "INTEGER REFERENCES transfers(id) ON DELETE SET NULL")
+    _create_indexes(connection, "transactions")
+    legs = {}
+    for transaction_id, user_id, type_id, day, amount in connection.execute(text("""
+            SELECT id, user_id, transaction_type_id, date_key, amount FROM transactions
+            WHERE transaction_type_id IN (3, 4) AND transfer_id IS NULL AND amount != 0
+            ORDER BY id""")):
+        legs.setdefault((user_id, type_id, day, abs(amount)), ([], []))[amount > 0].append(transaction_id)
+    for outflows, inflows in legs.values():
+        for outflow, inflow in zip(outflows, inflows):
+            transfer_id = connection.execute(text("INSERT INTO transfers (user_id, created_date) SELECT user_id, created_date FROM transactions WHERE id = :id"),
+                                             {'id': min(outflow, inflow)}).lastrowid
+            connection.execute(text("UPDATE transactions SET transfer_id = :transfer_id WHERE id IN (:outflow, :inflow)"),
+                               {'transfer_id': transfer_id, 'outflow': outflow, 'inflow': inflow})
+
+def foreign_key_indexes(connection):
+    for table in ["wallets", "categories", "transactions"]:
+        _create_indexes(connection, table)
+
+def budget_counters(connection):
+    rebuild_counters(connection)
+
+def change_log(connection):
+    # Start the log with the rows that already exist
+    record_all(connection)
+
+def transaction_fingerprints(connection):
+    _add_column(connection, "transactions", "fingerprint", "INTEGER")
+    backfill_fingerprints(connection)
+    _create_indexes(connection, "transactions")
+
+def autoincrement_transaction_ids(connection):
+    # Rebuild transactions as AUTOINCREMENT, so ids freed by deletes or archived are never handed out again
+    create_sql = connection.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'transactions'")).scalar()
+    if 'AUTOINCREMENT' not in create_sql:
+        _rebuild_table(connection, "transactions")
+    reserve_archived_ids(connection)
+
+def scoped_search_index(connection):
+    # FTS5 tables cannot take a new column: recreate the index with the owner token
+    connection.execute(text(f"DROP TABLE IF EXISTS {FTS_TABLE}"))
+    create_search_index(connection)
+
+migrations = [create_search_index, integer_money, date_keys, cascading_deletes, transfer_links, foreign_key_indexes, budget_counters, change_log,
+              transaction_fingerprints, autoincrement_transaction_ids, scoped_search_index]
+
+def run_migrations(engine):
+    with engine.connect() as connection:
+        # Tables are rebuilt with foreign keys off; the pragma must run before any write begins a transaction
+        connection.execute(text("PRAGMA foreign_keys=OFF"))
+        version = connection.execute(text("PRAGMA user_version")).scalar()
+        for number, migration in enumerate(migrations[version:], start=version + 1):
+            migration(connection)
+            connection.execute(text(f"PRAGMA user_version = {number}"))
+        connection.commit()
+        connection.execute(text("PRAGMA foreign_keys=ON"))
@@ -1,8 +1,10 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Float, DateTime
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Index, event
 from sqlalchemy.orm import relationship
 from datetime import datetime
 
 from app.database import Base
+from app.datekeys import epoch_day, month_key
+from app.duplicates import fingerprint
 
 class User(Base):
     __tablename__ = "users"
@@ -16,23 +18,25 @@ class User(Base):
     is_active = Column(Boolean, default=1)
     registered_date = Column(DateTime, default=datetime.now)
     updated_date = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    deleted_date = Column(DateTime) # set while the account data is being purged
 
-    wallets = relationship("Wallet", back_populates="user", cascade="all, delete-orphan")
-    categorys = relationship("Category", back_populates="user", cascade="all, delete-orphan")
-    transactions = relationship("Transaction", back_populates="user", cascade="all, delete-orphan")
+    # Children are removed by ON DELETE CASCADE in the database, not loaded and deleted one by one
+    wallets = relationship("Wallet", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
+    categorys = relationship("Category", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
+    transactions = relationship("Transaction", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
 
 class Wallet(Base):
     __tablename__ = "wallets"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True)
     wallet_name = Column(String)
     description = Column(String)
     liability = Column(Integer)
-    initial_balance = Column(Float)
+    initial_balance = Column(Integer) # minor units of the user currency
 
     user = relationship("User", back_populates="wallets")
-    transaction = relationship("Transaction", back_populates="wallet", cascade="all, delete-orphan")
+    transaction = relationship("Transaction", back_populates="wallet", cascade="all, delete-orphan", passive_deletes=True)
 
 class TransactionType(Base):
     __tablename__ = "transaction_types"
@@ -45,7 +49,7 @@ class Category(Base):
     __tablename__ = "categories"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True)
     transaction_type_id = Column(Integer, ForeignKey("transaction_types.id"))
     category_name = Column(String)
     description = Column(String)
@@ -53,19 +57,24 @@ class Category(Base):
 
     user = relationship("User", back_populates="categorys")
     transaction_type = relationship("TransactionType", back_populates="category")
-    transaction = relationship("Transaction", back_populates="category", cascade="all, delete-orphan")
+    transaction = relationship("Transaction", back_populates="category", cascade="all, delete-orphan", passive_deletes=True)
 
 class Transaction(Base):
     __tablename__ = "transactions"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    wallet_id = Column(Integer, ForeignKey("wallets.id"))
-    category_id = Column(Integer, ForeignKey("categories.id"))
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    # Indexed so ON DELETE CASCADE from a wallet or category does not scan every transaction
+    wallet_id = Column(Integer, ForeignKey("wallets.id", ondelete="CASCADE"), index=True)
+    category_id = Column(Integer, ForeignKey("categories.id", ondelete="CASCADE"), index=True)
     transaction_type_id = Column(Integer, ForeignKey("transaction_types.id"))
-    amount = Column(Float)
+    amount = Column(Integer) # minor units of the user currency
     description = Column(String)
     transaction_date = Column(DateTime)
+    date_key = Column(Integer) # days since 1970-01-01
+    month_key = Column(Integer) # yyyymm
+    transfer_id = Column(Integer, ForeignKey("transfers.id", ondelete="SET NULL"), index=True) # shared by the two legs of a transfer or debt
+    fingerprint = Column(Integer) # app/duplicates.py; equal for transactions that look like duplicates
     created_date = Column(DateTime, default=datetime.now)
     updated_date = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
@@ -73,3 +82,143 @@ class Transaction(Base):
     wallet = relationship("Wallet", back_populates="transaction")
     category = relationship("Category", back_populates="transaction")
     transaction_type = relationship("TransactionType")
+    transfer = relationship("Transfer", back_populates="legs")
+
+    __table_args__ = (Index("ix_transactions_user_date_key", "user_id", "date_key"),
+                      Index("ix_transactions_user_month_key", "user_id", "month_key"),
+                      Index("ix_transactions_user_fingerprint", "user_id", "fingerprint"),
+                      # Ids are never reused, also after the newest rows are deleted: archived rows keep theirs
+                      {'sqlite_autoincrement': True})
+
+class Transfer(Base):
+    __tablename__ = "transfers"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    created_date = Column(DateTime, default=datetime.now)
+
+    legs = relationship("Transaction", back_populates="transfer")
+
+class Budget(Base):
+    __tablename__ = "budgets"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    category_id = Column(Integer, ForeignKey("categories.id", ondelete="CASCADE"), index=True)
+    month_key = Column(Integer) # yyyymm the amount applies to; NULL for every month without its own
+    amount = Column(Integer) # minor units of the user currency
+    created_date = Column(DateTime, default=datetime.now)
+
+    category = relationship("Category")
+
+class CategorySpend(Base):
+    __tablename__ = "category_spend"
+
+    # Running totals maintained by app/budgets.py
+    category_id = Column(Integer, ForeignKey("categories.id", ondelete="CASCADE"), primary_key=True)
+    month_key = Column(Integer, primary_key=True)
+    amount = Column(Integer, default=0) # minor units of the user currency
+    count = Column(Integer, default=0)
+
+class DataVersion(Base):
+    __tablename__ = "data_versions"
+
+    # No foreign key: the row is bumped in the same transaction that deletes the user
+    user_id = Column(Integer, primary_key=True)
+    version = Column(Integer, default=0)
+
+class Statement(Base):
+    __tablename__ = "statements"
+
+    # Index of the files rendered by app/statements.py
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    month_key = Column(Integer) # yyyymm
+    pdf_path = Column(String)
+    png_path = Column(String)
+    created_date = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (Index("ix_statements_user_month_key", "user_id", "month_key", unique=True),)
+
+class CategoryRule(Base):
+    __tablename__ = "category_rules"
+
+    # Auto-categorization rules, compiled by app/rules.py. Every condition set must hold.
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    category_id = Column(Integer, ForeignKey("categories.id", ondelete="CASCADE"), index=True)
+    priority = Column(Integer, default=0) # lowest first when several rules match
+    keywords = Column(String) # comma separated, any of them
+    pattern = Column(String) # regular expression
+    min_amount = Column(Integer) # minor units of the user currency
+    max_amount = Column(Integer)
+    wallet_id = Column(Integer, ForeignKey("wallets.id", ondelete="CASCADE"), index=True)
+    created_date = Column(DateTime, default=datetime.now)
+    updated_date = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    category = relationship("Category")
+    wallet = relationship("Wallet")
+
+class ArchivedTransaction(Base):
+    __tablename__ = "archived_transactions"
+
+    # Cold storage for transactions moved out by app/archive.py; rows keep their transactions.id
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    wallet_id = Column(Integer, ForeignKey("wallets.id", ondelete="CASCADE"), index=True)
+    category_id = Column(Integer, ForeignKey("categories.id", ondelete="CASCADE"), index=True)
+    transaction_type_id = Column(Integer, ForeignKey("transaction_types.id"))
+    amount = Column(Integer) # minor units of the user currency
+    description = Column(String)
+    transaction_date = Column(DateTime)
+    date_key = Column(Integer) # days since 1970-01-01
+    month_key = Column(Integer) # yyyymm
+    transfer_id = Column(Integer, ForeignKey("transfers.id", ondelete="SET NULL"), index=True)
+    fingerprint = Column(Integer)
+    created_date = Column(DateTime)
+    updated_date = Column(DateTime)
+    archived_date = Column(DateTime, default=datetime.now)
+
+    wallet = relationship("Wallet")
+    category = relationship("Category")
+    transaction_type = relationship("TransactionType")
+
+    __table_args__ = (Index("ix_archived_transactions_user_date_key", "user_id", "date_key"),
+                      Index("ix_archived_transactions_user_month_key", "user_id", "month_key"))
+
+class TransactionSummary(Base):
+    __tablename__ = "transaction_summaries"
+
+    # Totals of the archived transactions per wallet, category, type and month, kept by app/archive.py
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    wallet_id = Column(Integer, ForeignKey("wallets.id", ondelete="CASCADE"), index=True)
+    category_id = Column(Integer, ForeignKey("categories.id", ondelete="CASCADE"), index=True)
+    transaction_type_id = Column(Integer, ForeignKey("transaction_types.id"))
+    month_key = Column(Integer) # yyyymm
+    amount = Column(Integer) # minor units of the user currency, signed like transactions.amount
+    count = Column(Integer)
+
+    __table_args__ = (Index("ix_transaction_summaries_user_month_key", "user_id", "month_key"),)
+
+class ChangeLog(Base):
+    __tablename__ = "change_log"
+
+    # Written by app/changes.py; seq never goes back or gets reused
+    seq = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    table_name = Column(String)
+    row_id = Column(Integer)
+    operation = Column(String) # insert, update or delete
+
+    __table_args__ = (Index("ix_change_log_user_seq", "user_id", "seq"),
+                      {'sqlite_autoincrement': True})
+
+@event.listens_for(Transaction, "before_insert")
+@event.listens_for(Transaction, "before_update")
+def set_date_keys(mapper, connection, transaction):
+    if transaction.transaction_date is not None:
+        transaction.date_key = epoch_day(transaction.transaction_date)
+        transaction.month_key = month_key(transaction.transaction_date)
+    transaction.fingerprint = fingerprint(transaction.user_id, transaction.wallet_id, transaction.transaction_type_id,
+                                          transaction.date_key, transaction.amount, transaction.description)
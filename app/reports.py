@@ -1,21 +1,51 @@
 import app.crud as crud
+import app.anomalies as anomalies
+import app.archive as archive
+from app.formatting import from_minor_units
+from app.datekeys import epoch_day, month_periods
 import pandas as pd
 import numpy as np
-from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
-import matplotlib.pyplot as plt
 import plotly.express as px
 import plotly.io as pio
 import plotly.graph_objs as go
 
 colors_map = ["#1d7af3", "#FE5E7B", "#fdaf4b", "#18DFAC", "#6861CE", "#FF79D8", "#53F1F1", "#FFA451"]
 
+# Maximum points sent to the browser per series unless full resolution is requested
+CHART_POINTS = 500
+SPARKLINE_POINTS = 100
+
+### Downsampling
+def lttb(x, y, threshold):
+    # Largest-Triangle-Three-Buckets: keeps the first and last points and, from each of the
+    # threshold - 2 buckets in between, the point forming the largest triangle with the point
+    # kept before it and the average of the next bucket. Returns the indices of the kept points.
+    n = len(y)
+    if threshold < 3 or n <= threshold:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+
+    kept = [0]
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = (edges[bucket + 1], edges[bucket + 2]) if bucket + 2 < len(edges) else (n - 1, n)
+        next_x, next_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        a = kept[-1]
+        area = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        kept.append(start + int(area.argmax()))
+    kept.append(n - 1)
+    return np.array(kept)
+
 ### Assets Dashboard
-def assets_pie_plot(wallets_df, darkmode):
+def assets_pie_plot(wallets_df, darkmode, currency):
     ### Plot Assets pie chart
-    pie_chart_dataset = wallets_df[wallets_df['current_balance'] > 0]
+    pie_chart_dataset = wallets_df[wallets_df['current_balance'] > 0].copy()
     if len(pie_chart_dataset) == 0:
         return None
+    pie_chart_dataset['current_balance'] = from_minor_units(pie_chart_dataset['current_balance'], currency)
     
     if darkmode=='dark':
         fig = px.pie(pie_chart_dataset, values='current_balance',
@@ -38,20 +68,18 @@ def assets_pie_plot(wallets_df, darkmode):
         hoverinfo='label+percent+value')
     fig.update_layout(margin=dict(l=0, r=0, t=0, b=0),
                       height=300)
-    pie_chart_html = pio.to_html(fig, full_html=False)
+    pie_chart_html = pio.to_html(fig, full_html=False, include_plotlyjs=False)
 
     return pie_chart_html
 
-def cashflow_plot(db, assets_transactions_df, wallets_df, fromdate, todate, wallet_filter, darkmode):
+def cashflow_plot(db, assets_transactions_df, wallets_df, fromdate, todate, wallet_filter, darkmode, currency, full_resolution=False):
     cashflow_dataset = assets_transactions_df.copy()
     selected_wallet = None
 
     if fromdate is not None:
-        fromdate_dt = pd.to_datetime(fromdate)
-        cashflow_dataset = cashflow_dataset[cashflow_dataset['transaction_date'] >= fromdate_dt]
+        cashflow_dataset = cashflow_dataset[cashflow_dataset['date_key'] >= epoch_day(pd.to_datetime(fromdate))]
     if todate is not None:
-        todate_dt = pd.to_datetime(todate)
-        cashflow_dataset = cashflow_dataset[cashflow_dataset['transaction_date'] <= todate_dt]
+        cashflow_dataset = cashflow_dataset[cashflow_dataset['date_key'] <= epoch_day(pd.to_datetime(todate))]
     if wallet_filter is not None:
         cashflow_dataset = cashflow_dataset[cashflow_dataset['wallet_id'] == wallet_filter]
         selected_wallet = crud.get_wallet_by_id(db, wallet_id=wallet_filter)
@@ -59,22 +87,26 @@ def cashflow_plot(db, assets_transactions_df, wallets_df, fromdate, todate, wall
 
     # Calculate inflow and outflow
     inflow = cashflow_dataset[cashflow_dataset['transaction_type_id'] != 1] \
-        .groupby('transaction_date', as_index=False)['amount'].sum() \
+        .groupby('date_key', as_index=False)['amount'].sum() \
         .rename(columns={'amount': 'inflow'})
     
     outflow = cashflow_dataset[cashflow_dataset['transaction_type_id'] == 1] \
-        .groupby('transaction_date', as_index=False)['amount'].sum() \
+        .groupby('date_key', as_index=False)['amount'].sum() \
         .rename(columns={'amount': 'outflow'})
 
     # Merge inflow and outflow
-    cashflow_dataset = pd.merge(left=inflow, right=outflow, on='transaction_date', how='outer').fillna({'inflow': 0, 'outflow': 0})
+    cashflow_dataset = pd.merge(left=inflow, right=outflow, on='date_key', how='outer').fillna({'inflow': 0, 'outflow': 0})\
+        .astype({'inflow': 'int64', 'outflow': 'int64'})
 
     # Calculate net amount and cumulative sum
     inital_balance = wallets_df['initial_balance'].sum() if wallet_filter is None else selected_wallet.initial_balance
     cashflow_dataset['amount'] = cashflow_dataset['inflow'] - cashflow_dataset['outflow']
-    cashflow_dataset = cashflow_dataset.sort_values(by='transaction_date').reset_index()
+    cashflow_dataset = cashflow_dataset.sort_values(by='date_key').reset_index()
+    cashflow_dataset['transaction_date'] = pd.to_datetime(cashflow_dataset['date_key'], unit='D')
     cashflow_dataset.loc[0, 'amount'] = cashflow_dataset.loc[0, 'amount'] + inital_balance
-    cashflow_dataset['cumsum'] = cashflow_dataset['amount'].cumsum()
+    cashflow_dataset['cumsum'] = from_minor_units(cashflow_dataset['amount'].cumsum(), currency)
+    if not full_resolution:
+        cashflow_dataset = cashflow_dataset.iloc[lttb(cashflow_dataset['date_key'], cashflow_dataset['cumsum'], CHART_POINTS)]
 
     # Create plot
     template = 'plotly_dark' if darkmode=='dark' else 'plotly_white'
@@ -115,15 +147,15 @@ def cashflow_plot(db, assets_transactions_df, wallets_df, fromdate, todate, wall
         )
     
     # Convert the figure to HTML
-    cashflow_chart_html = pio.to_html(fig, full_html=False)
+    cashflow_chart_html = pio.to_html(fig, full_html=False, include_plotlyjs=False)
 
     return cashflow_chart_html, selected_wallet
 
-def assets_dashboard(request, db, templates, fromdate=None, todate=None, wallet_filter=None):
+# The *_data functions only depend on their arguments, so concurrent identical requests
+# can share one computation (see app/concurrency.py); templates get the request added later
+def assets_dashboard_data(db, user_id, darkmode, fromdate=None, todate=None, wallet_filter=None, full_resolution=False):
     global colors_map
-    
-    darkmode = request.cookies.get("darkmode")
-    user_id = request.cookies.get("user_id")
+
     user = crud.get_user(db, user_id=user_id)
     username = user.fullname
     currency = user.currency
@@ -135,6 +167,8 @@ def assets_dashboard(request, db, templates, fromdate=None, todate=None, wallet_
     all_options = {'wallets': [{'id': wallet.id, 'name': wallet.wallet_name} for wallet in assets_wallets],
                     'debts': [{'id': debt.id, 'name': debt.wallet_name} for debt in debt_wallets]}
     transactions = crud.get_transactions(db, user_id=user_id)
+    # Archived months as one row per wallet, category, type and month: every figure below only adds amounts up
+    summaries = archive.get_summaries(db, user_id=user_id)
 
     ### Calculate initial balances
     inital_balance = wallets_df['initial_balance'].sum()
@@ -144,7 +178,7 @@ def assets_dashboard(request, db, templates, fromdate=None, todate=None, wallet_
         initial_receivables = wallets_df[(wallets_df['liability'] == 1) & (wallets_df['initial_balance'] > 0)]['initial_balance'].sum()
 
     # Handle no transactions case
-    if len(transactions) == 0:
+    if len(transactions) == 0 and len(summaries) == 0:
         scorecard = {"available_assets": inital_balance,
                     "receivables": initial_receivables,
                     "payables": abs(initial_payables)}
@@ -154,24 +188,16 @@ def assets_dashboard(request, db, templates, fromdate=None, todate=None, wallet_
             debt_wallets_df['debts'] = debt_wallets_df['initial_balance']
         
         ### Plot Assets pie chart
-        pie_chart_html = assets_pie_plot(wallets_df, darkmode)
-        print({'request': request,
-            'username': username,
-            'scorecard': scorecard,
-            'wallets': wallets_df.to_dict('records'),
-            'debt_wallets': debt_wallets_df.to_dict('records') if debt_wallets_df is not None else None,
-            'all_options': all_options,
-            'currency': currency})
-        return templates.TemplateResponse("assets_dashboard.html", {'request': request,
-                                                                'username': username,
-                                                                'scorecard': scorecard,
-                                                                'wallets': wallets_df.to_dict('records'),
-                                                                'debt_wallets': debt_wallets_df.to_dict('records') if debt_wallets_df is not None else None,
-                                                                'assets_pie': pie_chart_html,
-                                                                'all_options': all_options,
-                                                                'currency': currency})
-
-    transactions_df = pd.DataFrame([transaction.__dict__ for transaction in transactions])
+        pie_chart_html = assets_pie_plot(wallets_df, darkmode, currency)
+        return {'username': username,
+                'scorecard': scorecard,
+                'wallets': wallets_df.to_dict('records'),
+                'debt_wallets': debt_wallets_df.to_dict('records') if debt_wallets_df is not None else None,
+                'assets_pie': pie_chart_html,
+                'all_options': all_options,
+                'currency': currency}
+
+    transactions_df = pd.DataFrame([transaction.__dict__ for transaction in transactions] + summaries)
     assets_transactions_df = transactions_df[transactions_df['wallet_id'].isin([wallet.id for wallet in assets_wallets])]
     debts_transactions_df = transactions_df[transactions_df['wallet_id'].isin([debt.id for debt in debt_wallets])]
     
@@ -202,36 +228,35 @@ def assets_dashboard(request, db, templates, fromdate=None, todate=None, wallet_
     wallets_df = wallets_df.merge(positive_transactions, left_on='id', right_on='wallet_id', how='outer')
     wallets_df = wallets_df.merge(negative_transactions, left_on='id', right_on='wallet_id', how='outer')
 
-    wallets_df = wallets_df.fillna({'positve': 0, 'negative': 0})
+    wallets_df = wallets_df.fillna({'positve': 0, 'negative': 0}).astype({'positve': 'int64', 'negative': 'int64'})
     wallets_df['current_balance'] = wallets_df['initial_balance'] + wallets_df['positve'] - wallets_df['negative']
     wallets_df['assets_distribution'] = np.where(wallets_df['current_balance'] > 0, wallets_df['current_balance'] / wallets_df[wallets_df['current_balance'] > 0]['current_balance'].sum(), 0)
  
     wallets_df = wallets_df.sort_values(by='current_balance', ascending=False)
 
     ### Plot Assets pie chart
-    pie_chart_html = assets_pie_plot(wallets_df, darkmode)
+    pie_chart_html = assets_pie_plot(wallets_df, darkmode, currency)
 
     ### Plot Cashflow
-    cashflow_chart_html, selected_wallet = cashflow_plot(db, assets_transactions_df, wallets_df, fromdate, todate, wallet_filter, darkmode)
-
-    return templates.TemplateResponse("assets_dashboard.html", {'request': request,
-                                                                'username': username,
-                                                                'scorecard': scorecard,
-                                                                'wallets': wallets_df.to_dict('records'),
-                                                                'selected_wallet': selected_wallet,
-                                                                'fromdate': fromdate,
-                                                                'todate': todate,
-                                                                'debt_wallets': debt_wallets_df.to_dict('records') if debt_wallets_df is not None else None,
-                                                                'assets_pie': pie_chart_html,
-                                                                'cashflow_chart': cashflow_chart_html,
-                                                                'all_options': all_options,
-                                                                'currency': currency})
+    cashflow_chart_html, selected_wallet = cashflow_plot(db, assets_transactions_df, wallets_df, fromdate, todate, wallet_filter, darkmode, currency, full_resolution)
+
+    return {'username': username,
+            'scorecard': scorecard,
+            'wallets': wallets_df.to_dict('records'),
+            'selected_wallet': selected_wallet,
+            'fromdate': fromdate,
+            'todate': todate,
+            'debt_wallets': debt_wallets_df.to_dict('records') if debt_wallets_df is not None else None,
+            'assets_pie': pie_chart_html,
+            'cashflow_chart': cashflow_chart_html,
+            'all_options': all_options,
+            'currency': currency}
 
 ### Income Dashboard
-def ie_bar_chart(df, darkmode, type):
+def ie_bar_chart(df, darkmode, type, currency):
     template = 'plotly_dark' if darkmode=='dark' else 'plotly_white'
     fig = px.bar(
-            df,
+            df.assign(amount=from_minor_units(df['amount'], currency)),
             x='amount',
             y='category_name',
             template=template,
@@ -269,12 +294,13 @@ def ie_bar_chart(df, darkmode, type):
         )
 
     # Convert the figure to HTML
-    chart_html = pio.to_html(fig, full_html=False)
+    chart_html = pio.to_html(fig, full_html=False, include_plotlyjs=False)
 
     return chart_html
 
-def earnings_trend_chart(df, darkmode):
+def earnings_trend_chart(df, darkmode, currency):
     template = 'plotly_dark' if darkmode == 'dark' else 'plotly_white'
+    df = df.assign(**{column: from_minor_units(df[column], currency) for column in ['income', 'expense', 'earnings']})
     fig = go.Figure()
 
     # Add bar trace for earnings
@@ -343,23 +369,30 @@ def earnings_trend_chart(df, darkmode):
         )
 
     # Convert the figure to HTML
-    earnings_trend_html = pio.to_html(fig, full_html=False)
+    earnings_trend_html = pio.to_html(fig, full_html=False, include_plotlyjs=False)
 
     return earnings_trend_html
 
-def income_dashboard(request, db, templates, fromdate=None, todate=None, wallet_filter=None):
-    user_id = request.cookies.get("user_id")
+def income_dashboard_data(db, user_id, darkmode, fromdate=None, todate=None, wallet_filter=None, full_resolution=False, trend_months=6):
     user = crud.get_user(db, user_id=user_id)
     username = user.fullname
     currency = user.currency
-    darkmode = request.cookies.get("darkmode")
     categories = crud.get_categories(db, user_id=user_id)
     categories_df = pd.DataFrame([category.__dict__ for category in categories])
     wallets = crud.get_wallets(db, user_id=user_id)
     wallets_df = pd.DataFrame([wallet.__dict__ for wallet in wallets])
     transactions_all = crud.get_transactions(db, user_id=user_id, wallet_id=wallet_filter)    
     selected_wallet = wallets_df[wallets_df['id']==wallet_filter].to_dict(orient='records')[0] if wallet_filter else None
-    transactions_all_df = pd.DataFrame([transaction.__dict__ for transaction in transactions_all])
+    # Without recent transactions the default window falls on the latest archived one
+    latest = transactions_all[:1] or crud.get_transactions(db, user_id=user_id, wallet_id=wallet_filter, limit=1, offset=0, archived=True)
+
+    if fromdate is None and todate is None and latest:
+        # Set last transaction date as todate and the start of the month as fromdate
+        todate = latest[0].transaction_date
+        fromdate = todate.replace(day=1)
+    # Archived rows are only read for the window, which is usually recent enough to have none
+    archived = crud.get_transactions(db, user_id=user_id, wallet_id=wallet_filter, transaction_date_from=fromdate, transaction_date_to=todate, archived=True) if latest else []
+    transactions_all_df = pd.DataFrame([transaction.__dict__ for transaction in transactions_all + archived])
     
     # Handle no transaction case
     if transactions_all_df.empty:
@@ -368,78 +401,68 @@ def income_dashboard(request, db, templates, fromdate=None, todate=None, wallet_
                  "earnings": 0,
                  "incomeSparkline": [],
                  "expenseSparkline": []}
-        return templates.TemplateResponse("income_dashboard.html", {'request': request,
-                                                                'username': username,
-                                                                'scorecard': scorecard,
-                                                                'wallets': wallets_df[wallets_df['liability'] == 0].to_dict(orient='records'),
-                                                                'currency': currency})
-
-    if fromdate is None and todate is None:
-        # Set last transaction date as todate and the start of the month as fromdate
-        todate = transactions_all[0].transaction_date
-        fromdate = todate.replace(day=1)
-        todate_str = todate.strftime("%Y-%m-%d")
-        fromdate_str = fromdate.strftime("%Y-%m-%d")
-    else:
-        fromdate_str = fromdate.strftime("%Y-%m-%d")
-        todate_str = todate.strftime("%Y-%m-%d")
-
-    transactions_df = transactions_all_df[transactions_all_df['transaction_date'].between(fromdate, todate)]
+        return {'username': username,
+                'scorecard': scorecard,
+                'wallets': wallets_df[wallets_df['liability'] == 0].to_dict(orient='records'),
+                'currency': currency}
+
+    fromdate_str = fromdate.strftime("%Y-%m-%d")
+    todate_str = todate.strftime("%Y-%m-%d")
+
+    from_key, to_key = epoch_day(fromdate), epoch_day(todate)
+    # Numeric even when every row in it is a transfer without a category, so it can be merged on
+    transactions_all_df['category_id'] = transactions_all_df['category_id'].astype('float64')
+    transactions_df = transactions_all_df[transactions_all_df['date_key'].between(from_key, to_key)]
     income_df = transactions_df[transactions_df['transaction_type_id'] == 2]
     expense_df = transactions_df[transactions_df['transaction_type_id'] == 1]
 
     ### Calculate scorecard values
-    def date_fill(df, mindate=fromdate, maxdate=todate):
-        for date in pd.date_range(start=mindate, end=maxdate):
-            if date not in df['transaction_date'].values:
-                df.loc[len(df.index)] = [date, 0]
-        return df
-    
     income = income_df['amount'].sum()
     expense = expense_df['amount'].sum()
     earnings = income - expense
-    income_by_date = income_df.groupby('transaction_date', as_index=False)['amount'].sum()\
-                            .sort_values('transaction_date')
-    income_by_date = date_fill(income_by_date).rename(columns={'amount': 'income'})
 
-    expense_by_date = expense_df.groupby('transaction_date', as_index=False)['amount'].sum()\
-                            .sort_values('transaction_date')
-    expense_by_date = date_fill(expense_by_date).rename(columns={'amount': 'expense'})
-
-    income_statement = pd.merge(left=income_by_date, right=expense_by_date, on='transaction_date', how='outer')\
-        .fillna({'income': 0, 'expense': 0})
+    # Daily totals for every day of the window, days without transactions filled with 0
+    days = pd.RangeIndex(from_key, to_key + 1, name='date_key')
+    income_statement = pd.DataFrame({'income': income_df.groupby('date_key')['amount'].sum().reindex(days, fill_value=0),
+                                     'expense': expense_df.groupby('date_key')['amount'].sum().reindex(days, fill_value=0)})
     income_statement['income_cumsum'] = income_statement['income'].cumsum()
     income_statement['expense_cumsum'] = income_statement['expense'].cumsum()
+    income_sparkline = from_minor_units(income_statement['income_cumsum'], currency)
+    expense_sparkline = from_minor_units(income_statement['expense_cumsum'], currency)
+    if not full_resolution:
+        income_sparkline = income_sparkline.iloc[lttb(np.arange(len(income_sparkline)), income_sparkline, SPARKLINE_POINTS)]
+        expense_sparkline = expense_sparkline.iloc[lttb(np.arange(len(expense_sparkline)), expense_sparkline, SPARKLINE_POINTS)]
 
     scorecard = {"income": income,
                  "expense": expense,
                  "earnings": earnings,
-                 "incomeSparkline": income_statement['income_cumsum'].tolist(),
-                 "expenseSparkline": income_statement['expense_cumsum'].tolist()}
+                 "incomeSparkline": income_sparkline.tolist(),
+                 "expenseSparkline": expense_sparkline.tolist()}
     
     ### Plot Income chart    
     income_by_category = income_df.groupby('category_id', as_index=False)['amount'].sum().sort_values('amount')
     income_by_category = income_by_category.merge(categories_df, left_on='category_id', right_on='id', how='left')
     income_chart_data = income_by_category[['category_name', 'amount']]
-    income_chart_html = ie_bar_chart(income_chart_data, darkmode, 'income')
+    income_chart_html = ie_bar_chart(income_chart_data, darkmode, 'income', currency)
 
     ### Plot Expense chart
     expense_by_category = expense_df.groupby('category_id', as_index=False)['amount'].sum().sort_values('amount')
     expense_by_category = expense_by_category.merge(categories_df, left_on='category_id', right_on='id', how='left')
     expense_chart_data = expense_by_category[['category_name', 'amount']]
-    expense_chart_html = ie_bar_chart(expense_chart_data, darkmode, 'expense')
+    expense_chart_html = ie_bar_chart(expense_chart_data, darkmode, 'expense', currency)
     
     ### Plot Cashflow chart
-    transactions_6months = transactions_all_df[transactions_all_df['transaction_date'].between(fromdate - relativedelta(months=6), todate)]
-    transactions_6months['yearmonth'] = transactions_6months['transaction_date'].dt.strftime('%Y%m')
-    income_6months = transactions_6months[transactions_6months['transaction_type_id'] == 2]
-    expense_6months = transactions_6months[transactions_6months['transaction_type_id'] == 1]
-    income_by_month = income_6months.groupby('yearmonth', as_index=False)['amount'].sum().rename(columns={'amount': 'income'})
-    expense_by_month = expense_6months.groupby('yearmonth', as_index=False)['amount'].sum().rename(columns={'amount': 'expense'})
-    earnings_by_month = pd.merge(left=income_by_month, right=expense_by_month, on='yearmonth', how='outer').fillna({'income': 0, 'expense': 0})
+    # Monthly income and expense over the window plus trend_months before it
+    trend_periods = month_periods(fromdate - relativedelta(months=trend_months), todate)
+    trend = pd.DataFrame(crud.compare_periods(db, user_id=user_id, periods=trend_periods, group_by=('transaction_type_id',), wallet_id=wallet_filter),
+                         columns=['label', 'transaction_type_id', 'amount', 'count'])
+    earnings_by_month = trend.pivot_table(index='label', columns='transaction_type_id', values='amount', aggfunc='sum', fill_value=0)\
+        .reindex(columns=[2, 1], fill_value=0).set_axis(['income', 'expense'], axis=1)\
+        .rename_axis('month_key').reset_index().astype({'income': 'int64', 'expense': 'int64'}).sort_values('month_key')
     earnings_by_month['earnings'] = earnings_by_month['income'] - earnings_by_month['expense']
+    earnings_by_month['yearmonth'] = earnings_by_month['month_key'].astype(str)
     earnings_chart_data = earnings_by_month[['yearmonth', 'income', 'expense', 'earnings']]
-    earnings_trend_html = earnings_trend_chart(earnings_chart_data, darkmode)
+    earnings_trend_html = earnings_trend_chart(earnings_chart_data, darkmode, currency)
 
     ### Cashflow table
     transactions_df = pd.merge(transactions_df, wallets_df[['id', 'wallet_name', 'liability']], left_on='wallet_id', right_on='id', how='left')
@@ -480,16 +503,19 @@ def income_dashboard(request, db, templates, fromdate=None, todate=None, wallet_
                     'total': cashoutflow_by_category['amount'].sum()} if len(cashoutflow_by_category) > 0 else None
 
     
-    return templates.TemplateResponse("income_dashboard.html", {'request': request,
-                                                                'username': username,
-                                                                'fromdate': fromdate_str,
-                                                                'todate': todate_str,
-                                                                'selected_wallet': selected_wallet,
-                                                                'scorecard': scorecard,
-                                                                'wallets': wallets_df[wallets_df['liability'] == 0].to_dict(orient='records'),
-                                                                'income_chart': income_chart_html,
-                                                                'expense_chart': expense_chart_html,
-                                                                'earnings_chart': earnings_trend_html,
-                                                                'cash_inflow': cash_inflow,
-                                                                'cash_outflow': cash_outflow,
-                                                                'currency': currency})
\ No newline at end of file
+    return {'username': username,
+            'fromdate': fromdate_str,
+            'todate': todate_str,
+            'selected_wallet': selected_wallet,
+            'scorecard': scorecard,
+            'wallets': wallets_df[wallets_df['liability'] == 0].to_dict(orient='records'),
+            'income_chart': income_chart_html,
+            'expense_chart': expense_chart_html,
+            'earnings_chart': earnings_trend_html,
+            'cash_inflow': cash_inflow,
+            'cash_outflow': cash_outflow,
+            'budgets': crud.get_budget_status(db, user_id=user_id, month=todate),
+            # Found over the whole history (cached per data version), shown for the selected window
+            'anomalies': anomalies.in_window(anomalies.get_anomalies(db, user_id), from_key, to_key,
+                                             {category.id: category.category_name for category in categories}),
+            'currency': currency}
\ No newline at end of file
@@ -0,0 +1,225 @@
+import os
+import re
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from unicodedata import normalize as unicode_normalize
+from sqlalchemy import text
+
+# Auto-categorization from user rules (category_rules). A user's rules are compiled into one matcher:
+# - the keywords of every rule form a single regular expression built from a trie of them, so one
+#   scan of a description finds every keyword in it, however many rules there are
+# - the patterns are joined into one alternation and tried once; a rule's own pattern only runs
+#   when that hits, or when the rule also has keywords and they matched
+# - amount range, wallet and transaction type are then checked on the few rules left, in priority order
+# Descriptions, keywords and patterns are compared ignoring case and accents ("Phở" matches "pho").
+# Matchers are cached per process and rebuilt when the user's rules change.
+
+Rule = namedtuple("Rule", "id category_id transaction_type_id pattern min_amount max_amount wallet_id")
+
+_ACCENTS = re.compile("[\u0300-\u036f]")
+# Patterns that refer to their own groups can not be joined with others
+_GROUP_REFERENCE = re.compile(r"\\[1-9]|\(\?P[=<]")
+# Patterns are user input run on every description: they are kept short, and only the start of a
+# long description is matched
+MAX_PATTERN_LENGTH = 200
+MAX_DESCRIPTION_LENGTH = 500
+_QUANTIFIER = re.compile(r"[*+?]|\{\d*,?\d*\}")
+
+def strip_accents(value: str) -> str:
+    return _ACCENTS.sub('', unicode_normalize('NFD', value)).replace('đ', 'd').replace('Đ', 'D')
+
+def normalize(value) -> str:
+    value = (value or '').lower()
+    if not value.isascii():
+        value = strip_accents(value)
+    return ' '.join(value.split())
+
+def split_keywords(keywords) -> list:
+    return [keyword for keyword in (normalize(part) for part in (keywords or '').split(',')) if keyword]
+
+def _trie_pattern(words) -> str:
+    # "grab", "grab food", "gas" -> g(?:as|rab(?: food)?): one branch per shared prefix, and
+    # greedy, so the longest keyword at a position is the one captured
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return _node_pattern(trie)
+
+def _node_pattern(node) -> str:
+    branches = [re.escape(char) + _node_pattern(child) for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+    body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    if '' in node:
+        return (body + '?') if len(branches) == 1 and len(branches[0]) == 1 else '(?:' + body + ')?'
+    return body
+
+def _nested_quantifier(pattern: str) -> bool:
+    # A repeated group that itself repeats, like (a+)+ or (\w+\s?)*: such patterns can take
+    # exponential time on a description that almost matches
+    groups = [False]
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == '\\':
+            index += 2
+            continue
+        if char == '[':
+            # Skip the character class; a ] right after [ or [^ is part of it
+            index += 2 if pattern[index + 1:index + 2] == '^' else 1
+            index += 1 if pattern[index:index + 1] == ']' else 0
+            while index < len(pattern) and pattern[index] != ']':
+                index += 2 if pattern[index] == '\\' else 1
+        elif char == '(':
+            groups.append(False)
+        elif char == ')' and len(groups) > 1:
+            repeats = groups.pop()
+            quantifier = _QUANTIFIER.match(pattern, index + 1)
+            if quantifier and quantifier.group() != '?':
+                if repeats:
+                    return True
+                groups[-1] = True
+            groups[-1] = groups[-1] or repeats
+        elif _QUANTIFIER.match(pattern, index) and pattern[index - 1:index] not in ('(', ''):
+            groups[-1] = groups[-1] or pattern[index] != '?'
+        index += 1
+    return False
+
+def compile_pattern(pattern: str):
+    # The pattern as the matcher runs it, alone and wrapped to be joined with others; raises re.error
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        raise re.error(f"longer than {MAX_PATTERN_LENGTH} characters")
+    if _nested_quantifier(pattern):
+        raise re.error("a repeated group must not itself contain a repetition")
+    # Not lowercased, which would turn \S into \s: matched ignoring case instead
+    compiled = re.compile(strip_accents(pattern), re.IGNORECASE)
+    try:
+        re.compile(f'(?:{compiled.pattern})', re.IGNORECASE)
+    except re.error:
+        raise re.error("inline flags such as (?i) are not supported, rules already ignore case and accents")
+    return compiled
+
+class Matcher:
+    def __init__(self, rows):
+        # rows: (id, category_id, transaction_type_id, keywords, pattern, min_amount, max_amount, wallet_id),
+        # in priority order
+        self.rules = []
+        by_keyword = {}
+        patterns = []
+        # Rules without keywords: checked for every description, or only when the joined patterns hit
+        self.always = []
+        self.pattern_only = []
+        for rule_id, category_id, transaction_type_id, keywords, pattern, min_amount, max_amount, wallet_id in rows:
+            compiled = None
+            if pattern:
+                try:
+                    compiled = compile_pattern(pattern)
+                except re.error:
+                    # Stored before patterns were checked as they are here: the rule never matches
+                    continue
+                pattern = compiled.pattern
+            index = len(self.rules)
+            self.rules.append(Rule(rule_id, category_id, transaction_type_id, compiled, min_amount, max_amount, wallet_id))
+            keywords = split_keywords(keywords)
+            for keyword in keywords:
+                by_keyword.setdefault(keyword, []).append(index)
+            if keywords:
+                continue
+            if pattern and not _GROUP_REFERENCE.search(pattern):
+                patterns.append(pattern)
+                self.pattern_only.append(index)
+            else:
+                self.always.append(index)
+
+        self.keywords = None
+        if by_keyword:
+            # Captures the longest keyword starting at each word; the shorter keywords it starts
+            # with are found through self.hits
+            self.keywords = re.compile(r"(?<!\w)(?=(" + _trie_pattern(by_keyword) + r")(?!\w))")
+        self.hits = {}
+        for keyword in by_keyword:
+            found = set(by_keyword[keyword])
+            # Keywords it starts with, ending where a word does
+            for end, char in enumerate(keyword):
+                if not re.match(r"\w", char) and keyword[:end] in by_keyword:
+                    found.update(by_keyword[keyword[:end]])
+            self.hits[keyword] = found
+        self.patterns = re.compile('|'.join(f'(?:{pattern})' for pattern in patterns), re.IGNORECASE) if patterns else None
+
+    def match(self, description: str, amount: int = None, wallet_id: int = None, transaction_type_id: int = None):
+        # The first rule in priority order that matches, or None
+        value = normalize((description or '')[:MAX_DESCRIPTION_LENGTH])
+        candidates = set(self.always)
+        if self.keywords is not None:
+            for found in self.keywords.finditer(value):
+                candidates.update(self.hits[found.group(1)])
+        if self.patterns is not None and self.patterns.search(value):
+            candidates.update(self.pattern_only)
+        for index in sorted(candidates):
+            rule = self.rules[index]
+            if transaction_type_id is not None and rule.transaction_type_id != transaction_type_id:
+                continue
+            if rule.wallet_id is not None and rule.wallet_id != wallet_id:
+                continue
+            if rule.min_amount is not None and (amount is None or amount < rule.min_amount):
+                continue
+            if rule.max_amount is not None and (amount is None or amount > rule.max_amount):
+                continue
+            if rule.pattern is not None and not rule.pattern.search(value):
+                continue
+            return rule
+        return None
+
+    def categorize(self, rows):
+        # rows: dicts with description and optionally amount, wallet_id and transaction_type_id.
+        # The category id of each, None where no rule matches.
+        categories = []
+        for row in rows:
+            rule = self.match(row.get('description'), row.get('amount'), row.get('wallet_id'), row.get('transaction_type_id'))
+            categories.append(rule.category_id if rule else None)
+        return categories
+
+### Per-user cache
+_STAMP = text("SELECT count(*), max(id), max(updated_date) FROM category_rules WHERE user_id = :user_id")
+_LOAD = text("""
+    SELECT category_rules.id, category_rules.category_id, categories.transaction_type_id, category_rules.keywords,
+           category_rules.pattern, category_rules.min_amount, category_rules.max_amount, category_rules.wallet_id
+    FROM category_rules JOIN categories ON categories.id = category_rules.category_id
+    WHERE category_rules.user_id = :user_id
+    ORDER BY category_rules.priority, category_rules.id
+""")
+
+class MatcherCache:
+    # LRU of compiled matchers, each kept with the stamp of the rules it was built from. Every
+    # rule change moves the count, the highest id or the latest updated_date.
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, db, user_id) -> Matcher:
+        user_id = int(user_id)
+        stamp = tuple(db.execute(_STAMP, {'user_id': user_id}).one())
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] == stamp:
+                self.entries.move_to_end(user_id)
+                return entry[1]
+        matcher = Matcher(db.execute(_LOAD, {'user_id': user_id}).all())
+        with self.lock:
+            self.entries[user_id] = (stamp, matcher)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return matcher
+
+matcher_cache = MatcherCache(maxsize=int(os.environ.get("FINA_RULE_CACHE_SIZE", 256)))
+
+def get_matcher(db, user_id) -> Matcher:
+    return matcher_cache.get(db, user_id)
+
+def suggest_category(db, user_id, description: str, amount: int = None, wallet_id: int = None, transaction_type_id: int = None):
+    return get_matcher(db, user_id).match(description, amount, wallet_id, transaction_type_id)
@@ -7,7 +7,7 @@ class WalletBase(BaseModel):
     wallet_name: str
     description: str
     liability: int
-    initial_balance: float
+    initial_balance: int
 
 class Wallet(WalletBase):
     id: int
@@ -39,7 +39,7 @@ class Category(CategoryBase):
 
 ### transactions table
 class TransactionBase(BaseModel):
-    amount: float
+    amount: int
     description: str
     transaction_date: datetime
     created_date: datetime
@@ -0,0 +1,62 @@
+import re
+from sqlalchemy import text, Integer, Float
+
+# Full-text index over transaction descriptions, category names and wallet names.
+# The FTS5 table is created by app/migrations.py and keyed by transactions.id (rowid). Each row
+# also holds an owner token ("u3" for user 3), matched with the words searched so the MATCH only
+# returns the rows of one user.
+FTS_TABLE = "transactions_fts"
+
+_INDEX_SELECT = f"""
+    INSERT INTO {FTS_TABLE} (rowid, description, category_name, wallet_name, owner)
+    SELECT transactions.id,
+           coalesce(transactions.description, ''),
+           coalesce(categories.category_name, ''),
+           coalesce(wallets.wallet_name, ''),
+           'u' || transactions.user_id
+    FROM transactions
+    LEFT JOIN categories ON categories.id = transactions.category_id
+    LEFT JOIN wallets ON wallets.id = transactions.wallet_id
+"""
+
+def reindex_where(db, where: str, params: dict):
+    unindex_where(db, where, params)
+    db.execute(text(_INDEX_SELECT + f" WHERE {where}"), params)
+
+def index_transaction(db, transaction_id: int):
+    db.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), {'id': transaction_id})
+    db.execute(text(_INDEX_SELECT + " WHERE transactions.id = :id"), {'id': transaction_id})
+
+def unindex_transaction(db, transaction_id: int):
+    db.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), {'id': transaction_id})
+
+def reindex_wallet(db, wallet_id: int):
+    reindex_where(db, "transactions.wallet_id = :wallet_id", {'wallet_id': wallet_id})
+
+def reindex_category(db, category_id: int):
+    reindex_where(db, "transactions.category_id = :category_id", {'category_id': category_id})
+
+def unindex_where(db, where: str, params: dict):
+    db.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid IN (SELECT id FROM transactions WHERE {where})"), params)
+
+def rebuild_index(connection):
+    connection.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    connection.execute(text(_INDEX_SELECT))
+
+def match_expression(search: str):
+    # Every word must match as a prefix ("gra mar" finds "Grab ride in March")
+    terms = re.findall(r"\w+", search or "")
+    if not terms:
+        return None
+    return ' '.join('"' + term + '"*' for term in terms)
+
+def search_subquery(search: str, user_id: int):
+    # The user's matching transaction ids with their bm25 rank (lower is better). The words are
+    # matched in the text columns only, the owner token in its own column.
+    match = match_expression(search)
+    if match is None:
+        return None
+    return text(f"SELECT rowid AS id, rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match")\
+        .bindparams(match=f'owner : u{int(user_id)} AND {{description category_name wallet_name}} : ({match})')\
+        .columns(id=Integer, rank=Float)\
+        .subquery('search')
@@ -0,0 +1,118 @@
+import argparse
+import os
+from sqlalchemy import delete, event
+from sqlalchemy.dialects.sqlite import insert
+
+import app.models as models
+from app.database import SHARDS, SHARD_DIRECTORY, SessionLocal, engine, engine_for, shard_engines, shard_path, sqlite_engine
+from app.migrations import run_migrations
+from app.archive import reserve_archived_ids
+from app.search import rebuild_index
+from app.budgets import rebuild_counters
+
+# Sharded storage (FINA_SHARDS, see app/database.py). The directory database is the source of
+# truth for users; every shard holds the full schema plus copies of its users' rows, so foreign
+# keys and ON DELETE CASCADE keep working inside a shard. Run as a module to split an existing
+# single database:
+#
+#   python -m app.sharding --source finance_app.db --output shards --shards 4
+#   FINA_DATABASE_URL=sqlite:///shards/directory.db FINA_SHARDS=4 FINA_SHARD_DIRECTORY=shards uvicorn main:app
+users = models.User.__table__
+
+# Lookup tables copied into every shard
+REFERENCE_TABLES = ["transaction_types"]
+# Rebuilt from the copied rows instead of copied
+DERIVED_TABLES = ["category_spend"]
+
+def init_storage():
+    # Schema and migrations for the main database and, when sharded, for every shard
+    models.Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    if not SHARDS:
+        return
+    os.makedirs(SHARD_DIRECTORY, exist_ok=True)
+    for shard in shard_engines:
+        models.Base.metadata.create_all(bind=shard)
+        run_migrations(shard)
+        _copy_reference_data(engine, shard)
+
+def _copy_reference_data(source, target):
+    with source.connect() as connection:
+        rows = {table: [dict(row._mapping) for row in connection.execute(models.Base.metadata.tables[table].select())]
+                for table in REFERENCE_TABLES}
+    with target.begin() as connection:
+        for table, table_rows in rows.items():
+            if table_rows:
+                connection.execute(insert(models.Base.metadata.tables[table]).on_conflict_do_nothing(), table_rows)
+
+@event.listens_for(SessionLocal, "after_flush")
+def mirror_users(session, flush_context):
+    # Users are written to the directory; the copy in their shard follows in the same session
+    if not SHARDS:
+        return
+    for instance in list(session.new) + list(session.dirty):
+        if isinstance(instance, models.User):
+            row = {column.name: getattr(instance, column.key) for column in models.User.__mapper__.columns}
+            session.connection(bind_arguments={'bind': engine_for(instance.id)})\
+                .execute(insert(users).values(row).on_conflict_do_update(index_elements=[users.c.id], set_=row))
+    for instance in session.deleted:
+        if isinstance(instance, models.User):
+            # Cascades to the user's data in the shard
+            session.connection(bind_arguments={'bind': engine_for(instance.id)})\
+                .execute(delete(users).where(users.c.id == instance.id))
+
+### Splitting a single database
+def _copy_rows(connection, table, where: str):
+    source_columns = {row[1] for row in connection.exec_driver_sql(f"PRAGMA source.table_info({table.name})")}
+    columns = ', '.join(column.name for column in table.columns if column.name in source_columns)
+    return connection.exec_driver_sql(f"INSERT INTO main.{table.name} ({columns}) SELECT {columns} FROM source.{table.name} WHERE {where}").rowcount
+
+def _build(target_path: str, source_path: str, tables: dict):
+    # tables: table name -> WHERE clause selecting the rows to copy
+    target = sqlite_engine(f"sqlite:///{target_path}")
+    models.Base.metadata.create_all(bind=target)
+    run_migrations(target)
+    counts = {}
+    with target.connect() as connection:
+        connection.exec_driver_sql("ATTACH DATABASE ? AS source", (source_path,))
+        # Parents before children, so foreign keys hold at every insert
+        for table in models.Base.metadata.sorted_tables:
+            if table.name in tables:
+                counts[table.name] = _copy_rows(connection, table, tables[table.name])
+        rebuild_index(connection)
+        rebuild_counters(connection)
+        reserve_archived_ids(connection)
+        connection.commit()
+        connection.exec_driver_sql("DETACH DATABASE source")
+    target.dispose()
+    return counts
+
+def split(source_path: str, output: str, shards: int):
+    if os.path.exists(output) and os.listdir(output):
+        raise SystemExit(f"{output} is not empty")
+    os.makedirs(output, exist_ok=True)
+    # Bring the source up to the current schema first, as the app does at startup
+    source = sqlite_engine(f"sqlite:///{source_path}")
+    models.Base.metadata.create_all(bind=source)
+    run_migrations(source)
+    source.dispose()
+
+    everything = {table: "1" for table in REFERENCE_TABLES}
+    directory = _build(os.path.join(output, "directory.db"), source_path, {**everything, 'users': "1"})
+    print(f"directory.db: {directory}")
+    for number in range(shards):
+        tables = {**everything, 'users': f"id % {shards} = {number}"}
+        for table in models.Base.metadata.sorted_tables:
+            if 'user_id' in table.c and table.name not in DERIVED_TABLES:
+                tables[table.name] = f"user_id % {shards} = {number}"
+        counts = _build(shard_path(number, output), source_path, tables)
+        print(f"{os.path.basename(shard_path(number, output))}: {counts}")
+    print(f"\nFINA_DATABASE_URL=sqlite:///{os.path.join(output, 'directory.db')} FINA_SHARDS={shards} FINA_SHARD_DIRECTORY={output}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Split a single FINA database into a user directory and per-user shards")
+    parser.add_argument('--source', default='finance_app.db')
+    parser.add_argument('--output', default=SHARD_DIRECTORY)
+    parser.add_argument('--shards', type=int, default=4)
+    args = parser.parse_args()
+    split(args.source, args.output, args.shards)
@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from multiprocessing import get_context
+
+import app.crud as crud
+from app.database import session_for
+from app.datekeys import add_months, from_month_key, month_bounds, month_key, month_periods
+from app.formatting import currencies, format_money, from_minor_units
+
+# Monthly statements (PDF and PNG) rendered off the request path. After a month ends, every
+# active user with transactions in it gets a statement, rendered on a bounded process pool with
+# matplotlib's Agg backend. Workers only compute and write files; the parent records them in the
+# statements table, and downloads read that index and send the file as it is.
+#
+#   python -m app.statements [--month 2024-10] [--workers 2] [--force]
+#
+# FINA_STATEMENTS=1 runs the same job from the app, checking hourly for a finished month that has
+# not been rendered yet. Enable it in one worker only.
+STATEMENT_DIRECTORY = os.environ.get("FINA_STATEMENT_DIRECTORY", "statements")
+STATEMENT_WORKERS = int(os.environ.get("FINA_STATEMENT_WORKERS", 2))
+STATEMENT_FORMATS = ("pdf", "png")
+# Months of income and expense shown before the statement month, as on income_dashboard
+TREND_MONTHS = 6
+
+def last_complete_month(today: date = None) -> int:
+    return add_months(month_key(today or date.today()), -1)
+
+### Aggregation
+def statement_data(db, user_id: int, key: int):
+    # The income_dashboard numbers for one calendar month, from grouped SQL rather than pandas
+    user = crud.get_user(db, user_id=user_id)
+    first, last = month_bounds(key)
+    names = {category.id: category.category_name for category in crud.get_categories(db, user_id=user_id)}
+
+    by_category = {1: [], 2: []}
+    for row in crud.compare_periods(db, user_id=user_id, periods=[(key, first, last)], group_by=('transaction_type_id', 'category_id')):
+        by_category[row['transaction_type_id']].append({'category_name': names.get(row['category_id'], ''),
+                                                        'amount': row['amount'], 'count': row['count']})
+    for rows in by_category.values():
+        rows.sort(key=lambda row: -row['amount'])
+
+    trend_periods = month_periods(from_month_key(add_months(key, -TREND_MONTHS)), last)
+    trend = {period: {'month_key': period, 'income': 0, 'expense': 0} for period, _, _ in trend_periods}
+    for row in crud.compare_periods(db, user_id=user_id, periods=trend_periods, group_by=('transaction_type_id',)):
+        trend[row['label']]['income' if row['transaction_type_id'] == 2 else 'expense'] = row['amount']
+
+    income = sum(row['amount'] for row in by_category[2])
+    expense = sum(row['amount'] for row in by_category[1])
+    return {'fullname': user.fullname,
+            # Accounts created without a currency are shown in the default one, as minor_unit_scale does
+            'currency': user.currency if user.currency in currencies else 'VND',
+            'month_key': key,
+            'income': income,
+            'expense': expense,
+            'earnings': income - expense,
+            'transactions': sum(row['count'] for rows in by_category.values() for row in rows),
+            'income_by_category': by_category[2],
+            'expense_by_category': by_category[1],
+            'trend': list(trend.values()),
+            'budgets': crud.get_budget_status(db, user_id=user_id, month=datetime.combine(first, datetime.min.time()))}
+
+### Rendering
+def _bar_chart(axes, rows, title, color, currency, limit=10):
+    rows = rows[:limit][::-1]
+    axes.barh([row['category_name'] for row in rows], [from_minor_units(row['amount'], currency) for row in rows], color=color)
+    axes.set_title(title, loc='left', fontsize=11)
+    axes.tick_params(labelsize=8)
+    if not rows:
+        axes.text(0.5, 0.5, "No transactions", ha='center', va='center', transform=axes.transAxes, color='grey')
+
+def render(data: dict):
+    # One A4 page: scorecard, income and expense by category, monthly trend and budgets
+    from matplotlib.figure import Figure
+
+    currency = data['currency']
+    money = lambda value: format_money(value, currency)
+    figure = Figure(figsize=(8.27, 11.69))
+    grid = figure.add_gridspec(4, 2, height_ratios=[0.8, 2, 1.6, 1.6], hspace=0.45, wspace=0.45, left=0.2, right=0.95, top=0.95, bottom=0.05)
+
+    header = figure.add_subplot(grid[0, :])
+    header.axis('off')
+    header.text(0, 0.95, f"Statement {from_month_key(data['month_key']).strftime('%B %Y')}", fontsize=16, weight='bold', va='top')
+    header.text(0, 0.6, data['fullname'] or '', fontsize=10, color='grey', va='top')
+    for column, (label, value) in enumerate([('Income', data['income']), ('Expense', data['expense']), ('Earnings', data['earnings'])]):
+        header.text(column / 3, 0.3, label, fontsize=9, color='grey', va='top')
+        header.text(column / 3, 0.1, money(value), fontsize=12, weight='bold', va='top')
+
+    _bar_chart(figure.add_subplot(grid[1, 0]), data['income_by_category'], "Income by category", '#31ce36', currency)
+    _bar_chart(figure.add_subplot(grid[1, 1]), data['expense_by_category'], "Expense by category", '#f25961', currency)
+
+    trend = figure.add_subplot(grid[2, :])
+    labels = [str(row['month_key']) for row in data['trend']]
+    positions = range(len(labels))
+    trend.bar([position - 0.2 for position in positions], [from_minor_units(row['income'], currency) for row in data['trend']], width=0.4, color='#31ce36', label='Income')
+    trend.bar([position + 0.2 for position in positions], [from_minor_units(row['expense'], currency) for row in data['trend']], width=0.4, color='#f25961', label='Expense')
+    trend.set_xticks(list(positions), labels)
+    trend.tick_params(labelsize=8)
+    trend.legend(fontsize=8)
+    trend.set_title("Income and expense by month", loc='left', fontsize=11)
+
+    budgets = figure.add_subplot(grid[3, :])
+    budgets.axis('off')
+    budgets.set_title("Budgets", loc='left', fontsize=11)
+    if data['budgets']:
+        budgets.table(cellText=[[row['category_name'], money(row['budget']), money(row['spent']), money(row['remaining'])] for row in data['budgets'][:12]],
+                      colLabels=['Category', 'Budget', 'Spent', 'Remaining'], loc='upper center', cellLoc='left').set_fontsize(8)
+    else:
+        budgets.text(0, 0.8, "No budgets set", color='grey', fontsize=9)
+    return figure
+
+def statement_path(user_id: int, key: int, extension: str, directory: str = STATEMENT_DIRECTORY) -> str:
+    return os.path.join(directory, str(user_id), f"{key}.{extension}")
+
+def render_statement(user_id: int, key: int, directory: str = STATEMENT_DIRECTORY):
+    # Runs in a pool process: aggregates, renders and writes the files, returns their paths.
+    # None when the user has no transactions in the month.
+    db = session_for(user_id)
+    try:
+        data = statement_data(db, user_id, key)
+    finally:
+        db.close()
+    if not data['transactions']:
+        return None
+    figure = render(data)
+    os.makedirs(os.path.join(directory, str(user_id)), exist_ok=True)
+    paths = {}
+    for extension in STATEMENT_FORMATS:
+        path = statement_path(user_id, key, extension, directory)
+        # Written aside and renamed, so a download never sees a half-written file
+        figure.savefig(path + ".tmp", format=extension, dpi=150)
+        os.replace(path + ".tmp", path)
+        paths[extension] = path
+    return paths
+
+### Scheduling
+def generate(key: int = None, workers: int = STATEMENT_WORKERS, force: bool = False, directory: str = STATEMENT_DIRECTORY):
+    key = key or last_complete_month()
+    db = session_for()
+    try:
+        user_ids = [user.id for user in crud.get_users(db) if user.is_active and user.deleted_date is None]
+    finally:
+        db.close()
+    if not force:
+        user_ids = [user_id for user_id in user_ids if not _has_statement(user_id, key)]
+
+    rendered = 0
+    # spawn: pool processes open their own database connections instead of inheriting ours
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+        futures = {user_id: pool.submit(render_statement, user_id, key, directory) for user_id in user_ids}
+        for user_id, future in futures.items():
+            try:
+                paths = future.result()
+                if paths is None:
+                    continue
+                db = session_for(user_id)
+                try:
+                    crud.save_statement(db, user_id=user_id, month_key=key, pdf_path=paths['pdf'], png_path=paths['png'])
+                finally:
+                    db.close()
+            except Exception as error:
+                # One failing account must not hold up the others; it is retried on the next run
+                print(f"Statement {key} for user {user_id} failed: {error!r}")
+                continue
+            rendered += 1
+    return rendered
+
+def _has_statement(user_id: int, key: int) -> bool:
+    db = session_for(user_id)
+    try:
+        return crud.get_statement(db, user_id=user_id, month_key=key) is not None
+    finally:
+        db.close()
+
+def remove_statements(user_id: int, directory: str = STATEMENT_DIRECTORY):
+    # Files of a deleted user; the index rows go with the user through ON DELETE CASCADE
+    shutil.rmtree(os.path.join(directory, str(int(user_id))), ignore_errors=True)
+
+async def schedule(interval: float = 3600):
+    # Renders the last complete month once per process, then waits for the next one to end
+    done = None
+    while True:
+        key = last_complete_month()
+        if key != done:
+            try:
+                await asyncio.to_thread(generate, key)
+                done = key
+            except Exception as error:
+                # Tried again after the next interval instead of ending the task
+                print(f"Statements {key} failed: {error!r}")
+        await asyncio.sleep(interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render monthly statements for every user")
+    parser.add_argument('--month', help='YYYY-MM, default the last complete month')
+    parser.add_argument('--workers', type=int, default=STATEMENT_WORKERS)
+    parser.add_argument('--force', action='store_true', help='render again statements that exist')
+    args = parser.parse_args()
+    key = month_key(datetime.strptime(args.month, '%Y-%m')) if args.month else None
+    started = time.perf_counter()
+    rendered = generate(key, workers=args.workers, force=args.force)
+    print(f"{rendered} statements rendered in {time.perf_counter() - started:.1f}s")
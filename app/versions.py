@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from threading import Lock
+from sqlalchemy import event, text
+
+from app.database import SessionLocal, engine_for
+
+# Per-user data version, stored in the data_versions table and bumped in the same transaction
+# as every write, so all worker processes agree on it. Caches key their entries on it: an entry
+# computed before the user's latest change is never served.
+#
+# Reading the table on every request is avoided with PRAGMA data_version on a dedicated
+# connection per database (the shard, when sharded), which changes whenever any other connection
+# (in this or another process) commits. Versions read by this process stay valid until it does.
+_lock = Lock()
+_watch = {}
+_seen = {}
+_versions = {}
+
+_BUMP = text("""
+    INSERT INTO data_versions (user_id, version) VALUES (:user_id, 1)
+    ON CONFLICT (user_id) DO UPDATE SET version = version + 1
+""")
+
+def get_version(user_id) -> int:
+    user_id = int(user_id)
+    bind = engine_for(user_id)
+    with _lock:
+        if bind not in _watch:
+            _watch[bind] = bind.raw_connection()
+        cursor = _watch[bind].cursor()
+        try:
+            cursor.execute("PRAGMA data_version")
+            current = cursor.fetchone()[0]
+            if current != _seen.get(bind):
+                for cached in [cached for cached in _versions if engine_for(cached) is bind]:
+                    del _versions[cached]
+                _seen[bind] = current
+            if user_id not in _versions:
+                cursor.execute("SELECT version FROM data_versions WHERE user_id = ?", (user_id,))
+                row = cursor.fetchone()
+                _versions[user_id] = row[0] if row else 0
+            return _versions[user_id]
+        finally:
+            cursor.close()
+
+def mark_changed(db, user_id):
+    # Recorded on the session and written with the transaction when it commits
+    db.info.setdefault('changed_users', set()).add(int(user_id))
+
+@event.listens_for(SessionLocal, "before_commit")
+def record_changes(session):
+    for user_id in session.info.pop('changed_users', ()):
+        session.connection(bind_arguments={'bind': engine_for(user_id)}).execute(_BUMP, {'user_id': user_id})
+
+@event.listens_for(SessionLocal, "after_rollback")
+def discard_changes(session):
+    session.info.pop('changed_users', None)
+
+class VersionedCache:
+    # Small LRU of values computed from one user's data. An entry is only returned while the
+    # user's data version is still the one it was computed at.
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, user_id, key):
+        with self.lock:
+            entry = self.entries.get((user_id, key))
+        if entry is None or entry[0] != get_version(user_id):
+            return None
+        with self.lock:
+            if (user_id, key) in self.entries:
+                self.entries.move_to_end((user_id, key))
+        return entry[1]
+
+    def set(self, user_id, key, value, version: int):
+        # version is the one read before computing value, so a write that raced the computation
+        # leaves the entry already stale
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[(user_id, key)] = (version, value)
+            self.entries.move_to_end((user_id, key))
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
@@ -0,0 +1,106 @@
+# Throughput of the spending anomaly scan (app/anomalies.py). Generates expense histories of
+# growing size, times detect() on the in-memory columns and load() + detect() through SQLite, and
+# a cached lookup. Finally scans a database of --users users the way `python -m app.anomalies` does.
+#
+#   python benchmarks/bench_anomalies.py [--sizes 1000,10000,100000,1000000] [--users 50] [--rows 2000]
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+directory = tempfile.mkdtemp()
+os.environ['FINA_DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+os.environ['FINA_SHARDS'] = '0'
+
+from sqlalchemy import text
+import app.models as models
+import app.anomalies as anomalies
+from app.database import engine, session_for
+from app.datekeys import epoch_day, from_epoch_day
+from app.migrations import run_migrations
+
+CATEGORIES = 12
+
+def history(rows: int, seed: int = 0):
+    # Expenses over ten years in CATEGORIES categories, log-normal amounts with rare spikes
+    random = np.random.default_rng(seed)
+    days = np.sort(random.integers(epoch_day(from_epoch_day(0).replace(year=2015)), epoch_day(from_epoch_day(0).replace(year=2025)), rows))
+    months = np.array([day.year * 100 + day.month for day in map(from_epoch_day, np.unique(days))])[np.searchsorted(np.unique(days), days)]
+    categories = random.integers(1, CATEGORIES + 1, rows)
+    amounts = np.exp(random.normal(11, 0.6, rows)).astype(np.int64) * np.where(random.random(rows) < 0.001, 20, 1)
+    return np.column_stack([np.arange(1, rows + 1), categories, days, months, amounts]).astype(np.int64)
+
+def seed(users: int, rows: int):
+    models.Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO transaction_types (id, transaction_type_name) VALUES (1, 'expense'), (2, 'income')"))
+        for user_id in range(1, users + 1):
+            connection.execute(text("INSERT INTO users (id, username, is_active) VALUES (:id, :name, 1)"), {'id': user_id, 'name': f'user{user_id}'})
+            connection.execute(text("INSERT INTO wallets (user_id, wallet_name, liability) VALUES (:id, 'cash', 0)"), {'id': user_id})
+            wallet_id = connection.execute(text("SELECT max(id) FROM wallets")).scalar()
+            first_category = connection.execute(text("SELECT coalesce(max(id), 0) FROM categories")).scalar() + 1
+            connection.execute(text("INSERT INTO categories (user_id, transaction_type_id, category_name) VALUES (:id, 1, :name)"),
+                               [{'id': user_id, 'name': f'category {n}'} for n in range(CATEGORIES)])
+            connection.execute(text("""INSERT INTO transactions (user_id, wallet_id, category_id, transaction_type_id, amount, transaction_date, date_key, month_key)
+                                       VALUES (:user_id, :wallet_id, :category_id, 1, :amount, :date, :date_key, :month_key)"""),
+                               [{'user_id': user_id, 'wallet_id': wallet_id, 'category_id': first_category + int(category) - 1, 'amount': int(amount),
+                                 'date': from_epoch_day(day), 'date_key': int(day), 'month_key': int(month)}
+                                for _, category, day, month, amount in history(rows, seed=user_id)])
+
+def timed(function, repeat: int = 3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000', help='expenses per history for detect()')
+    parser.add_argument('--users', type=int, default=50, help='users in the database scan')
+    parser.add_argument('--rows', type=int, default=2000, help='expenses per user in the database scan')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+    results = {'detect': [], 'database': {}}
+
+    print(f"{'expenses':>10} {'detect ms':>10} {'expenses/s':>12} {'anomalies':>10}")
+    for size in map(int, args.sizes.split(',')):
+        columns = history(size)
+        seconds, flags = timed(lambda: anomalies.detect(columns))
+        results['detect'].append({'expenses': size, 'seconds': seconds, 'anomalies': len(flags)})
+        print(f"{size:>10} {seconds * 1000:>10.1f} {size / seconds:>12,.0f} {len(flags):>10}")
+
+    seed(args.users, args.rows)
+    db = session_for(1)
+    load_seconds, loaded = timed(lambda: anomalies.load(db, 1))
+    detect_seconds, _ = timed(lambda: anomalies.detect(loaded))
+    anomalies.get_anomalies(db, 1)
+    cached_seconds, _ = timed(lambda: anomalies.get_anomalies(db, 1))
+    db.close()
+    started = time.perf_counter()
+    totals = anomalies.scan_all()
+    scan_seconds = time.perf_counter() - started
+    results['database'] = {'load_seconds': load_seconds, 'detect_seconds': detect_seconds, 'cached_seconds': cached_seconds,
+                           'scan_seconds': scan_seconds, **totals}
+    print(f"\none user of {len(loaded)} expenses: load {load_seconds * 1000:.1f} ms, detect {detect_seconds * 1000:.1f} ms, cached {cached_seconds * 1000:.3f} ms")
+    print(f"batch scan: {totals['users']} users, {totals['transactions']} expenses in {scan_seconds:.2f}s "
+          f"({totals['users'] / scan_seconds:,.0f} users/s, {totals['transactions'] / scan_seconds:,.0f} expenses/s), {totals['anomalies']} anomalies")
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,122 @@
+# Dashboards on accounts with ten years of history before and after archiving all but the last
+# --months of it (app/archive.py). Times the assets and income dashboards and the archival itself,
+# and checks that balances, the scorecards and the earnings trend come out the same.
+#
+#   python benchmarks/bench_archive.py [--sizes 20000,100000,300000] [--months 24]
+import argparse
+import atexit
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+directory = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, directory, ignore_errors=True)
+os.environ['FINA_DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+os.environ['FINA_SHARDS'] = '0'
+
+from sqlalchemy import text
+import app.models as models
+import app.archive as archive
+import app.crud as crud
+import app.reports as reports
+from app.budgets import rebuild_counters
+from app.database import engine, session_for
+from app.datekeys import month_periods
+from app.migrations import run_migrations
+
+TODAY = date(2025, 1, 1)
+YEARS = 10
+
+def seed(user_id: int, size: int):
+    random.seed(size)
+    start = datetime(TODAY.year - YEARS, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (id, username, fullname, is_active, currency) VALUES (:id, :name, :name, 1, 'VND')"), {'id': user_id, 'name': f'user{user_id}'})
+        wallet_ids = [connection.execute(text("INSERT INTO wallets (user_id, wallet_name, liability, initial_balance) VALUES (:id, :name, 0, 1000000)"),
+                                         {'id': user_id, 'name': f'wallet {n}'}).lastrowid for n in range(3)]
+        category_ids = [(connection.execute(text("INSERT INTO categories (user_id, transaction_type_id, category_name) VALUES (:id, :type, :name)"),
+                                            {'id': user_id, 'type': 1 + n % 2, 'name': f'category {n}'}).lastrowid, 1 + n % 2) for n in range(12)]
+        rows = []
+        for _ in range(size):
+            category_id, type_id = random.choice(category_ids)
+            day = start + timedelta(days=random.randrange(YEARS * 365))
+            rows.append({'user_id': user_id, 'wallet_id': random.choice(wallet_ids), 'category_id': category_id, 'type': type_id,
+                         'amount': random.randrange(1, 1000) * 1000, 'date': day, 'date_key': (day - datetime(1970, 1, 1)).days,
+                         'month_key': day.year * 100 + day.month})
+        connection.execute(text("""INSERT INTO transactions (user_id, wallet_id, category_id, transaction_type_id, amount, transaction_date, date_key, month_key)
+                                   VALUES (:user_id, :wallet_id, :category_id, :type, :amount, :date, :date_key, :month_key)"""), rows)
+        rebuild_counters(connection)
+        connection.execute(text("ANALYZE"))
+
+def dashboards(user_id: int):
+    # Seconds for each dashboard and the figures that must not change
+    db = session_for(user_id)
+    try:
+        started = time.perf_counter()
+        assets = reports.assets_dashboard_data(db, user_id, 'light')
+        assets_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        income = reports.income_dashboard_data(db, user_id, 'light')
+        income_seconds = time.perf_counter() - started
+        # The monthly totals behind the earnings trend, over the whole history
+        trend = sorted((row['label'], row['transaction_type_id'], row['amount'], row['count'])
+                       for row in crud.compare_periods(db, user_id, month_periods(date(TODAY.year - YEARS, 1, 1), TODAY), group_by=('transaction_type_id',)))
+    finally:
+        db.close()
+    figures = {'scorecard': {key: int(value) for key, value in assets['scorecard'].items()},
+               'balances': sorted((wallet['id'], int(wallet['current_balance'])) for wallet in assets['wallets']),
+               'income': {key: int(income['scorecard'][key]) for key in ('income', 'expense', 'earnings')},
+               'trend': trend}
+    return assets_seconds, income_seconds, figures
+
+def measure(user_id: int, size: int, months: int):
+    seed(user_id, size)
+    hot_assets, hot_income, expected = dashboards(user_id)
+
+    db = session_for(user_id)
+    try:
+        started = time.perf_counter()
+        moved = archive.archive_user(db, user_id, archive.horizon(months, TODAY))
+        archive_seconds = time.perf_counter() - started
+    finally:
+        db.close()
+    assets_seconds, income_seconds, figures = dashboards(user_id)
+    if figures != expected:
+        raise SystemExit(f"{size} transactions: {[key for key in figures if figures[key] != expected[key]]} changed after archiving")
+    return {'transactions': size, 'archived': moved, 'archive_seconds': round(archive_seconds, 2),
+            'assets_ms_before': round(hot_assets * 1000), 'assets_ms_after': round(assets_seconds * 1000),
+            'income_ms_before': round(hot_income * 1000), 'income_ms_after': round(income_seconds * 1000)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='20000,100000,300000', help='transactions per account')
+    parser.add_argument('--months', type=int, default=archive.ARCHIVE_MONTHS, help='months kept hot')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+    models.Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO transaction_types (id, transaction_type_name) VALUES (1, 'expense'), (2, 'income'), (3, 'transfer'), (4, 'debt')"))
+
+    results = []
+    # Dashboard times in milliseconds on the full history and after archiving
+    print(f"{'transactions':>12} {'archived':>9} {'archive s':>10} {'assets ms':>16} {'income ms':>16}")
+    for user_id, size in enumerate(map(int, args.sizes.split(',')), start=1):
+        result = measure(user_id, size, args.months)
+        results.append(result)
+        print(f"{size:>12} {result['archived']:>9} {result['archive_seconds']:>10} "
+              f"{str(result['assets_ms_before']) + ' -> ' + str(result['assets_ms_after']):>16} "
+              f"{str(result['income_ms_before']) + ' -> ' + str(result['income_ms_after']):>16}")
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == '__main__':
+    main()
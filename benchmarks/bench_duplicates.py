@@ -0,0 +1,104 @@
+# Duplicate detection on accounts of growing size (app/duplicates.py): the check a new
+# transaction goes through before it is inserted, and the scan for duplicate clusters over the
+# whole account. About 1% of each account is written twice, with the description in other case
+# and accents, as a re-imported statement would be.
+#
+#   python benchmarks/bench_duplicates.py [--sizes 10000,100000,1000000] [--checks 1000]
+import argparse
+import atexit
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+directory = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, directory, ignore_errors=True)
+os.environ['FINA_DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+os.environ['FINA_SHARDS'] = '0'
+
+from sqlalchemy import text
+import app.models as models
+import app.duplicates as duplicates
+from app.database import engine, session_for
+from app.migrations import run_migrations
+
+WORDS = ["Grab", "Phở bò", "Cà phê", "Siêu thị", "Tiền điện", "Xăng", "Highlands", "Shopee", "Bún chả", "Điện thoại"]
+
+def seed(user_id: int, size: int):
+    random.seed(size)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (id, username, is_active) VALUES (:id, :name, 1)"), {'id': user_id, 'name': f'user{user_id}'})
+        connection.execute(text("INSERT INTO wallets (user_id, wallet_name, liability) VALUES (:id, :name, 0)"),
+                           [{'id': user_id, 'name': f'wallet {n}'} for n in range(3)])
+        wallet_ids = [row[0] for row in connection.execute(text("SELECT id FROM wallets WHERE user_id = :id"), {'id': user_id})]
+    rows = []
+    for n in range(size):
+        row = {'user_id': user_id, 'wallet_id': random.choice(wallet_ids), 'category_id': None, 'transaction_type_id': 1,
+               'amount': random.randrange(1, 500) * 1000, 'date_key': 18000 + random.randrange(3650),
+               'description': f"{random.choice(WORDS)} {random.randrange(100)}"}
+        rows.append(row)
+        if n % 100 == 0:
+            rows.append({**row, 'description': row['description'].upper()})
+    for row in rows:
+        row['fingerprint'] = duplicates.fingerprint(row['user_id'], row['wallet_id'], row['transaction_type_id'], row['date_key'], row['amount'], row['description'])
+    with engine.begin() as connection:
+        connection.execute(text("""INSERT INTO transactions (user_id, wallet_id, category_id, transaction_type_id, amount, date_key, description, fingerprint)
+                                   VALUES (:user_id, :wallet_id, :category_id, :transaction_type_id, :amount, :date_key, :description, :fingerprint)"""), rows)
+        connection.execute(text("ANALYZE"))
+    return rows
+
+def measure(user_id: int, size: int, checks: int):
+    started = time.perf_counter()
+    rows = seed(user_id, size)
+    seeded = time.perf_counter() - started
+
+    db = session_for(user_id)
+    try:
+        # Half of the checked rows are stored already
+        sample = [random.choice(rows) if n % 2 else {**random.choice(rows), 'amount': 1} for n in range(checks)]
+        started = time.perf_counter()
+        found = sum(duplicates.find_duplicate(db, user_id, row['wallet_id'], row['transaction_type_id'], row['date_key'], row['amount'], row['description']) is not None
+                    for row in sample)
+        check_seconds = (time.perf_counter() - started) / checks
+        started = time.perf_counter()
+        batch = duplicates.find_existing(db, user_id, sample)
+        batch_seconds = (time.perf_counter() - started) / checks
+        started = time.perf_counter()
+        clusters = duplicates.clusters(db, user_id)
+        scan_seconds = time.perf_counter() - started
+    finally:
+        db.close()
+    if sum(match is not None for match in batch) != found:
+        raise SystemExit("single and batch checks disagree")
+    return {'transactions': len(rows), 'seed_seconds': round(seeded, 2), 'found': found, 'checks': checks,
+            'check_us': round(check_seconds * 1e6, 1), 'batch_check_us': round(batch_seconds * 1e6, 1),
+            'clusters': len(clusters), 'scan_ms': round(scan_seconds * 1000, 1)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='transactions per account')
+    parser.add_argument('--checks', type=int, default=1000, help='rows checked one by one and as a batch')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+    models.Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO transaction_types (id, transaction_type_name) VALUES (1, 'expense'), (2, 'income')"))
+
+    results = []
+    print(f"{'transactions':>12} {'check us':>9} {'batch us':>9} {'found':>6} {'clusters':>9} {'scan ms':>8}")
+    for user_id, size in enumerate(map(int, args.sizes.split(',')), start=1):
+        result = measure(user_id, size, args.checks)
+        results.append(result)
+        print(f"{result['transactions']:>12} {result['check_us']:>9} {result['batch_check_us']:>9} {result['found']:>6} {result['clusters']:>9} {result['scan_ms']:>8}")
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == '__main__':
+    main()
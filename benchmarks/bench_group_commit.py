@@ -0,0 +1,105 @@
+# Transaction insert throughput with concurrent writers, committing every row on its own
+# (crud.create_transaction) and through the group-commit queue (app/group_commit.py). Writers are
+# threads of one process, as concurrent requests are in one worker; each posts rows for its own
+# user and waits for every row to be acknowledged before posting the next.
+#
+#   python benchmarks/bench_group_commit.py [--writers 1,4,16,64] [--rows 100] [--batch-rows 64] [--wait-ms 2]
+import argparse
+import atexit
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from threading import Barrier, Thread
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+directory = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, directory, ignore_errors=True)
+os.environ['FINA_DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+os.environ['FINA_SHARDS'] = '0'
+
+from sqlalchemy import func, text
+import app.models as models
+import app.crud as crud
+from app.database import engine, session_for
+from app.sharding import init_storage
+from app.group_commit import GroupCommitQueue
+
+def setup(writers: int):
+    with engine.begin() as connection:
+        models.Base.metadata.create_all(bind=connection)
+        connection.execute(text("INSERT OR IGNORE INTO transaction_types (id, transaction_type_name) VALUES (1, 'expense'), (2, 'income'), (3, 'transfer'), (4, 'debt')"))
+    init_storage()
+    users = []
+    for n in range(writers):
+        name = f"writer{time.monotonic_ns()}_{n}"
+        db = session_for()
+        user = crud.create_user(db, SimpleNamespace(username=name, fullname=name, email=f'{name}@example.com', password='x', currency='VND'))
+        wallet = crud.create_wallet(db, user.id, 'cash')
+        category = crud.create_category(db, user.id, 1, 'food')
+        users.append(dict(user_id=user.id, wallet_id=wallet.id, category_id=category.id))
+        db.close()
+    return users
+
+def row(user, n):
+    return dict(**user, transaction_type_id=1, amount=1000 + n, transaction_date=datetime(2024, 1, 1 + n % 28), description='bench')
+
+def direct_writer(user, rows, start):
+    db = session_for(user['user_id'])
+    start.wait()
+    for n in range(rows):
+        crud.create_transaction(db, **row(user, n))
+    db.close()
+
+def queued_writer(writes, user, rows, start):
+    start.wait()
+    for n in range(rows):
+        writes.submit(**row(user, n)).result()
+
+def measure(mode: str, writers: int, rows: int, batch_rows: int, wait_ms: float):
+    users = setup(writers)
+    before = session_for().query(func.count(models.Transaction.id)).scalar()
+    start = Barrier(writers + 1)
+    if mode == 'direct':
+        threads = [Thread(target=direct_writer, args=(user, rows, start)) for user in users]
+    else:
+        writes = GroupCommitQueue(max_rows=batch_rows, max_wait=wait_ms / 1000)
+        threads = [Thread(target=queued_writer, args=(writes, user, rows, start)) for user in users]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+    written = session_for().query(func.count(models.Transaction.id)).scalar() - before
+    return {'mode': mode, 'writers': writers, 'rows': written, 'seconds': round(elapsed, 3),
+            'rows_per_second': round(written / elapsed, 1)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writers', default='1,4,16,64', help='concurrent writers, one user each')
+    parser.add_argument('--rows', type=int, default=100, help='transactions per writer')
+    parser.add_argument('--batch-rows', type=int, default=64, help='most rows per group commit')
+    parser.add_argument('--wait-ms', type=float, default=2, help='longest a batch waits for more rows')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'mode':<8} {'writers':>8} {'rows':>7} {'seconds':>8} {'rows/s':>9}")
+    for writers in map(int, args.writers.split(',')):
+        for mode in ['direct', 'grouped']:
+            result = measure(mode, writers, args.rows, args.batch_rows, args.wait_ms)
+            results.append(result)
+            print(f"{mode:<8} {writers:>8} {result['rows']:>7} {result['seconds']:>8} {result['rows_per_second']:>9}")
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == '__main__':
+    main()
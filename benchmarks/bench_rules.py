@@ -0,0 +1,112 @@
+# Categorization throughput of app/rules.py against the naive approach it replaces: one regular
+# expression per rule, tried in priority order on every description until one matches. Rules and
+# descriptions are generated from a fixed vocabulary; about half the descriptions match a rule.
+# Both must return the same category for every description.
+#
+#   python benchmarks/bench_rules.py [--rules 10,100,1000] [--descriptions 20000]
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app.rules import Matcher, normalize, split_keywords
+
+WORDS = ["grab", "be", "shopee", "lazada", "tiki", "highlands", "phuc long", "circle k", "winmart", "bach hoa xanh",
+         "pho", "bun bo", "com tam", "banh mi", "tra sua", "xang", "dien", "nuoc", "internet", "netflix"]
+FILLER = ["thanh toan", "chuyen khoan", "don hang", "ngay", "quan 1", "hcm", "ha noi", "the", "vi", "momo", "zalopay"]
+
+def make_rules(count: int):
+    random.seed(count)
+    rows = []
+    for n in range(count):
+        # Made-up merchant keywords, so the rule count grows without every rule sharing the same few words
+        keywords = [f"{random.choice(WORDS)} {n}", f"merchant{n}"]
+        pattern = rf"^ref{n}\s+\d+" if n % 10 == 0 else None
+        min_amount = 100000 if n % 7 == 0 else None
+        rows.append((n + 1, n % 25 + 1, 1, ', '.join(keywords), pattern, min_amount, None, None))
+    return rows
+
+def make_descriptions(count: int, rules: int):
+    random.seed(count + rules)
+    descriptions = []
+    for _ in range(count):
+        words = random.sample(FILLER, 3)
+        if random.random() < 0.5:
+            n = random.randrange(rules)
+            words.insert(1, f"ref{n} {random.randrange(10 ** 6)}" if n % 10 == 0 and random.random() < 0.5 else f"merchant{n}")
+        descriptions.append((' '.join(words).upper(), random.choice([50000, 150000])))
+    return descriptions
+
+def naive(rows):
+    # One compiled expression per rule, tried in order
+    compiled = []
+    for rule_id, category_id, _, keywords, pattern, min_amount, max_amount, wallet_id in rows:
+        keyword = re.compile(r"(?<!\w)(?:" + '|'.join(map(re.escape, split_keywords(keywords))) + r")(?!\w)") if keywords else None
+        compiled.append((category_id, keyword, re.compile(pattern, re.IGNORECASE) if pattern else None, min_amount))
+    def categorize(description, amount):
+        value = normalize(description)
+        for category_id, keyword, pattern, min_amount in compiled:
+            if keyword is not None and not keyword.search(value):
+                continue
+            if pattern is not None and not pattern.search(value):
+                continue
+            if min_amount is not None and amount < min_amount:
+                continue
+            return category_id
+        return None
+    return categorize
+
+def measure(rules: int, descriptions: int):
+    rows = make_rules(rules)
+    sample = make_descriptions(descriptions, rules)
+
+    started = time.perf_counter()
+    matcher = Matcher(rows)
+    build = time.perf_counter() - started
+    started = time.perf_counter()
+    compiled = [rule.category_id if rule else None for rule in (matcher.match(description, amount) for description, amount in sample)]
+    match_seconds = time.perf_counter() - started
+    batch = [{'description': description, 'amount': amount} for description, amount in sample]
+    started = time.perf_counter()
+    categorized = matcher.categorize(batch)
+    categorize_seconds = time.perf_counter() - started
+
+    categorize = naive(rows)
+    started = time.perf_counter()
+    expected = [categorize(description, amount) for description, amount in sample]
+    naive_seconds = time.perf_counter() - started
+
+    if compiled != expected or categorized != expected:
+        raise SystemExit(f"{rules} rules: {sum(a != b for a, b in zip(compiled, expected))} descriptions categorized differently")
+    return {'rules': rules, 'descriptions': descriptions, 'matched': sum(category is not None for category in compiled),
+            'build_ms': round(build * 1000, 2),
+            'naive_per_ms': round(descriptions / naive_seconds / 1000, 1),
+            'match_per_ms': round(descriptions / match_seconds / 1000, 1),
+            'categorize_per_ms': round(descriptions / categorize_seconds / 1000, 1)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rules', default='10,100,1000', help='rule counts to compare')
+    parser.add_argument('--descriptions', type=int, default=20000)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = []
+    # Descriptions per millisecond: naive loop, Matcher.match one at a time, Matcher.categorize for the batch
+    print(f"{'rules':>6} {'matched':>8} {'build ms':>9} {'naive /ms':>10} {'match /ms':>10} {'categorize /ms':>15}")
+    for rules in map(int, args.rules.split(',')):
+        result = measure(rules, args.descriptions)
+        results.append(result)
+        print(f"{rules:>6} {result['matched']:>8} {result['build_ms']:>9} {result['naive_per_ms']:>10} {result['match_per_ms']:>10} {result['categorize_per_ms']:>15}")
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# Write throughput of transaction inserts with concurrent users, on one database and on
+# per-user shards (FINA_SHARDS). Every writer is its own process, as uvicorn workers are, posts
+# rows for its own user through crud.create_transaction and commits each one.
+#
+#   python benchmarks/bench_sharding.py [--shards 0,4] [--writers 1,2,4,8] [--rows 200]
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SETUP = """
+import json, sys
+from types import SimpleNamespace
+from sqlalchemy import text
+import app.models as models
+from app.database import engine, session_for
+from app.sharding import init_storage
+import app.crud as crud
+
+models.Base.metadata.create_all(bind=engine)
+with engine.begin() as connection:
+    connection.execute(text("INSERT OR IGNORE INTO transaction_types (id, transaction_type_name) VALUES (1, 'expense'), (2, 'income'), (3, 'transfer'), (4, 'debt')"))
+init_storage()
+users = []
+for n in range(int(sys.argv[1])):
+    db = session_for()
+    user = crud.create_user(db, SimpleNamespace(username=f'writer{n}', fullname=f'writer {n}', email=f'writer{n}@example.com', password='x', currency='VND'))
+    db.close()
+    db = session_for(user.id)
+    wallet = crud.create_wallet(db, user.id, 'cash')
+    category = crud.create_category(db, user.id, 1, 'food')
+    users.append([user.id, wallet.id, category.id])
+    db.close()
+print(json.dumps(users))
+"""
+
+WRITER = """
+import json, sys, time
+from datetime import datetime
+from sqlalchemy.exc import OperationalError
+from app.database import session_for
+import app.crud as crud
+
+user_id, wallet_id, category_id, rows, start_at = int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]), float(sys.argv[5])
+db = session_for(user_id)
+crud.get_user(db, user_id) # connect before the clock starts
+time.sleep(max(0, start_at - time.time()))
+errors = 0
+for n in range(rows):
+    try:
+        crud.create_transaction(db, user_id, wallet_id, category_id, 1, 1000 + n, datetime(2024, 1, 1 + n % 28), 'bench')
+    except OperationalError:
+        db.rollback()
+        errors += 1
+print(json.dumps({'finished': time.time(), 'errors': errors}))
+"""
+
+def run(code, args, env):
+    return subprocess.Popen([sys.executable, '-c', code, *map(str, args)], cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+def measure(shards: int, writers: int, rows: int):
+    with tempfile.TemporaryDirectory() as directory:
+        env = {**os.environ, 'PYTHONPATH': ROOT,
+               'FINA_DATABASE_URL': f"sqlite:///{os.path.join(directory, 'directory.db' if shards else 'single.db')}",
+               'FINA_SHARDS': str(shards), 'FINA_SHARD_DIRECTORY': directory}
+        setup = run(SETUP, [writers], env)
+        output, error = setup.communicate()
+        if setup.returncode:
+            raise SystemExit(error)
+        users = json.loads(output.strip().splitlines()[-1])
+
+        # All writers start on the same clock tick, after their imports
+        start_at = time.time() + 2 + writers * 0.2
+        processes = [run(WRITER, [*user, rows, start_at], env) for user in users]
+        results = []
+        for process in processes:
+            output, error = process.communicate()
+            if process.returncode:
+                raise SystemExit(error)
+            results.append(json.loads(output.strip().splitlines()[-1]))
+    elapsed = max(result['finished'] for result in results) - start_at
+    errors = sum(result['errors'] for result in results)
+    return {'shards': shards, 'writers': writers, 'rows': writers * rows - errors, 'errors': errors,
+            'seconds': round(elapsed, 3), 'rows_per_second': round((writers * rows - errors) / elapsed, 1)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', default='0,4', help='shard counts to compare, 0 for a single database')
+    parser.add_argument('--writers', default='1,2,4,8', help='concurrent writer processes, one user each')
+    parser.add_argument('--rows', type=int, default=200, help='transactions per writer')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'storage':<12} {'writers':>8} {'rows':>7} {'errors':>7} {'seconds':>8} {'rows/s':>9}")
+    for shards in map(int, args.shards.split(',')):
+        for writers in map(int, args.writers.split(',')):
+            result = measure(shards, writers, args.rows)
+            results.append(result)
+            print(f"{f'{shards} shards' if shards else 'single':<12} {writers:>8} {result['rows']:>7} {result['errors']:>7} {result['seconds']:>8} {result['rows_per_second']:>9}")
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# Measures cold import time and peak memory (RSS) of the app, with and without the report
+# dependencies. Each measurement runs in a fresh interpreter.
+#
+#   python benchmarks/bench_startup.py [--runs 5]
+import argparse
+import json
+import os
+import subprocess
+import sys
+from statistics import median
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+for module in sys.argv[1:]:
+    __import__(module)
+elapsed = time.perf_counter() - start
+# ru_maxrss is in kilobytes on Linux and bytes on macOS
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+rss_mb = rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+print(json.dumps({'seconds': elapsed, 'rss_mb': rss_mb, 'pandas': 'pandas' in sys.modules, 'plotly': 'plotly' in sys.modules}))
+"""
+
+SCENARIOS = {
+    'main': ['main'],
+    'main + reports (prewarmed)': ['main', 'app.reports'],
+    'reports only': ['app.reports'],
+}
+
+def measure(modules):
+    output = subprocess.run([sys.executable, '-c', PROBE, *modules], cwd=ROOT, capture_output=True, text=True, check=True,
+                            env={**os.environ, 'PYTHONPATH': ROOT, 'PYTHONDONTWRITEBYTECODE': '1'})
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    results = {}
+    for name, modules in SCENARIOS.items():
+        runs = [measure(modules) for _ in range(args.runs)]
+        results[name] = {'import_seconds': round(median(run['seconds'] for run in runs), 3),
+                         'rss_mb': round(median(run['rss_mb'] for run in runs), 1),
+                         'loads_pandas': runs[0]['pandas'],
+                         'loads_plotly': runs[0]['plotly']}
+        print(f"{name:<28} {results[name]['import_seconds']:>7.3f}s {results[name]['rss_mb']:>8.1f} MB"
+              f"  pandas={results[name]['loads_pandas']} plotly={results[name]['loads_plotly']}")
+    return results
+
+if __name__ == '__main__':
+    main()
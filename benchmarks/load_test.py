@@ -0,0 +1,218 @@
+# Load generator simulating user sessions: log in, browse /transactions with filters, post
+# transactions and transfers, and open both dashboards. Runs the app in-process on a copy of
+# the database (default) or against a running server with --target.
+#
+#   python benchmarks/load_test.py --users 20 --duration 60
+#   python benchmarks/load_test.py --target http://127.0.0.1:8000 --account demo:123 --output results.json
+#   python benchmarks/load_test.py --mix browse=60,transaction=20,transfer=5,assets=10,income=5
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MIX = {'browse': 50, 'transaction': 15, 'transfer': 5, 'assets': 15, 'income': 15}
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.shed = defaultdict(int)
+
+    def record(self, route, seconds, status):
+        self.latencies[route].append(seconds)
+        if status == 503:
+            self.shed[route] += 1
+        elif status >= 400:
+            self.errors[route] += 1
+
+    def summary(self, elapsed):
+        routes = {}
+        for route, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            count = len(latencies)
+            routes[route] = {'requests': count,
+                             'throughput_rps': round(count / elapsed, 2),
+                             'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+                             'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+                             'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+                             'error_rate': round(self.errors[route] / count, 4),
+                             'shed_rate': round(self.shed[route] / count, 4)}
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {'elapsed_seconds': round(elapsed, 2),
+                'requests': total,
+                'throughput_rps': round(total / elapsed, 2),
+                'errors': sum(self.errors.values()),
+                'shed': sum(self.shed.values()),
+                'routes': routes}
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+class VirtualUser:
+    def __init__(self, client, stats, account, mix, think):
+        self.client = client
+        self.stats = stats
+        self.username, self.password = account
+        self.mix = mix
+        self.think = think
+        self.wallets = []
+        self.categories = []
+
+    async def request(self, route, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, follow_redirects=False, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError:
+            response, status = None, 599
+        self.stats.record(route, time.perf_counter() - start, status)
+        return response
+
+    async def login(self):
+        await self.request('POST /login', 'POST', '/login', data={'username': self.username, 'password': self.password})
+        # Ids to post with: asset wallets from the transactions page, category types from the categories page
+        page = await self.request('GET /transactions', 'GET', '/transactions')
+        if page is not None:
+            select = re.search(r'name="wallet"[^>]*>(.*?)</select>', page.text, re.S)
+            self.wallets = re.findall(r'<option value="(\d+)"', select.group(1)) if select else []
+        page = await self.request('GET /categories', 'GET', '/categories')
+        if page is not None:
+            self.categories = [(int(id), int(type_id)) for id, type_id in re.findall(r"openUpdateModal\((\d+),\s*'[^']*',\s*'(\d+)'", page.text)
+                               if type_id in ('1', '2')]
+
+    def random_day(self):
+        return (date.today() - timedelta(days=random.randrange(365))).isoformat()
+
+    async def browse(self):
+        params = {'page': random.randint(1, 5)}
+        if random.random() < 0.3 and self.categories:
+            params['category_id'] = random.choice(self.categories)[0]
+        if random.random() < 0.3:
+            start = date.today() - timedelta(days=random.randrange(30, 720))
+            params.update(startdate=start.isoformat(), enddate=(start + timedelta(days=30)).isoformat())
+        if random.random() < 0.1:
+            params['search'] = random.choice(['an', 'grab', 'coffee', 'tien'])
+        await self.request('GET /transactions', 'GET', '/transactions', params=params)
+
+    async def transaction(self):
+        if not self.wallets or not self.categories:
+            return await self.browse()
+        category_id, type_id = random.choice(self.categories)
+        await self.request('POST /transactions/create', 'POST', '/transactions/create',
+                           data={'selected_date': self.random_day(), 'selected_type': type_id, 'category': category_id,
+                                 'wallet': random.choice(self.wallets), 'amount': random.randint(1, 500) * 1000, 'description': 'load test'})
+
+    async def transfer(self):
+        if len(self.wallets) < 2:
+            return await self.browse()
+        wallet, wallet_to = random.sample(self.wallets, 2)
+        await self.request('POST /transactions/create/transfer', 'POST', '/transactions/create/transfer',
+                           data={'selected_date': self.random_day(), 'selected_type': 3, 'category': 1, 'wallet': wallet,
+                                 'wallet_to': wallet_to, 'amount': random.randint(1, 500) * 1000, 'description': 'load test'})
+
+    async def assets(self):
+        await self.request('GET /assets_dashboard', 'GET', '/assets_dashboard')
+
+    async def income(self):
+        params = {}
+        if random.random() < 0.5:
+            start = date.today() - timedelta(days=random.randrange(30, 720))
+            params = {'fromdate': start.isoformat(), 'todate': (start + timedelta(days=random.choice([30, 90, 365]))).isoformat()}
+        await self.request('GET /income_dashboard', 'GET', '/income_dashboard', params=params)
+
+    async def run(self, deadline):
+        await self.login()
+        actions, weights = zip(*self.mix.items())
+        while time.monotonic() < deadline:
+            await getattr(self, random.choices(actions, weights)[0])()
+            if self.think:
+                await asyncio.sleep(random.expovariate(1 / self.think))
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        action, weight = part.split('=')
+        if action not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown action {action}, expected one of {', '.join(DEFAULT_MIX)}")
+        mix[action] = float(weight)
+    return mix
+
+def in_process_app(database):
+    # Run against a copy so the load never touches the real data
+    directory = tempfile.mkdtemp(prefix='fina-load-')
+    shutil.copy(database, os.path.join(directory, 'load.db'))
+    os.environ['FINA_DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'load.db')}"
+    os.chdir(ROOT) # templates, static and preparation/ are relative paths
+    sys.path.insert(0, ROOT)
+    from main import app
+    return app, directory
+
+async def run(args):
+    transport, directory = None, None
+    if args.target is None:
+        app, directory = in_process_app(args.database)
+        transport = httpx.ASGITransport(app=app)
+    base_url = args.target or 'http://loadtest'
+
+    stats = Stats()
+    accounts = [tuple(account.split(':', 1)) for account in args.account]
+    clients = [httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout) for _ in range(args.users)]
+    users = [VirtualUser(client, stats, accounts[n % len(accounts)], args.mix, args.think) for n, client in enumerate(clients)]
+
+    start = time.monotonic()
+    deadline = start + args.duration
+    try:
+        await asyncio.gather(*[user.run(deadline) for user in users])
+    finally:
+        for client in clients:
+            await client.aclose()
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
+    return stats.summary(time.monotonic() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target', help='base URL of a running server; omitted runs the app in-process')
+    parser.add_argument('--database', default=os.path.join(ROOT, 'finance_app.db'), help='database copied for in-process runs')
+    parser.add_argument('--account', action='append', help='username:password, repeat to spread users over accounts (default demo:123)')
+    parser.add_argument('--users', type=int, default=10, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--think', type=float, default=0.5, help='mean think time between actions in seconds, 0 for none')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help='action weights, e.g. browse=50,transaction=15,transfer=5,assets=15,income=15')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+    args.account = args.account or ['demo:123']
+    random.seed(args.seed)
+
+    results = asyncio.run(run(args))
+    results['config'] = {'target': args.target or 'in-process', 'users': args.users, 'duration': args.duration,
+                         'think': args.think, 'mix': args.mix, 'accounts': len(args.account)}
+
+    print(f"{'route':<36} {'reqs':>6} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'shed':>6}")
+    for route, row in results['routes'].items():
+        print(f"{route:<36} {row['requests']:>6} {row['throughput_rps']:>7} {row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8}"
+              f" {row['error_rate']:>7.1%} {row['shed_rate']:>6.1%}")
+    print(f"total {results['requests']} requests in {results['elapsed_seconds']}s, {results['throughput_rps']} rps, "
+          f"{results['errors']} errors, {results['shed']} shed")
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == '__main__':
+    main()
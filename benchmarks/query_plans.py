@@ -0,0 +1,164 @@
+# Query-plan regression check for the hot queries. Builds a populated SQLite database in a
+# temporary directory, runs the real crud/report functions against it while capturing every
+# SELECT they issue, and checks EXPLAIN QUERY PLAN for full scans of the data tables.
+# Exits with status 1 when a query scans one, so it can gate CI.
+#
+#   python benchmarks/query_plans.py [--users 20] [--transactions 2000] [--verbose]
+import argparse
+import atexit
+import itertools
+import os
+import random
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# The app's own engine points at the scratch database too, as data versions read through it
+directory = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, directory, ignore_errors=True)
+os.environ['FINA_DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'plans.db')}"
+os.environ['FINA_SHARDS'] = '0'
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import sessionmaker
+
+import app.crud as crud, app.models as models, app.reports as reports, app.changes as changes, app.rules as rules, app.duplicates as duplicates, app.archive as archive
+from app.migrations import run_migrations
+from app.search import rebuild_index
+from app.budgets import rebuild_counters
+from app.database import engine
+
+# Small lookup tables that are fine to scan
+SCAN_ALLOWED = {'transaction_types'}
+
+def seed(engine, users: int, transactions: int):
+    random.seed(1)
+    start = datetime(2020, 1, 1)
+    words = ['grab', 'coffee', 'rent', 'salary', 'market', 'electricity', 'lunch', 'book', 'taxi', 'gift']
+    with engine.begin() as connection:
+        connection.execute(text("INSERT OR IGNORE INTO transaction_types (id, transaction_type_name) VALUES (1, 'expense'), (2, 'income'), (3, 'transfer'), (4, 'debt')"))
+        for user_id in range(1, users + 1):
+            connection.execute(text("INSERT INTO users (id, username, fullname, email, hashed_password, is_active, currency) VALUES (:id, :name, :name, :email, '', 1, 'VND')"),
+                               {'id': user_id, 'name': f'user{user_id}', 'email': f'user{user_id}@example.com'})
+            wallet_ids = [connection.execute(text("INSERT INTO wallets (user_id, wallet_name, liability, initial_balance) VALUES (:user_id, :name, :liability, 0)"),
+                                             {'user_id': user_id, 'name': f'wallet {n}', 'liability': int(n == 4)}).lastrowid for n in range(5)]
+            category_ids = [(connection.execute(text("INSERT INTO categories (user_id, transaction_type_id, category_name) VALUES (:user_id, :type, :name)"),
+                                                {'user_id': user_id, 'type': 1 + n % 2, 'name': f'category {n}'}).lastrowid, 1 + n % 2) for n in range(10)]
+            connection.execute(text("INSERT INTO budgets (user_id, category_id, month_key, amount) VALUES (:user_id, :category_id, :month_key, 500000)"),
+                               [{'user_id': user_id, 'category_id': category_id, 'month_key': month_key}
+                                for (category_id, _), month_key in zip(category_ids[:3], [None, None, 202103])])
+            rows = []
+            for _ in range(transactions):
+                category_id, type_id = random.choice(category_ids)
+                day = start + timedelta(days=random.randrange(1800))
+                rows.append({'user_id': user_id, 'wallet_id': random.choice(wallet_ids[:4]), 'category_id': category_id, 'type': type_id,
+                             'amount': random.randrange(1, 1000) * 1000, 'description': ' '.join(random.sample(words, 2)),
+                             'date': day, 'date_key': (day - datetime(1970, 1, 1)).days, 'month_key': day.year * 100 + day.month})
+            connection.execute(text("""INSERT INTO transactions (user_id, wallet_id, category_id, transaction_type_id, amount, description, transaction_date, date_key, month_key)
+                                       VALUES (:user_id, :wallet_id, :category_id, :type, :amount, :description, :date, :date_key, :month_key)"""), rows)
+        rebuild_index(connection)
+        rebuild_counters(connection)
+        changes.record_all(connection)
+        duplicates.backfill(connection)
+        connection.execute(text("ANALYZE"))
+
+def hot_queries(db):
+    # name -> callable issuing the query through the app's own code
+    user_id, wallet_id, category_id = 3, db.query(models.Wallet.id).filter(models.Wallet.user_id == 3).first()[0], \
+        db.query(models.Category.id).filter(models.Category.user_id == 3).first()[0]
+    queries = {
+        'user by username': lambda: crud.get_user_by_username(db, 'user3'),
+        'user by email': lambda: crud.get_user_by_email(db, 'user3@example.com'),
+        'user by id': lambda: crud.get_user(db, user_id),
+        'wallets of user': lambda: crud.get_wallets(db, user_id, liability=0),
+        'categories of user': lambda: crud.get_categories(db, user_id),
+        'assets dashboard': lambda: reports.assets_dashboard_data(db, user_id, 'light'),
+        'income dashboard': lambda: reports.income_dashboard_data(db, user_id, 'light'),
+        'period comparison': lambda: crud.compare_periods(db, user_id, [('this', datetime(2021, 3, 1), datetime(2021, 3, 31)),
+                                                                       ('last', datetime(2021, 2, 1), datetime(2021, 2, 28)),
+                                                                       ('last year', datetime(2020, 3, 1), datetime(2020, 3, 31)),
+                                                                       ('archived days', datetime(2020, 5, 10), datetime(2020, 6, 20))],
+                                                          group_by=('transaction_type_id', 'category_id', 'wallet_id')),
+        'archive summaries': lambda: archive.get_summaries(db, user_id, wallet_id=wallet_id),
+        'export': lambda: list(crud.export_transactions(db, user_id, transaction_date_from=datetime(2021, 1, 1), archived=False)),
+        'archived export': lambda: list(crud.export_transactions(db, user_id, search_text='coffee', archived=True)),
+        'budget status': lambda: crud.get_budget_status(db, user_id, datetime(2021, 3, 1)),
+        'sync changes': lambda: changes.get_changes(db, user_id, since=100),
+        'category rules': lambda: rules.get_matcher(db, user_id),
+        'duplicate check': lambda: duplicates.find_duplicate(db, user_id, wallet_id, 1, 18700, 1000, 'coffee'),
+        'duplicate clusters': lambda: duplicates.clusters(db, user_id),
+    }
+    # The transactions page: every combination of its filters, facets and one page of rows
+    filters = {'wallet_id': wallet_id, 'category_id': category_id, 'transaction_type_id': 1,
+               'transaction_date_from': datetime(2021, 1, 1), 'transaction_date_to': datetime(2021, 6, 30), 'search_text': 'coffee'}
+    for size in range(len(filters) + 1):
+        for names in itertools.combinations(filters, size):
+            active = {name: filters[name] for name in names}
+            label = ', '.join(names) or 'no filters'
+            queries[f'transactions page ({label})'] = lambda active=active: crud.get_transactions(db, user_id, limit=10, offset=0, **active)
+            queries[f'transaction facets ({label})'] = lambda active=active: crud.get_transaction_facets(db, user_id, **active)
+            queries[f'archived transactions page ({label})'] = lambda active=active: crud.get_transactions(db, user_id, limit=10, offset=0, archived=True, **active)
+    return queries
+
+def full_scans(plan):
+    scans = []
+    for row in plan:
+        detail = row[-1]
+        if detail.startswith('SCAN '):
+            table = detail.split()[1]
+            if table in models.Base.metadata.tables and table not in SCAN_ALLOWED:
+                scans.append(detail)
+    return scans
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--transactions', type=int, default=2000, help='transactions per user')
+    parser.add_argument('--verbose', action='store_true', help='print every plan')
+    args = parser.parse_args()
+
+    models.Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    seed(engine, args.users, args.transactions)
+    # Half the users have their first year archived
+    db = sessionmaker(bind=engine)()
+    for user_id in range(1, args.users + 1, 2):
+        archive.archive_user(db, user_id, 202101)
+    db.execute(text("ANALYZE"))
+    db.commit()
+    db.close()
+
+    statements = []
+    @event.listens_for(engine, "before_cursor_execute")
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            statements.append((statement, parameters))
+
+    db = sessionmaker(bind=engine)()
+    failures = 0
+    for name, run in hot_queries(db).items():
+        statements.clear()
+        run()
+        captured = list(statements)
+        scans = []
+        with engine.connect() as connection:
+            for statement, parameters in captured:
+                plan = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+                scans += full_scans(plan)
+                if args.verbose:
+                    print(f"  {statement.split(chr(10))[0][:100]}")
+                    for row in plan:
+                        print(f"    {row[-1]}")
+        failures += bool(scans)
+        print(f"{'FAIL' if scans else 'ok  '} {name} ({len(captured)} queries)" + ''.join(f"\n       {scan}" for scan in sorted(set(scans))))
+    db.close()
+    engine.dispose()
+
+    print(f"\n{failures} hot queries with full table scans")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
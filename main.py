@@ -1,37 +1,48 @@
-from fastapi import FastAPI, Request, Form, HTTPException, Depends, Query
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, Request, Form, HTTPException, Depends, Query, BackgroundTasks
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 
-import app.crud as crud, app.models as models, app.schemas as schemas
-from app.reports import *
+import app.crud as crud, app.schemas as schemas, app.changes as changes, app.rules as rules, app.duplicates as duplicates
 from app.formatting import *
-from app.database import SessionLocal, engine
+from app.database import SessionLocal, bind_user, session_for
+from app.sharding import init_storage
+from app.datekeys import epoch_day, from_epoch_day, from_month_key, month_bounds, month_key, resolve_period
+from app.concurrency import run_report
+from app.search import match_expression
+import app.group_commit as group_commit
+import app.statements as statements
+import app.archive as archive
+from app.assets import AssetFiles, asset_url, asset_urls
 from pydantic import BaseModel
 
+import asyncio
+import csv
+import importlib
+import io
 import math
-import pandas as pd
-import numpy as np
+import os
 from typing import Optional, Annotated
-from datetime import date, timedelta, datetime
+from datetime import date, datetime
 import ast
+from urllib.parse import urlencode
 
-models.Base.metadata.create_all(bind=engine)
+init_storage()
 
 app = FastAPI()
 
 # Dependency
-def get_db():
-    db = SessionLocal()
+def get_db(request: Request):
+    # Routed to the signed-in user's shard when the storage is sharded
+    db = session_for(request.cookies.get("user_id"))
     try:
         yield db
     finally:
         db.close()
 
 # Serve static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", AssetFiles(directory="static"), name="static")
 
 # Initialize Jinja2Templates with the templates directory
 templates = Jinja2Templates(directory="templates")
@@ -59,6 +70,8 @@ async def read_profile(request: Request, db: Session = Depends(get_db), error_me
                                                        "username": user.fullname,
                                                        "user": user,
                                                        "currencies": currencies.keys(),
+                                                       'statements': [{'month_key': statement.month_key, 'month': from_month_key(statement.month_key).strftime('%B %Y')}
+                                                                      for statement in crud.get_statements(db, user_id=user_id)],
                                                        'error_message': error_message})
 
 @app.post("/users/update", response_class=HTMLResponse)
@@ -92,18 +105,57 @@ def delete_user(request: Request, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="User not found")
     return RedirectResponse('/', status_code=303)
 
+def purge_user(user_id: int):
+    # Runs after the response with its own session
+    db = session_for(user_id)
+    try:
+        crud.purge_user(db, user_id=user_id)
+    finally:
+        db.close()
+    statements.remove_statements(user_id)
+
+def purge_pending_users():
+    # Finish deletions interrupted by a restart
+    db = SessionLocal()
+    try:
+        user_ids = [user.id for user in crud.get_users_pending_deletion(db)]
+    finally:
+        db.close()
+    for user_id in user_ids:
+        purge_user(user_id)
+
+@app.on_event("startup")
+async def resume_user_purges():
+    # In a thread, so the app serves requests while large accounts are purged in batches.
+    # Kept on app.state so the task is not garbage collected
+    app.state.purge_task = asyncio.create_task(asyncio.to_thread(purge_pending_users))
+
 @app.post("/users/delete")
-def delete_user(request: Request, db: Session = Depends(get_db)):
+def delete_user(request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     user_id = request.cookies.get("user_id")
-    db_user = crud.delete_user(db=db, user_id=user_id)
+    db_user = crud.request_user_deletion(db=db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
+
+    # Small accounts go in one cascading delete, large ones are purged in batches after the response
+    if crud.count_transactions(db, user_id=db_user.id) > crud.PURGE_BACKGROUND_THRESHOLD:
+        background_tasks.add_task(purge_user, db_user.id)
+    else:
+        crud.delete_user(db=db, user_id=db_user.id)
+        statements.remove_statements(db_user.id)
     return RedirectResponse('/', status_code=303)
 
 templates.env.filters['format_number'] = format_number
 templates.env.filters['format_percentage'] = format_percentage
 templates.env.filters['format_date'] = format_date
+templates.env.filters['from_epoch_day'] = from_epoch_day
 templates.env.filters['format_money'] = lambda x, currency='VND': format_money(x, currency)
+templates.env.filters['money_value'] = lambda x, currency='VND': from_minor_units(x, currency)
+templates.env.globals['asset_url'] = asset_url
+templates.env.globals['asset_urls'] = asset_urls
+
+def user_currency(db: Session, user_id):
+    return crud.get_user(db, user_id=user_id).currency
 
 ### Transactions Routes
 @app.get("/transactions", response_class=HTMLResponse, name="transactions")
@@ -114,7 +166,10 @@ async def get_transaction_page(request: Request, db: Session = Depends(get_db),
                          wallet_id: Optional[str] = None,
                          startdate: Optional[str] = None,
                          enddate: Optional[str] = None,
-                         error: Optional[str] = None):
+                         search: Optional[str] = None,
+                         error: Optional[str] = None,
+                         archived: bool = False,
+                         fragment: bool = False):
     
     user_id = request.cookies.get("user_id")
 
@@ -128,89 +183,198 @@ async def get_transaction_page(request: Request, db: Session = Depends(get_db),
     if startdate: startdate = datetime.fromisoformat(startdate)
     if enddate: enddate = datetime.fromisoformat(enddate)
 
-    user = crud.get_user(db, user_id=user_id)
-    username = user.fullname
+    filters = {'wallet_id': wallet_id if wallet_id else None,
+               'category_id': category_id,
+               'transaction_type_id': transaction_type_id,
+               'transaction_date_from': startdate,
+               'transaction_date_to': enddate,
+               # The rows moved out by app/archive.py, only when asked for
+               'archived': archived}
+    facets = crud.get_transaction_facets(db, user_id=user_id, search_text=search, **filters)
+    months = [{'id': key, 'name': month_bounds(key)[0].strftime('%b %Y'), 'startdate': month_bounds(key)[0].isoformat(), 'enddate': month_bounds(key)[1].isoformat(), 'count': count}
+              for key, count in sorted(facets['months'].items(), reverse=True) if key is not None]
+    # Every row has exactly one type, so the type counts add up to the total
+    total = sum(facets['transaction_types'].values())
+    currency = user_currency(db, user_id)
+
+    # Handle case no records
+    if total == 0:
+        error = "No records found" +  "<br>" + error if error is not None else "No records found"
+        transactions_offset, pagination = None, None
+    else:
+        # Pagination
+        pagelimit = 10
+        pages = math.ceil(total / pagelimit)
+
+        if page < 1: page = 1
+        if page > pages: page = pages
+        fromtrans = (page - 1) * pagelimit
+        totrans = page * pagelimit
+        transactions_offset = crud.get_transactions(db, user_id=user_id, search_text=search, limit=pagelimit, offset=fromtrans, **filters)
+        # Keep the active filters when moving between pages
+        query = urlencode({key: value for key, value in request.query_params.items() if key not in ('page', 'error', 'fragment') and value})
+        pagination = {'page': page, 'pages': pages, 'total': total, 'fromtrans': fromtrans + 1, 'totrans': totrans, 'query': query}
+
+    table = {'request': request,
+             'transactions': transactions_offset,
+             'pagination': pagination,
+             'error': error,
+             'archived': archived,
+             'currency': currency}
+
+    if fragment:
+        # Filtering and paging from the page itself: only the table, pagination and facet counts,
+        # without the layout or the option lists of the filters and modals
+        return JSONResponse({'html': templates.get_template('_transactions_table.html').render(table),
+                             'total': total,
+                             'facets': {'categories': facets['categories'],
+                                        'wallets': facets['wallets'],
+                                        'transaction_types': facets['transaction_types'],
+                                        'months': months}})
+
+    username = crud.get_user(db, user_id=user_id).fullname
     categories = crud.get_categories(db, user_id=user_id)
     wallets = crud.get_wallets(db, user_id=user_id, liability=0)
     debtors = crud.get_wallets(db, user_id=user_id, liability=1)
     transaction_types = crud.get_transaction_types(db)
-    transactions = crud.get_transactions(db, user_id=user_id,
-                                         wallet_id=wallet_id if wallet_id else None,
-                                         category_id=category_id,
-                                         transaction_type_id=transaction_type_id,
-                                         transaction_date_from=startdate,
-                                         transaction_date_to=enddate)
     
     all_options = {'categories': [{'id': category.id, 'name': category.category_name} for category in categories],
                    'wallets': [{'id': wallet.id, 'name': wallet.wallet_name} for wallet in wallets],
                    'transaction_types': [{'id': transaction_type.id, 'name': transaction_type.transaction_type_name} for transaction_type in transaction_types],
                    'debtors': [] if len(debtors) == 0 else [{'id': debtor.id, 'name': debtor.wallet_name} for debtor in debtors]}
 
-    filter_options = {'categories': [{x.id: x.category_name} for x in categories if x.id in set(transaction.category_id for transaction in transactions)],
-                'wallets': [{x.id: x.wallet_name} for x in wallets if x.id in set(transaction.wallet_id for transaction in transactions)],
-                'transaction_types': [{x.id: x.transaction_type_name} for x in transaction_types if x.id in set(transaction.transaction_type_id for transaction in transactions)]}
-    
-    # Handle case no records
-    if len(transactions) == 0:
-        error = "No records found" +  "<br>" + error if error is not None else "No records found"
-        return templates.TemplateResponse('transactions.html', 
-                                      {'request': request,
-                                       'username': username,
-                                       'transactions': None,
-                                       'options': None,
-                                       'all_options': all_options,
-                                       'pagination': None,
-                                       'error': error,
-                                       'currency': user.currency})
-    
-    # Pagination
-    pagelimit = 10
-    pages = math.ceil(len(transactions) / pagelimit)
-
-    if page < 1: page = 1
-    if page > pages: page = pages
-    fromtrans = (page - 1) * pagelimit
-    totrans = page * pagelimit
-    transactions_offset = transactions[fromtrans : totrans]
-    pagination = {'page': page, 'pages': pages, 'total': len(transactions), 'fromtrans': fromtrans + 1, 'totrans': totrans}
-    
+    # Every value with its count under the active filters; the page hides those without rows and
+    # updates the counts from fragment responses
+    filter_options = {'categories': [{'id': x.id, 'name': x.category_name, 'count': facets['categories'].get(x.id, 0)} for x in categories],
+                'wallets': [{'id': x.id, 'name': x.wallet_name, 'count': facets['wallets'].get(x.id, 0)} for x in wallets],
+                'transaction_types': [{'id': x.id, 'name': x.transaction_type_name, 'count': facets['transaction_types'].get(x.id, 0)} for x in transaction_types],
+                'months': months}
+    # Budgets of the current month that are used up or nearly so
+    budget_alerts = [row for row in crud.get_budget_status(db, user_id=user_id) if row['warning']]
+    # Transactions recorded more than once, the latest first
+    duplicate_clusters = duplicates.get_clusters(db, user_id=user_id)
+
     return templates.TemplateResponse('transactions.html', 
-                                      {'request': request,
+                                      {**table,
                                        'username': username,
-                                       'transactions': transactions_offset,
                                        'options': filter_options,
                                        'all_options': all_options,
-                                       'pagination': pagination,
-                                       'error': error,
-                                       'currency': user.currency})
+                                       'budget_alerts': budget_alerts,
+                                       'duplicate_clusters': duplicate_clusters})
 
 @app.post("/transactions/create")
 async def add_transaction(request: Request,
                     selected_date: Annotated[str, Form()],
                     selected_type: Annotated[str, Form()],
-                    category: Annotated[str, Form()],
                     wallet: Annotated[str, Form()],
                     amount: Annotated[float, Form()],
                     description: Annotated[str, Form()],
+                    category: Annotated[Optional[str], Form()] = None,
+                    allow_duplicate: Annotated[bool, Form()] = False,
                     db: Session = Depends(get_db)):
     user_id = request.cookies.get("user_id")
     selected_date = datetime.fromisoformat(selected_date).date()
     wallet_id = int(wallet)
-    category_id = int(category)
     transaction_type_id = int(selected_type)
+    amount = to_minor_units(amount, user_currency(db, user_id))
+    if category:
+        category_id = int(category)
+    else:
+        # Left out: the user's categorization rules pick it
+        rule = await run_in_threadpool(rules.suggest_category, db, user_id, description, amount=amount, wallet_id=wallet_id, transaction_type_id=transaction_type_id)
+        if rule is None:
+            return RedirectResponse(url='/transactions?error=No category given and no rule matches', status_code=303)
+        category_id = rule.category_id
     try:
-        crud.create_transaction(db=db,
-                                user_id=user_id,
-                                wallet_id=wallet_id,
-                                category_id=category_id,
-                                transaction_type_id=transaction_type_id,
-                                amount=amount,
-                                transaction_date=selected_date,
-                                description=description)
+        await group_commit.create_transaction(db=db,
+                                              user_id=user_id,
+                                              wallet_id=wallet_id,
+                                              category_id=category_id,
+                                              transaction_type_id=transaction_type_id,
+                                              amount=amount,
+                                              transaction_date=selected_date,
+                                              description=description,
+                                              allow_duplicate=allow_duplicate)
         return RedirectResponse(url='/transactions', status_code=303)
     except HTTPException as e:
         return RedirectResponse(url=f'/transactions?error={e.detail}', status_code=303)
 
+@app.get("/transactions/suggest_category")
+async def suggest_category(request: Request,
+                           description: str = '',
+                           amount: Optional[float] = None,
+                           wallet: Optional[int] = None,
+                           selected_type: Optional[int] = None,
+                           db: Session = Depends(get_db)):
+    # The category the user's rules give a transaction, for the create form
+    user_id = request.cookies.get("user_id")
+    if amount is not None:
+        amount = to_minor_units(amount, user_currency(db, user_id))
+    # Rules are user regular expressions: matched in the threadpool, off the event loop
+    rule = await run_in_threadpool(rules.suggest_category, db, user_id, description, amount=amount, wallet_id=wallet, transaction_type_id=selected_type)
+    return JSONResponse({'category_id': rule.category_id if rule else None, 'rule_id': rule.id if rule else None})
+
+class categorizeTransaction(BaseModel):
+    description: Optional[str] = None
+    amount: Optional[float] = None
+    wallet_id: Optional[int] = None
+    transaction_type_id: Optional[int] = None
+class categorizeRequest(BaseModel):
+    transactions: list[categorizeTransaction]
+@app.post("/transactions/categorize")
+async def categorize_transactions(request: Request,
+                                  body: categorizeRequest,
+                                  db: Session = Depends(get_db)):
+    # Categories for a batch of transactions about to be imported, in order; null where no rule matches
+    user_id = request.cookies.get("user_id")
+    currency = user_currency(db, user_id)
+    rows = [{'description': row.description,
+             'amount': to_minor_units(row.amount, currency) if row.amount is not None else None,
+             'wallet_id': row.wallet_id,
+             'transaction_type_id': row.transaction_type_id} for row in body.transactions]
+    matcher = await run_in_threadpool(rules.get_matcher, db, user_id)
+    return JSONResponse({'categories': await run_in_threadpool(matcher.categorize, rows)})
+
+@app.get("/transactions/duplicates")
+async def get_duplicates(request: Request, db: Session = Depends(get_db)):
+    # Groups of transactions with the same wallet, type, day, amount and description
+    user_id = request.cookies.get("user_id")
+    currency = user_currency(db, user_id)
+    return JSONResponse({'currency': currency,
+                         'clusters': [[{**row, 'date': from_epoch_day(row['date_key']).isoformat(), 'amount': from_minor_units(row['amount'], currency)}
+                                       for row in transactions]
+                                      for transactions in duplicates.get_clusters(db, user_id)]})
+
+class checkDuplicateTransaction(BaseModel):
+    selected_date: date
+    wallet_id: int
+    transaction_type_id: int
+    amount: float
+    description: Optional[str] = None
+class checkDuplicatesRequest(BaseModel):
+    transactions: list[checkDuplicateTransaction]
+@app.post("/transactions/duplicates/check")
+async def check_duplicates(request: Request,
+                           body: checkDuplicatesRequest,
+                           db: Session = Depends(get_db)):
+    # For a batch about to be imported, in order: the id of the stored transaction each row repeats,
+    # and the index of an earlier row of the batch it repeats; null where there is none
+    user_id = request.cookies.get("user_id")
+    currency = user_currency(db, user_id)
+    rows = [{'wallet_id': row.wallet_id,
+             'transaction_type_id': row.transaction_type_id,
+             'date_key': epoch_day(row.selected_date),
+             'amount': to_minor_units(row.amount, currency),
+             'description': row.description} for row in body.transactions]
+    first_rows = {}
+    repeats = []
+    for number, row in enumerate(rows):
+        key = duplicates.fingerprint(user_id, **row)
+        repeats.append(first_rows.get(key))
+        first_rows.setdefault(key, number)
+    return JSONResponse({'duplicates': [{'transaction_id': transaction_id, 'row': row}
+                                        for transaction_id, row in zip(duplicates.find_existing(db, user_id, rows), repeats)]})
+
 @app.post("/transactions/create/transfer")
 async def add_debt(request: Request,
                     selected_date: Annotated[str, Form()],
@@ -220,43 +384,28 @@ async def add_debt(request: Request,
                     wallet_to: Annotated[str, Form()],
                     amount: Annotated[float, Form()],
                     description: Annotated[str, Form()],
+                    allow_duplicate: Annotated[bool, Form()] = False,
                     db: Session = Depends(get_db)):
     user_id = request.cookies.get("user_id")
     selected_date = datetime.fromisoformat(selected_date).date()
     wallet_from = int(wallet)
     transaction_type_id = int(selected_type)
+    amount = to_minor_units(amount, user_currency(db, user_id))
 
-    # Create debt wallet if it doesn't exist
-    if transaction_type_id==4:
-        wallet_to_first = crud.get_wallet_by_name(db=db, user_id=user_id, wallet_name=wallet_to)
-
-        if wallet_to_first is None:
-            crud.create_wallet(db=db, user_id=user_id, wallet_name=wallet_to, liability=1)
-            wallet_to_first = crud.get_wallet_by_name(db=db, user_id=user_id, wallet_name=wallet_to)
-        
-    if transaction_type_id==3:
-        wallet_to_first = crud.get_wallet_by_id(db=db, wallet_id=int(wallet_to))
-
-    print(wallet_to_first.id, wallet_to_first.wallet_name)
-    # Create 2 transactions for the debt
-    ## Create first transaction
-    crud.create_transaction(db=db,
-                            user_id=user_id,
-                            wallet_id=wallet_from,
-                            category_id=None,
-                            transaction_type_id=transaction_type_id,
-                            amount=amount if category == 0 else -amount,
-                            transaction_date=selected_date,
-                            description=description)
-    ## Create second transaction
-    crud.create_transaction(db=db,
-                            user_id=user_id,
-                            wallet_id=wallet_to_first.id,
-                            category_id=None,
-                            transaction_type_id=transaction_type_id,
-                            amount=-amount if category == 0 else amount,
-                            transaction_date=selected_date,
-                            description=description)
+    # category 0 means money comes into the selected wallet (borrow/collect)
+    try:
+        crud.post_transfer(db=db,
+                           user_id=user_id,
+                           transaction_type_id=transaction_type_id,
+                           wallet_id=wallet_from,
+                           amount=amount if category == 0 else -amount,
+                           transaction_date=selected_date,
+                           description=description,
+                           to_wallet_id=int(wallet_to) if transaction_type_id == 3 else None,
+                           to_wallet_name=wallet_to if transaction_type_id == 4 else None,
+                           allow_duplicate=allow_duplicate)
+    except HTTPException as e:
+        return RedirectResponse(url=f'/transactions?error={e.detail}', status_code=303)
 
     return RedirectResponse(url='/transactions', status_code=303)
 
@@ -270,10 +419,12 @@ async def update_transaction(request: Request,
                     description: Annotated[Optional[str], Form()] = None,
                     category: Annotated[Optional[str], Form()] = None,
                     db: Session = Depends(get_db)):
+    user_id = request.cookies.get("user_id")
     selected_date = datetime.fromisoformat(selected_date).date()
     wallet_id = int(wallet)
     transaction_type_id = int(selected_type)
     category_id = int(category) if category else None
+    amount = to_minor_units(amount, user_currency(db, user_id))
 
     try:
         crud.update_transaction(db = db,
@@ -301,6 +452,98 @@ async def delete_transaction(request: Request, db: Session = Depends(get_db)):
     response = RedirectResponse(url=current_url, status_code=303)
     return response
 
+class bulkTransactionsRequest(BaseModel):
+    transaction_ids: Optional[list[int]] = None
+    transaction_type_id: Optional[int] = None
+    category_id: Optional[int] = None
+    wallet_id: Optional[int] = None
+    startdate: Optional[date] = None
+    enddate: Optional[date] = None
+    search: Optional[str] = None
+
+    def filters(self):
+        # A search without any word to match selects nothing to filter on, not every transaction
+        if self.search is not None and not self.search.strip():
+            self.search = None
+        if self.search is not None and match_expression(self.search) is None:
+            raise HTTPException(status_code=400, detail="Search must contain at least one word")
+        filters = {'transaction_ids': self.transaction_ids,
+                   'transaction_type_id': self.transaction_type_id,
+                   'category_id': self.category_id,
+                   'wallet_id': self.wallet_id,
+                   'transaction_date_from': self.startdate,
+                   'transaction_date_to': self.enddate,
+                   'search_text': self.search}
+        # Refuse to touch every transaction of the user by accident
+        if all(value is None for value in filters.values()):
+            raise HTTPException(status_code=400, detail="Select transactions by id or by at least one filter")
+        return filters
+
+class bulkUpdateTransactionsRequest(bulkTransactionsRequest):
+    new_category_id: Optional[int] = None
+    new_wallet_id: Optional[int] = None
+
+@app.post("/transactions/bulk/delete")
+async def delete_transactions(request: Request, body: bulkTransactionsRequest, db: Session = Depends(get_db)):
+    user_id = request.cookies.get("user_id")
+    deleted = crud.delete_transactions(db=db, user_id=user_id, **body.filters())
+    return JSONResponse({'deleted': deleted})
+
+@app.post("/transactions/bulk/update")
+async def update_transactions(request: Request, body: bulkUpdateTransactionsRequest, db: Session = Depends(get_db)):
+    user_id = request.cookies.get("user_id")
+    updated = crud.update_transactions(db=db,
+                                       user_id=user_id,
+                                       new_category_id=body.new_category_id,
+                                       new_wallet_id=body.new_wallet_id,
+                                       **body.filters())
+    return JSONResponse({'updated': updated})
+
+@app.get("/transactions/export")
+async def export_transactions(request: Request,
+                              db: Session = Depends(get_db),
+                              transaction_type_id: Optional[int] = None,
+                              category_id: Optional[int] = None,
+                              wallet_id: Optional[int] = None,
+                              startdate: Optional[date] = None,
+                              enddate: Optional[date] = None,
+                              search: Optional[str] = None,
+                              include_archived: bool = False):
+    # CSV of the transactions under the same filters as the page, archived ones after the rest
+    # when asked for. Amounts are in the currency, not minor units.
+    user_id = request.cookies.get("user_id")
+    currency = user_currency(db, user_id)
+    decimals = currencies.get(currency, currencies['VND'])['decimals']
+    filters = {'transaction_type_id': transaction_type_id,
+               'category_id': category_id,
+               'wallet_id': wallet_id,
+               'transaction_date_from': startdate,
+               'transaction_date_to': enddate,
+               'search_text': search}
+
+    def lines():
+        # Streamed after the request's session is closed, so it reads through its own
+        export_db = session_for(user_id)
+        try:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(['id', 'date', 'type', 'category', 'wallet', 'amount', 'description', 'archived'])
+            for archived in ([False, True] if include_archived else [False]):
+                for number, row in enumerate(crud.export_transactions(export_db, user_id=user_id, archived=archived, **filters)):
+                    transaction_id, transaction_date, type_name, category_name, wallet_name, amount, description = row
+                    writer.writerow([transaction_id, transaction_date.date().isoformat() if transaction_date else '', type_name, category_name, wallet_name,
+                                     f"{from_minor_units(amount, currency):.{decimals}f}", description, int(archived)])
+                    if number % 1000 == 999:
+                        yield buffer.getvalue()
+                        buffer.seek(0)
+                        buffer.truncate()
+            yield buffer.getvalue()
+        finally:
+            export_db.close()
+
+    return StreamingResponse(lines(), media_type='text/csv',
+                             headers={'Content-Disposition': 'attachment; filename="transactions.csv"'})
+
 ### Wallets Routes
 @app.get('/wallets')
 async def get_wallets(request: Request, db: Session = Depends(get_db)):
@@ -329,7 +572,7 @@ async def add_wallet(request: Request,
                         user_id=user_id,
                         wallet_name=wallet,
                         liability=liability,
-                        initial_balance=initial_balance,
+                        initial_balance=to_minor_units(initial_balance, user_currency(db, user_id)),
                         description=description)
         return RedirectResponse(url="/wallets", status_code=303)
     except ValueError:
@@ -342,11 +585,12 @@ async def update_wallet(request: Request,
                         initial_balance: Annotated[float, Form()],
                         description: Annotated[str, Form()],
                         db: Session = Depends(get_db)):
+    user_id = request.cookies.get("user_id")
     try:
         crud.update_wallet(db=db,
                            wallet_id=wallet_id,
                            wallet_name=wallet,
-                           initial_balance=initial_balance,
+                           initial_balance=to_minor_units(initial_balance, user_currency(db, user_id)),
                            description=description)
         return RedirectResponse(url='/wallets', status_code=303)
     except ValueError:
@@ -370,14 +614,22 @@ async def delete_wallet(request: deleteWalletRequest,
 @app.get('/categories')
 async def get_categories(request: Request, db: Session = Depends(get_db)):
     user_id = request.cookies.get("user_id")
-    username = crud.get_user(db, user_id=user_id).fullname
+    user = crud.get_user(db, user_id=user_id)
     categories = crud.get_categories(db, user_id=user_id)
     transaction_types = crud.get_transaction_types(db, ie=True)
+    # Default monthly budgets, with this month's spend against the budget in force
+    budgets = {budget.category_id: budget.amount for budget in crud.get_budgets(db, user_id=user_id)}
+    budget_status = {row['category_id']: row for row in crud.get_budget_status(db, user_id=user_id)}
     return templates.TemplateResponse('categories.html', 
                                       {'request': request,
-                                       'username': username,
+                                       'username': user.fullname,
                                        'categories': categories,
-                                       'transaction_types': transaction_types})
+                                       'transaction_types': transaction_types,
+                                       'budgets': budgets,
+                                       'budget_status': budget_status,
+                                       'rules': crud.get_rules(db, user_id=user_id),
+                                       'wallets': crud.get_wallets(db, user_id=user_id, liability=0),
+                                       'currency': user.currency})
 
 @app.post("/categories/create")
 async def add_category(request: Request,
@@ -398,13 +650,153 @@ async def update_category(request: Request,
                         category: Annotated[str, Form()],
                         transaction_type_id: Annotated[str, Form()],
                         description: Annotated[str, Form()],    
+                        budget: Annotated[Optional[str], Form()] = None,
                         db: Session = Depends(get_db)):
+    user_id = request.cookies.get("user_id")
     try:
         crud.update_category(db=db, category_id=category_id, transaction_type_id=transaction_type_id, category_name=category, description=description)
+        # An empty budget field removes the category's monthly budget
+        if budget is not None:
+            amount = to_minor_units(float(budget), user_currency(db, user_id)) if budget.strip() else None
+            crud.set_budget(db, user_id=user_id, category_id=category_id, amount=amount)
         return RedirectResponse(url='/categories', status_code=303)
     except ValueError:
         return ValueError("Invalid category id", status_code=400)
 
+### Budget Routes
+class setBudgetRequest(BaseModel):
+    category_id: int
+    amount: Optional[float] = None
+    month: Optional[str] = None
+@app.post("/budgets/set")
+async def set_budget(request: Request,
+                     budget: setBudgetRequest,
+                     db: Session = Depends(get_db)):
+    # Without a month the amount is the category's default for every month; no amount removes the budget
+    user_id = request.cookies.get("user_id")
+    month = parse_month(budget.month) if budget.month else None
+    amount = to_minor_units(budget.amount, user_currency(db, user_id)) if budget.amount is not None else None
+    crud.set_budget(db, user_id=user_id, category_id=budget.category_id, amount=amount, month_key=month_key(month) if month else None)
+    return JSONResponse({'status': 'ok'})
+
+@app.get("/budgets/status")
+async def get_budget_status(request: Request, db: Session = Depends(get_db), month: Optional[str] = None):
+    user_id = request.cookies.get("user_id")
+    currency = user_currency(db, user_id)
+    rows = crud.get_budget_status(db, user_id=user_id, month=parse_month(month) if month else None)
+    for row in rows:
+        for column in ('budget', 'spent', 'remaining'):
+            row[column] = from_minor_units(row[column], currency)
+    return JSONResponse({'currency': currency, 'budgets': rows})
+
+def parse_month(value: str):
+    try:
+        return datetime.strptime(value, '%Y-%m')
+    except ValueError:
+        raise HTTPException(status_code=400, detail="month must be YYYY-MM")
+
+### Rule Routes
+def rule_json(rule, currency):
+    return {'id': rule.id,
+            'category_id': rule.category_id,
+            'category_name': rule.category.category_name,
+            'keywords': rule.keywords,
+            'pattern': rule.pattern,
+            'min_amount': from_minor_units(rule.min_amount, currency) if rule.min_amount is not None else None,
+            'max_amount': from_minor_units(rule.max_amount, currency) if rule.max_amount is not None else None,
+            'wallet_id': rule.wallet_id,
+            'wallet_name': rule.wallet.wallet_name if rule.wallet else None,
+            'priority': rule.priority}
+
+@app.get("/rules")
+async def get_rules(request: Request, db: Session = Depends(get_db)):
+    user_id = request.cookies.get("user_id")
+    currency = user_currency(db, user_id)
+    return JSONResponse({'currency': currency, 'rules': [rule_json(rule, currency) for rule in crud.get_rules(db, user_id=user_id)]})
+
+class ruleRequest(BaseModel):
+    # Keywords are comma separated and any of them matches; every condition given must hold
+    category_id: int
+    keywords: Optional[str] = None
+    pattern: Optional[str] = None
+    min_amount: Optional[float] = None
+    max_amount: Optional[float] = None
+    wallet_id: Optional[int] = None
+    priority: int = 0
+class updateRuleRequest(ruleRequest):
+    rule_id: int
+def rule_fields(rule: ruleRequest, currency: str):
+    return {'category_id': rule.category_id,
+            'keywords': rule.keywords,
+            'pattern': rule.pattern,
+            'min_amount': to_minor_units(rule.min_amount, currency) if rule.min_amount is not None else None,
+            'max_amount': to_minor_units(rule.max_amount, currency) if rule.max_amount is not None else None,
+            'wallet_id': rule.wallet_id,
+            'priority': rule.priority}
+
+@app.post("/rules/create")
+async def create_rule(request: Request, rule: ruleRequest, db: Session = Depends(get_db)):
+    user_id = request.cookies.get("user_id")
+    db_rule = crud.create_rule(db, user_id=user_id, **rule_fields(rule, user_currency(db, user_id)))
+    return JSONResponse({'status': 'ok', 'rule_id': db_rule.id})
+
+@app.post("/rules/update")
+async def update_rule(request: Request, rule: updateRuleRequest, db: Session = Depends(get_db)):
+    user_id = request.cookies.get("user_id")
+    crud.update_rule(db, rule_id=rule.rule_id, user_id=user_id, **rule_fields(rule, user_currency(db, user_id)))
+    return JSONResponse({'status': 'ok'})
+
+class deleteRuleRequest(BaseModel):
+    rule_id: int
+@app.post("/rules/delete")
+async def delete_rule(request: Request, rule: deleteRuleRequest, db: Session = Depends(get_db)):
+    user_id = request.cookies.get("user_id")
+    crud.delete_rule(db, rule_id=rule.rule_id, user_id=user_id)
+    return JSONResponse({'status': 'ok'})
+
+### Statement Routes
+@app.get("/statements")
+async def list_statements(request: Request, db: Session = Depends(get_db)):
+    user_id = request.cookies.get("user_id")
+    return JSONResponse({'statements': [{'month_key': statement.month_key,
+                                         'created_date': statement.created_date.isoformat(),
+                                         **{extension: f"/statements/{statement.month_key}.{extension}" for extension in statements.STATEMENT_FORMATS}}
+                                        for statement in crud.get_statements(db, user_id=user_id)]})
+
+@app.get("/statements/{month}.{extension}")
+async def download_statement(request: Request, month: int, extension: str, db: Session = Depends(get_db)):
+    # Rendered ahead of time by app/statements.py; this only looks up the index and sends the file
+    user_id = request.cookies.get("user_id")
+    statement = crud.get_statement(db, user_id=user_id, month_key=month)
+    if statement is None or extension not in statements.STATEMENT_FORMATS:
+        raise HTTPException(status_code=404, detail="Statement not found")
+    return FileResponse(getattr(statement, f"{extension}_path"), filename=f"statement-{month}.{extension}",
+                        content_disposition_type='attachment' if extension == 'pdf' else 'inline')
+
+@app.on_event("startup")
+async def schedule_statements():
+    if os.environ.get("FINA_STATEMENTS") == "1":
+        # Kept on app.state so the task is not garbage collected
+        app.state.statement_task = asyncio.create_task(statements.schedule())
+
+@app.on_event("startup")
+async def schedule_archive():
+    if os.environ.get("FINA_ARCHIVE") == "1":
+        # Moves transactions older than FINA_ARCHIVE_MONTHS to the archive, see app/archive.py
+        app.state.archive_task = asyncio.create_task(archive.schedule())
+
+### Sync Routes
+@app.get("/sync/changes")
+async def get_changes(request: Request,
+                      db: Session = Depends(get_db),
+                      since: int = Query(0, ge=0),
+                      limit: int = Query(500, ge=1, le=5000)):
+    # Inserts, updates and deletes after the `since` sequence, each row once with its current
+    # values. Amounts are minor units of the currency. Ask again with `next` while `more` is true.
+    user_id = request.cookies.get("user_id")
+    return JSONResponse({'currency': user_currency(db, user_id),
+                         **changes.get_changes(db, user_id=user_id, since=since, limit=limit)})
+
 ### User Routes
 @app.get('/login')
 def get_login(request: Request, error=None):
@@ -459,6 +851,7 @@ async def signup(request: Request, db: Session = Depends(get_db)):
         return RedirectResponse(url="/login?error=Invalid+currency", status_code=303)
 
     user = crud.create_user(db, user=form)
+    bind_user(db, user.id)
     
     # New user setup
     with open('preparation/initial_categories.txt', 'r') as category_file:
@@ -488,22 +881,87 @@ async def get_theme(request: Request, darkmode: str = None):
     response.set_cookie(key="darkmode", value=darkmode, httponly=True)
     return response
     
+@app.on_event("startup")
+def prewarm_reports():
+    # Optionally pay the pandas/plotly import cost at boot instead of on the first dashboard request
+    if os.environ.get("FINA_PREWARM") == "1":
+        importlib.import_module("app.reports")
+
+def report_data(name: str):
+    # app.reports (pandas, plotly) is imported on first use, inside the report threadpool,
+    # so workers that only serve transactions or login pages never load it
+    def compute(db, *args):
+        import app.reports as reports
+        return getattr(reports, name)(db, *args)
+    return compute
+
 @app.get("/assets_dashboard")
 async def get_assets_dashboard(request: Request,
-                               db: Session = Depends(get_db),
                                fromdate: str = None,
                                todate: str = None,
-                               wallet: int = None):
+                               wallet: int = None,
+                               full_resolution: bool = False):
     fromdate = fromdate if fromdate != '' else None
     todate = todate if todate != '' else None
-    return assets_dashboard(request, db, templates, fromdate=fromdate, todate=todate, wallet_filter=wallet)
+    user_id = int(request.cookies.get("user_id"))
+    darkmode = request.cookies.get("darkmode")
+    key = ('assets_dashboard', darkmode, fromdate, todate, wallet, full_resolution)
+    context = await run_report(key, user_id, report_data('assets_dashboard_data'), user_id, darkmode, fromdate, todate, wallet, full_resolution)
+    return templates.TemplateResponse("assets_dashboard.html", {'request': request, **context})
 
 @app.get("/income_dashboard")
 async def get_income_dashboard(request: Request,
-                               db: Session = Depends(get_db),
                                fromdate: str = None,
                                todate: str = None,
-                               wallet: int = None):
+                               wallet: int = None,
+                               full_resolution: bool = False,
+                               trend_months: int = Query(6, ge=1, le=36)):
     fromdate = datetime.fromisoformat(fromdate) if fromdate else None
     todate = datetime.fromisoformat(todate) if todate else None
-    return income_dashboard(request, db, templates, fromdate, todate, wallet)
\ No newline at end of file
+    user_id = int(request.cookies.get("user_id"))
+    darkmode = request.cookies.get("darkmode")
+    key = ('income_dashboard', darkmode, fromdate, todate, wallet, full_resolution, trend_months)
+    context = await run_report(key, user_id, report_data('income_dashboard_data'), user_id, darkmode, fromdate, todate, wallet, full_resolution, trend_months)
+    return templates.TemplateResponse("income_dashboard.html", {'request': request, **context})
+
+### Report API
+@app.get("/reports/compare")
+async def compare_periods(request: Request,
+                          db: Session = Depends(get_db),
+                          periods: str = "this_month,last_month,same_month_last_year",
+                          anchor: Optional[str] = None,
+                          group_by: str = "category",
+                          wallet: Optional[int] = None):
+    # Income and expense per category and/or wallet for each period, e.g.
+    # ?periods=this_month,last_month,same_month_last_year or ?periods=2024-01-01:2024-03-31,month-12
+    user_id = request.cookies.get("user_id")
+    currency = user_currency(db, user_id)
+    try:
+        anchor = date.fromisoformat(anchor) if anchor else date.today()
+        resolved = [resolve_period(spec.strip(), anchor) for spec in periods.split(',') if spec.strip()]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid period: {e}")
+    if len(set(label for label, _, _ in resolved)) != len(resolved):
+        raise HTTPException(status_code=400, detail="Duplicate period")
+    groups = {'category': 'category_id', 'wallet': 'wallet_id'}
+    if not group_by or any(name not in groups for name in group_by.split(',')):
+        raise HTTPException(status_code=400, detail="group_by must be category, wallet or category,wallet")
+    group_columns = ('transaction_type_id',) + tuple(groups[name] for name in group_by.split(','))
+
+    rows = crud.compare_periods(db, user_id=user_id, periods=resolved, group_by=group_columns, wallet_id=wallet)
+
+    names = {'category_id': {category.id: category.category_name for category in crud.get_categories(db, user_id=user_id)},
+             'wallet_id': {wallet.id: wallet.wallet_name for wallet in crud.get_wallets(db, user_id=user_id)}}
+    comparison = {}
+    for row in rows:
+        group = tuple(row[column] for column in group_columns)
+        if group not in comparison:
+            comparison[group] = {'type': 'income' if row['transaction_type_id'] == 2 else 'expense',
+                                 **{column: row[column] for column in group_columns[1:]},
+                                 **{column.replace('_id', '_name'): names[column].get(row[column]) for column in group_columns[1:]},
+                                 'amounts': {label: 0 for label, _, _ in resolved}}
+        comparison[group]['amounts'][row['label']] = from_minor_units(row['amount'], currency)
+
+    return JSONResponse({'currency': currency,
+                         'periods': [{'label': label, 'from': first.isoformat(), 'to': last.isoformat()} for label, first, last in resolved],
+                         'rows': sorted(comparison.values(), key=lambda row: (row['type'], -max(row['amounts'].values())))})
\ No newline at end of file